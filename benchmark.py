@@ -0,0 +1,312 @@
+# Benchmarks do pipeline de classificação
+# Uso: python benchmark.py [batch|scaling|pipeline|compare] [--rows 1000 100000 1000000] [--repeat 3] [--max-workers N]
+#
+# pipeline mede cada etapa separadamente (classify_code, get_item_code, leitura,
+# classificação, escrita e as rotas HTTP de ponta a ponta) sobre uma carga sintética
+# e acrescenta o resultado em --output (JSON Lines); compare mostra a variação entre
+# as duas últimas execuções com os mesmos parâmetros
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+import openpyxl
+import pandas as pd
+
+import main
+from main import classify_code, classify_series, classify_series_parallel, get_item_code, is_code_matched, rule_index
+
+# Limite de linhas de uma aba do Excel (sem contar o cabeçalho)
+EXCEL_MAX_ROWS = 1_048_575
+
+# Formatos de entrada que o benchmark sabe gerar
+BENCH_INPUT_FORMATS = ("xlsx", "csv", "parquet")
+
+# Histórico padrão do pipeline, em um diretório ignorado pelo git (fora do diretório atual)
+BENCH_OUTPUT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks", "benchmark_results.jsonl")
+
+# Códigos que certamente se enquadram: códigos exatos e NCMs gerados a partir dos prefixos
+def known_codes(rng):
+    known = [code for rule in rule_index.rules for code in rule.get("codes", ())]
+    for rule in rule_index.rules:
+        for prefix in rule.get("prefixes", ()):
+            suffixes = rng.integers(0, 10 ** (8 - len(prefix)), 20)
+            known += [prefix + str(suffix).zfill(8 - len(prefix)) for suffix in suffixes]
+    return np.array(known)
+
+# Gera uma carga sintética com colunas NCM e Faturamento:
+# - hit_ratio: fração dos códigos distintos que se enquadram em alguma regra
+# - unique_ratio: códigos distintos / linhas (duplicação típica de planilhas reais)
+# - dotted_ratio: fração dos códigos de 8 dígitos escritos com pontos (3101.00.00)
+def synthetic_workload(rows, hit_ratio=0.4, unique_ratio=0.2, dotted_ratio=0.5, revenue=True, seed=42):
+    rng = np.random.default_rng(seed)
+    distinct = max(1, int(rows * unique_ratio))
+
+    random_codes = np.char.zfill(rng.integers(0, 10 ** 8, distinct).astype(str), 8)
+    pool = pd.Series(np.where(rng.random(distinct) < hit_ratio, rng.choice(known_codes(rng), distinct), random_codes))
+    dotted = pool.str.len().eq(8) & (rng.random(distinct) < dotted_ratio)
+    pool[dotted] = pool[dotted].str[:4] + "." + pool[dotted].str[4:6] + "." + pool[dotted].str[6:]
+
+    df = pd.DataFrame({"NCM": pool.to_numpy()[rng.integers(0, distinct, rows)]})
+    if revenue:
+        df["Faturamento"] = rng.lognormal(mean=9, sigma=1.5, size=rows).round(2)
+    return df
+
+# Coluna NCM sintética (40% de códigos enquadrados, metade com pontos)
+def synthetic_ncm_column(rows, seed=42):
+    return synthetic_workload(rows, unique_ratio=1.0, revenue=False, seed=seed)["NCM"]
+
+# Grava a carga no formato de entrada pedido; devolve o caminho do arquivo
+def write_input_file(df, input_format, directory):
+    path = os.path.join(directory, f"entrada.{input_format}")
+    if input_format == "csv":
+        df.to_csv(path, index=False)
+    elif input_format == "parquet":
+        df.to_parquet(path, index=False)
+    else:
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet("Planilha1")
+        sheet.append(list(df.columns))
+        for row in df.itertuples(index=False, name=None):
+            sheet.append(row)
+        workbook.save(path)
+    return path
+
+# Caminho antigo de /classify-excel: quatro Series.apply linha a linha
+def classify_with_apply(codes):
+    df = pd.DataFrame({"NCM": codes})
+    df['Classificação NCM'] = df['NCM'].apply(classify_code)
+    df['Código do item (índice)'] = df['NCM'].apply(get_item_code)
+    df['Classificação (enquadra ou não)'] = df['Classificação NCM'].apply(lambda x: "Enquadrado" if is_code_matched(x) else "Não enquadrado")
+    df['Enquadrado'] = df['Classificação (enquadra ou não)'].apply(lambda x: True if x == "Enquadrado" else False)
+    return df
+
+# Executa a função algumas vezes e retorna o melhor tempo em segundos.
+# setup (opcional) roda antes de cada repetição, fora da medição
+def best_of(func, repeat, setup=None):
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def bench_batch(rows, repeat):
+    codes = synthetic_ncm_column(rows)
+    apply_time = best_of(lambda: classify_with_apply(codes), repeat)
+    vector_time = best_of(lambda: classify_series(codes), repeat)
+    print(f"Linhas: {rows}")
+    print(f"  .apply (4 colunas):  {apply_time:.3f}s")
+    print(f"  classify_series:     {vector_time:.3f}s")
+    print(f"  Ganho:               {apply_time / vector_time:.1f}x")
+
+# Escalabilidade da classificação paralela de 1 a N processos
+def bench_scaling(rows, repeat, max_workers):
+    codes = synthetic_ncm_column(rows)
+    serial_time = best_of(lambda: classify_series(codes), repeat)
+    print(f"Linhas: {rows} ({codes.nunique()} códigos distintos)")
+    print(f"  classify_series (1 processo, sem pool): {serial_time:.3f}s")
+    for workers in range(1, max_workers + 1):
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Aquecimento: inicia os processos antes de medir
+            list(executor.map(abs, range(workers)))
+            elapsed = best_of(lambda: classify_series_parallel(codes, executor=executor, chunks=workers * 4), repeat)
+        print(f"  {workers} processo(s): {elapsed:.3f}s ({serial_time / elapsed:.2f}x)")
+
+# Lê o arquivo de entrada como /classify-excel faria (mesma escolha de modo de leitura)
+def read_input(path, input_format):
+    use_streaming = main.should_stream(input_format, os.path.getsize(path), False)
+    batches, _ = main.open_input_batches(path, input_format, use_streaming)
+    return list(batches)
+
+# Classifica os lotes lidos e acumula as métricas, como em process_spreadsheet
+def classify_batches(batches):
+    renames, revenue_column = main.detect_columns(batches[0])
+    accumulator = main.MetricsAccumulator(revenue_column)
+    classified = []
+    for batch in batches:
+        batch = main.prepare_batch(batch, renames, revenue_column)
+        accumulator.update(batch)
+        classified.append(batch)
+    metrics = accumulator.metrics()
+    metrics["processing_time"] = 0.0
+    return classified, revenue_column, metrics
+
+def write_output(classified, revenue_column, metrics, output_format, directory):
+    path = os.path.join(directory, f"saida.{output_format}")
+    writer = main.RESULT_WRITERS[output_format](path, revenue_column, metrics.get("total_revenue", 0))
+    for batch in classified:
+        writer.write_batch(batch)
+    writer.close(metrics)
+
+# Rotas HTTP de ponta a ponta, no próprio processo (TestClient). Cada repetição de
+# /classify-excel usa um armazenamento de resultados vazio; a variante "cached"
+# mede o reaproveitamento de um upload idêntico
+def bench_http(df, path, output_format, repeat, directory):
+    try:
+        from fastapi.testclient import TestClient
+    except (ImportError, RuntimeError):
+        print("  (rotas HTTP ignoradas: instale httpx para usar o TestClient)")
+        return {}
+
+    with open(path, "rb") as f:
+        content = f.read()
+    filename = os.path.basename(path)
+    codes = df["NCM"].head(100_000).tolist()
+    body = "\n".join(codes).encode()
+    stages = {}
+
+    def fresh_store():
+        main.result_store = main.ResultStore(tempfile.mkdtemp(dir=directory), main.RESULTS_TTL_SECONDS, main.RESULTS_MAX_BYTES)
+
+    def post_excel():
+        client.post(f"/classify-excel?output_format={output_format}", files={"file": (filename, content)}).raise_for_status()
+
+    def post_codes():
+        client.post("/classify", json={"codes": codes}).raise_for_status()
+
+    def post_stream():
+        client.post("/classify/stream", content=body, headers={"content-type": "text/plain"}).raise_for_status()
+
+    original_store = main.result_store
+    try:
+        with TestClient(main.app) as client:
+            stages["http_classify_excel"] = (best_of(post_excel, repeat, setup=fresh_store), len(df))
+            stages["http_classify_excel_cached"] = (best_of(post_excel, repeat), len(df))
+            stages["http_classify"] = (best_of(post_codes, repeat, setup=main.resolve_code.cache_clear), len(codes))
+            stages["http_classify_stream"] = (best_of(post_stream, repeat, setup=main.resolve_code.cache_clear), len(codes))
+    finally:
+        main.result_store = original_store
+    return stages
+
+# Mede cada etapa do pipeline separadamente; devolve o formato de entrada
+# usado e {etapa: (segundos, linhas processadas)}
+def bench_pipeline(rows, args, directory):
+    input_format = args.input_format
+    if input_format == "xlsx" and rows > EXCEL_MAX_ROWS:
+        print(f"  {rows} linhas não cabem em uma aba .xlsx; usando entrada parquet")
+        input_format = "parquet"
+
+    df = synthetic_workload(rows, args.hit_ratio, args.unique_ratio, args.dotted_ratio, not args.no_revenue, args.seed)
+    path = write_input_file(df, input_format, directory)
+    codes = df["NCM"].tolist()
+    stages = {}
+
+    # Chamadas linha a linha, com o cache de códigos vazio a cada repetição
+    stages["classify_code"] = (best_of(lambda: [classify_code(code) for code in codes], args.repeat, setup=main.resolve_code.cache_clear), rows)
+    stages["get_item_code"] = (best_of(lambda: [get_item_code(code) for code in codes], args.repeat, setup=main.resolve_code.cache_clear), rows)
+
+    stages[f"read_{input_format}"] = (best_of(lambda: read_input(path, input_format), args.repeat), rows)
+    batches = read_input(path, input_format)
+    stages["classify"] = (best_of(lambda: classify_batches(batches), args.repeat), rows)
+    classified, revenue_column, metrics = classify_batches(batches)
+    stages[f"write_{args.output_format}"] = (best_of(lambda: write_output(classified, revenue_column, metrics, args.output_format, directory), args.repeat), rows)
+
+    if not args.skip_http:
+        stages.update(bench_http(df, path, args.output_format, args.repeat, directory))
+    return input_format, stages
+
+# Parâmetros que identificam execuções comparáveis
+def run_params(rows, input_format, args):
+    return {
+        "rows": rows,
+        "input_format": input_format,
+        "output_format": args.output_format,
+        "hit_ratio": args.hit_ratio,
+        "unique_ratio": args.unique_ratio,
+        "dotted_ratio": args.dotted_ratio,
+        "revenue": not args.no_revenue,
+        "repeat": args.repeat,
+        "seed": args.seed,
+    }
+
+def environment_info():
+    return {
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "rules_version": rule_index.version,
+    }
+
+def run_pipeline(args):
+    directory = tempfile.mkdtemp(prefix="ncm-bench-")
+    try:
+        for rows in args.rows:
+            print(f"Linhas: {rows}")
+            input_format, stages = bench_pipeline(rows, args, directory)
+            record = {
+                "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                "params": run_params(rows, input_format, args),
+                "environment": environment_info(),
+                "stages": {
+                    name: {"seconds": round(seconds, 6), "rows_per_second": round(count / seconds) if seconds > 0 else None}
+                    for name, (seconds, count) in stages.items()
+                },
+            }
+            for name, stage in record["stages"].items():
+                print(f"  {name:<28} {stage['seconds']:>9.3f}s  {stage['rows_per_second'] or 0:>12,} linhas/s")
+            os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+            with open(args.output, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        print(f"Resultados acrescentados em {args.output}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+# Compara as duas últimas execuções de cada conjunto de parâmetros
+def run_compare(args):
+    with open(args.output, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    runs = {}
+    for record in records:
+        runs.setdefault(json.dumps(record["params"], sort_keys=True), []).append(record)
+
+    for params, history in runs.items():
+        if len(history) < 2:
+            continue
+        previous, latest = history[-2], history[-1]
+        print(params)
+        print(f"  {previous['timestamp']} -> {latest['timestamp']}")
+        for name, stage in latest["stages"].items():
+            before = previous["stages"].get(name)
+            if before is None:
+                print(f"  {name:<28} {stage['seconds']:>9.3f}s  (nova etapa)")
+                continue
+            change = (stage["seconds"] - before["seconds"]) / before["seconds"] * 100 if before["seconds"] > 0 else 0.0
+            print(f"  {name:<28} {before['seconds']:>9.3f}s -> {stage['seconds']:>9.3f}s  {change:+6.1f}%")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks do classificador NCM/NBS")
+    parser.add_argument("suite", nargs="?", choices=["batch", "scaling", "pipeline", "compare"], default="batch")
+    parser.add_argument("--rows", type=int, nargs="+", default=[500_000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--hit-ratio", type=float, default=0.4)
+    parser.add_argument("--unique-ratio", type=float, default=0.2)
+    parser.add_argument("--dotted-ratio", type=float, default=0.5)
+    parser.add_argument("--no-revenue", action="store_true")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--input-format", choices=BENCH_INPUT_FORMATS, default="xlsx")
+    parser.add_argument("--output-format", choices=main.OUTPUT_FORMATS, default="xlsx")
+    parser.add_argument("--skip-http", action="store_true")
+    parser.add_argument("--output", default=BENCH_OUTPUT_PATH)
+    args = parser.parse_args()
+    if args.suite == "compare":
+        run_compare(args)
+    elif args.suite == "pipeline":
+        run_pipeline(args)
+    else:
+        for rows in args.rows:
+            if args.suite == "scaling":
+                bench_scaling(rows, args.repeat, args.max_workers)
+            else:
+                bench_batch(rows, args.repeat)
@@ -1,21 +1,102 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, APIRouter, File, UploadFile, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse, Response, JSONResponse
+from starlette.requests import ClientDisconnect
 from pydantic import BaseModel
-import pandas as pd
 import re
 import os
 import time
-from io import BytesIO
 import tempfile
 import logging
-import numpy as np
+import pickle
+import threading
+from functools import lru_cache, cached_property
+import asyncio
+import json
+import orjson
+import csv
+import uuid
+import hashlib
+import secrets
+import cProfile
+from contextlib import contextmanager, asynccontextmanager, suppress
+import gzip
+import shutil
+import itertools
+import operator
+import zipfile
+import mmap
+import struct
+import array
+import bisect
+import sys
+import importlib
+import importlib.util
+from email.utils import parsedate_to_datetime, formatdate
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# pandas, numpy e openpyxl só são importados no primeiro uso (rotas de planilhas):
+# uma instância que atende apenas a classificação de códigos inicia bem mais
+# rápido e ocupa menos memória
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        value = getattr(self._module, attr)
+        # Os próximos acessos ao mesmo atributo não passam mais por aqui
+        self.__dict__[attr] = value
+        return value
+
+pd = LazyModule("pandas")
+np = LazyModule("numpy")
+openpyxl = LazyModule("openpyxl")
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+# Ciclo de vida do app: na subida, cria o pool de planilhas (modo completo) e inicia
+# a verificação do arquivo de regras; no encerramento, para a verificação e encerra
+# o pool. As funções chamadas aqui são definidas mais adiante no módulo
+@asynccontextmanager
+async def lifespan(app):
+    start_rules_watcher()
+    if SERVICE_MODE == "completo":
+        get_spreadsheet_pool()
+    try:
+        yield
+    finally:
+        await stop_rules_watcher()
+        shutdown_spreadsheet_pool()
+
+app = FastAPI(lifespan=lifespan)
+
+# Modo de serviço: "completo" (padrão) monta todas as rotas; "classificacao" monta
+# só as de classificação de códigos, regras e métricas, sem frontend nem planilhas
+SERVICE_MODES = ("completo", "classificacao")
+SERVICE_MODE = os.environ.get("NCM_SERVICE_MODE", "completo")
+if SERVICE_MODE not in SERVICE_MODES:
+    raise ValueError(f"NCM_SERVICE_MODE inválido: {SERVICE_MODE}. Use um de: {', '.join(SERVICE_MODES)}.")
+
+# Rotas do frontend e de planilhas, incluídas no app apenas no modo "completo"
+spreadsheet_routes = APIRouter()
+
+# Opções do orjson: aceita chaves não textuais e tipos numpy nas respostas
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+# Resposta JSON serializada com orjson, bem mais rápido que o json padrão em
+# respostas grandes. As rotas devolvem a instância diretamente, sem jsonable_encoder
+class FastJSONResponse(JSONResponse):
+    def render(self, content):
+        return orjson.dumps(content, option=ORJSON_OPTIONS)
 
 # Configurar CORS para permitir acesso de origens diferentes
 app.add_middleware(
@@ -26,6 +107,161 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Limites (em segundos) dos histogramas de latência
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Métrica no formato texto do Prometheus: contador, gauge ou histograma, com uma
+# série por combinação de rótulos
+class Metric:
+    def __init__(self, kind, name, help_text):
+        self.kind = kind
+        self.name = name
+        self.help_text = help_text
+        self.series = {}
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.series[key] = self.series.get(key, 0) + value
+
+    def set(self, value, **labels):
+        self.series[tuple(sorted(labels.items()))] = value
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        histogram = self.series.setdefault(key, {"buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0, "count": 0})
+        for position, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                histogram["buckets"][position] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in self.series.items():
+            if self.kind != "histogram":
+                lines.append(f"{self.name}{format_labels(key)} {value}")
+                continue
+            for bound, count in zip(LATENCY_BUCKETS, value["buckets"]):
+                lines.append(f"{self.name}_bucket{format_labels(key + (('le', str(bound)),))} {count}")
+            lines.append(f"{self.name}_bucket{format_labels(key + (('le', '+Inf'),))} {value['count']}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {value['sum']}")
+            lines.append(f"{self.name}_count{format_labels(key)} {value['count']}")
+        return lines
+
+# Rótulos no formato {nome="valor",...}, com escape de barra, aspas e quebra de linha
+def format_labels(key):
+    if not key:
+        return ""
+    escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in key) + "}"
+
+# Registro das métricas do processo principal. Os coletores rodam a cada leitura
+# de /metrics para atualizar valores obtidos de outras estruturas (cache, fila, jobs)
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def add(self, kind, name, help_text):
+        metric = Metric(kind, name, help_text)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        for collect in self.collectors:
+            collect()
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+metrics_registry = MetricsRegistry()
+HTTP_REQUEST_SECONDS = metrics_registry.add("histogram", "ncm_http_request_duration_seconds", "Duração das requisições HTTP, até o fim da resposta")
+SPREADSHEET_STAGE_SECONDS = metrics_registry.add("histogram", "ncm_spreadsheet_stage_seconds", "Tempo de cada etapa do processamento de planilhas")
+ROWS_CLASSIFIED = metrics_registry.add("counter", "ncm_rows_classified_total", "Linhas e códigos classificados, por origem")
+UPLOAD_BYTES = metrics_registry.add("counter", "ncm_upload_bytes_total", "Bytes recebidos em uploads de planilhas")
+RESULT_BYTES = metrics_registry.add("counter", "ncm_result_bytes_total", "Bytes gravados em arquivos de resultado")
+RESULT_CACHE_LOOKUPS = metrics_registry.add("counter", "ncm_result_cache_lookups_total", "Consultas ao armazenamento de resultados (hit/miss)")
+EXCEL_ENGINE_FAILURES = metrics_registry.add("counter", "ncm_excel_engine_failures_total", "Falhas de leitura por engine de Excel")
+SPREADSHEET_FAILURES = metrics_registry.add("counter", "ncm_spreadsheet_failures_total", "Planilhas que falharam, por tipo de erro")
+INCREMENTAL_ROWS = metrics_registry.add("counter", "ncm_incremental_rows_total", "Linhas de uploads incrementais, por situação em relação ao resultado anterior")
+
+# Middleware ASGI que mede a duração de cada requisição (inclusive respostas em
+# streaming) por rota, método e status
+class RequestMetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - start,
+                route=route.path if route is not None else "desconhecida",
+                method=scope["method"],
+                status=status["code"],
+            )
+
+app.add_middleware(RequestMetricsMiddleware)
+
+# Tempos por etapa e falhas de engine de um processamento de planilha. É criado no
+# processo do pool e volta com a resposta, para ser registrado no processo principal
+class ProcessingStats:
+    def __init__(self):
+        self.stages = {}
+        self.engine_failures = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def engine_failed(self, engine):
+        self.engine_failures[engine] = self.engine_failures.get(engine, 0) + 1
+
+    def stage_seconds(self):
+        return {name: round(seconds, 3) for name, seconds in self.stages.items()}
+
+# Diretório para perfis do cProfile de cada planilha processada (vazio = desativado).
+# Os arquivos .prof podem ser abertos com pstats ou snakeviz
+PROFILE_DIR = os.environ.get("NCM_PROFILE_DIR")
+
+def start_profiler():
+    if not PROFILE_DIR:
+        return None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def stop_profiler(profiler, label):
+    if profiler is None:
+        return
+    profiler.disable()
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"{label}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.prof")
+    profiler.dump_stats(path)
+    logger.info(f"Perfil gravado em {path}")
+
+# Erro de validação da planilha. Ao contrário de HTTPException, pode ser
+# devolvido pelos processos do pool; a rota o converte na resposta HTTP
+class SpreadsheetError(Exception):
+    def __init__(self, status_code, detail):
+        super().__init__(status_code, detail)
+        self.status_code = status_code
+        self.detail = detail
+
 # Modelo para entrada de códigos individuais
 class CodeInput(BaseModel):
     codes: list[str]
@@ -36,605 +272,3032 @@ def normalize_code(code):
         code = str(code)
     return code.replace(".", "")
 
-# Função para verificar a qual descrição o código (NCM ou NBS) pertence
-def classify_code(code):
-    code_normalized = normalize_code(code)
+# Tamanho dos códigos NCM completos (regras por prefixo só se aplicam a eles)
+NCM_LENGTH = 8
+
+# Arquivo com a tabela de regras versionada, na ordem de precedência da classificação.
+# Cada regra tem: número do item, códigos exatos, prefixos (válidos apenas
+# para NCMs de 8 dígitos), exceções exatas, exceções por prefixo e descrição.
+RULES_PATH = os.environ.get("NCM_RULES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "rules.json"))
+
+RULE_CODE_FIELDS = ("codes", "prefixes", "exclude", "exclude_prefixes")
+RULE_PREFIX_FIELDS = ("prefixes", "exclude_prefixes")
+
+# Maior código aceito nas regras (as chaves numéricas do índice usam 64 bits)
+RULE_CODE_MAX_DIGITS = 16
+
+# Valida o conteúdo de um arquivo de regras e devolve (versão, regras). A versão
+# combina o campo "version" com o hash do conteúdo, então qualquer edição a altera
+def parse_rules(content):
+    try:
+        document = orjson.loads(content)
+    except orjson.JSONDecodeError as e:
+        raise ValueError(f"JSON inválido: {str(e)}")
+    if not isinstance(document, dict) or not isinstance(document.get("rules"), list) or not document["rules"]:
+        raise ValueError('O arquivo de regras deve ter uma lista "rules" não vazia.')
+    for position, rule in enumerate(document["rules"], start=1):
+        if not isinstance(rule, dict):
+            raise ValueError(f"Regra {position}: deve ser um objeto.")
+        for field in ("item", "description"):
+            if not isinstance(rule.get(field), str) or not rule[field]:
+                raise ValueError(f'Regra {position}: campo "{field}" obrigatório.')
+        for field in RULE_CODE_FIELDS:
+            values = rule.get(field, [])
+            # Prefixos só se aplicam a NCMs completos: um prefixo mais longo nunca casaria
+            max_digits = NCM_LENGTH if field in RULE_PREFIX_FIELDS else RULE_CODE_MAX_DIGITS
+            if not isinstance(values, list) or not all(isinstance(v, str) and v.isascii() and v.isdigit() and len(v) <= max_digits for v in values):
+                raise ValueError(f'Regra {position} (item {rule["item"]}): "{field}" deve ser uma lista de códigos numéricos, sem pontos, com até {max_digits} dígitos.')
+        if not rule.get("codes") and not rule.get("prefixes"):
+            raise ValueError(f'Regra {position} (item {rule["item"]}): informe "codes" ou "prefixes".')
+    version = f"{document.get('version', '0')}-{hashlib.sha256(content).hexdigest()[:12]}"
+    return version, document["rules"]
+
+# Lê e valida o arquivo de regras
+def load_rules(path=RULES_PATH):
+    with open(path, "rb") as f:
+        return parse_rules(f.read())
+
+# Verifica se uma regra se aplica ao código, avaliando-a por completo
+def rule_matches(rule, code_normalized):
+    if code_normalized in rule.get("codes", ()):
+        return True
+    if len(code_normalized) != NCM_LENGTH or not code_normalized.isdigit():
+        return False
+    if code_normalized in rule.get("exclude", ()):
+        return False
+    if any(code_normalized.startswith(p) for p in rule.get("exclude_prefixes", ())):
+        return False
+    return any(code_normalized.startswith(p) for p in rule.get("prefixes", ()))
+
+# Tabelas de consulta das regras, com a precedência já resolvida: códigos citados
+# explicitamente (inclusive exceções) e, para NCMs de 8 dígitos, os prefixos de
+# cada profundidade. Cada tabela mapeia código -> posição da regra (-1 sem regra)
+def build_rule_tables(rules):
+    special_codes = set()
+    for rule in rules:
+        special_codes.update(rule.get("codes", ()))
+        special_codes.update(rule.get("exclude", ()))
+    exact = {}
+    for code in special_codes:
+        exact[code] = next((pos for pos, r in enumerate(rules) if rule_matches(r, code)), -1)
+
+    # Os demais NCMs dependem apenas dos prefixos no caminho: o prefixo mais longo
+    # presente na tabela decide, mesmo que sua posição seja -1
+    paths = set()
+    for rule in rules:
+        for prefix in list(rule.get("prefixes", ())) + list(rule.get("exclude_prefixes", ())):
+            paths.update(prefix[:depth] for depth in range(1, len(prefix) + 1))
+    prefix_levels = {}
+    for path in paths:
+        prefix_levels.setdefault(len(path), {})[path] = next(
+            (pos for pos, r in enumerate(rules)
+             if any(path.startswith(p) for p in r.get("prefixes", ()))
+             and not any(path.startswith(p) for p in r.get("exclude_prefixes", ()))),
+            -1,
+        )
+    return exact, prefix_levels
+
+# Chave numérica de um código só com dígitos. O número de dígitos entra na chave
+# para que "0101" e "101" continuem diferentes
+def code_key(code):
+    return int(code) * 100 + len(code)
+
+# Diretório dos índices binários das regras, compartilhados pelos workers do
+# mesmo usuário (um diretório por usuário, acessível só a ele)
+RULES_INDEX_DIR = os.environ.get(
+    "NCM_RULES_INDEX_DIR", os.path.join(tempfile.gettempdir(), f"ncm-regras-{os.getuid() if hasattr(os, 'getuid') else 0}")
+)
+
+# Formato do arquivo de índice: cabeçalho (assinatura, ordem dos bytes, versão das
+# regras) seguido das seções, cada uma com profundidade (0 = códigos exatos),
+# quantidade, chaves uint64 ordenadas e posições int16, alinhadas em 8 bytes
+RULES_INDEX_MAGIC = b"NCMIDX01"
+
+def encode_rule_index(version, exact, prefix_levels):
+    sections = [(0, {code_key(code): pos for code, pos in exact.items()})]
+    sections += [(depth, {int(prefix): pos for prefix, pos in level.items()}) for depth, level in sorted(prefix_levels.items())]
+
+    version_bytes = version.encode()
+    header = RULES_INDEX_MAGIC + struct.pack("<BI", sys.byteorder == "little", len(version_bytes)) + version_bytes
+    parts = [header + b"\0" * (-len(header) % 8), struct.pack("<II", len(sections), 0)]
+    for depth, table in sections:
+        keys = sorted(table)
+        parts.append(struct.pack("<II", depth, len(keys)))
+        parts.append(array.array("Q", keys).tobytes())
+        positions = array.array("h", [table[key] for key in keys]).tobytes()
+        parts.append(positions + b"\0" * (-len(positions) % 8))
+    return b"".join(parts)
+
+# Lê as seções de um índice binário (bytes ou mmap) sem copiar os dados: cada
+# tabela é um par de memoryviews (chaves, posições) sobre o buffer
+def decode_rule_index(buffer, version):
+    view = memoryview(buffer)
+    if bytes(view[:8]) != RULES_INDEX_MAGIC:
+        raise ValueError("assinatura inválida")
+    little_endian, version_length = struct.unpack_from("<BI", view, 8)
+    if bool(little_endian) != (sys.byteorder == "little"):
+        raise ValueError("ordem de bytes diferente")
+    if bytes(view[13:13 + version_length]).decode() != version:
+        raise ValueError("versão diferente das regras")
+    offset = 13 + version_length
+    offset += -offset % 8
+    section_count, _ = struct.unpack_from("<II", view, offset)
+    offset += 8
+    sections = {}
+    for _ in range(section_count):
+        depth, count = struct.unpack_from("<II", view, offset)
+        offset += 8
+        keys = view[offset:offset + count * 8].cast("Q")
+        offset += count * 8
+        positions = view[offset:offset + count * 2].cast("h")
+        offset += count * 2 + (-(count * 2) % 8)
+        sections[depth] = (keys, positions)
+    return sections
 
-    # Item 1: Biofertilizantes (3101.00.00)
-    if code_normalized == "31010000":
-        return "Biofertilizantes, em conformidade com as definições e demais requisitos da legislação específica"
-
-    # Item 4: Inoculantes (3002.49, 3002.90.00, 3821.00.00)
-    if code_normalized in ["300249", "30029000", "38210000"]:
-        return "Inoculantes, meios de cultura e outros microorganismos para uso agrícola; em conformidade com as definições e demais requisitos da legislação específica"
-
-    # Item 5: Bioestimulantes e bioinsumos (38.24, 3807.00.00, 12.11, 38.08)
-    if re.match(r"^3824\d{4}$", code_normalized) and code_normalized not in ["38249977", "38249979", "38249989"] or code_normalized == "38070000" or re.match(r"^1211\d{4}$", code_normalized) or re.match(r"^3808\d{4}$", code_normalized):
-        return "Bioestimulantes e bioinsumos para controle fitossanitário, em conformidade com as definições e demais requisitos da legislação específica"
-
-    # Item 6: Defensivos agrícolas (38.08, 3824.99.89)
-    if re.match(r"^3808\d{4}$", code_normalized) or code_normalized == "38249989":
-        return "Inseticidas, fungicidas, formicidas, herbicidas, parasiticidas, germicidas, acaricidas, nematicidas, raticidas, desfolhantes, dessecantes, espalhantes adesivos, estimuladores e inibidores de crescimento (reguladores); todos destinados diretamente ao uso agropecuário ou destinados diretamente à fabricação de defensivo agropecuário; em conformidade com as definições e demais requisitos da legislação específica"
-
-    # Item 7: Matérias-primas para insumos (vários NCMs)
-    if code_normalized in ["0506", "12011000", "12130000", "13019090", "1302199", "14019000", "14049090", "21022000", "2302", "2303", "230400", "23050000", "2306", "23080000", "27030000", "28399010", "28399050", "29224", "293040", "3301", "38029040", "380400", "38249971", "44013900", "44014", "44029000", "47010000", "53050090", "68062000"]:
-        return "Calcário, casca de coco triturada, turfa; tortas, bagaços e demais resíduos e desperdícios vegetais das indústrias alimentares; cascas, serragens e demais resíduos e desperdícios de madeira; resíduos da indústria de celulose (dregs e grits), ossos, borra de carnaúba, cinzas, resíduos agroindustriais orgânicos, DL-Metionina e seus análogos, vermiculita e argilas expandidas, palhas e cascas de produtos vegetais, fibra de coco e outras fibras vegetais, silicatos de potássio ou de magnésio, resinas e oleorresinas naturais, sucos e extratos vegetais, aminoácidos e microrganismos mortos, óleos essenciais, argilas e terras, carvão vegetal e pastas mecânicas de madeira; todos destinados diretamente à fabricação de biofertilizantes, fertilizantes, corretivos de solo (inclusive condicionadores), remineralizadores, substratos para plantas, bioestimulantes ou biodefensivos para controle fitossanitário ou utilizados diretamente como biofertilizantes, fertilizantes, corretivos de solo (inclusive condicionadores), remineralizadores, substratos para plantas, bioestimulantes ou biodefensivos para controle fitossanitário; em conformidade com as definições e demais requisitos da legislação específica"
-
-    # Item 8: Ácidos para fertilizantes (vários NCMs)
-    if code_normalized in ["25030010", "25030090", "25101010", "25101090", "25102010", "25102090", "28020000", "28061020", "28070010", "28080010", "28092011", "28092019", "28111920", "28151100", "28151200", "28362010", "28362090", "29152100"]:
-        return "Ácido nítrico, ácido sulfúrico, ácido fosfórico, fosfatos de cálcio naturais, enxofre, ácido clorídrico, ácido fosforoso, ácido acético, hidróxido de sódio e carbonato dissódico; todos destinados diretamente à fabricação de fertilizantes"
-
-    # Item 9: Enzimas (3507.90.4X)
-    if re.match(r"^3507904\d$", code_normalized):
-        return "Enzimas preparadas para decomposição de matéria orgânica animal e vegetal"
-
-    # Item 11: Mudas (06.01, 06.02)
-    if re.match(r"^060[12]\d{4}$", code_normalized):
-        return "Mudas de plantas e demais materiais propagativos de plantas e fungos, inclusive plantas e fungos nativos de espécies florestais; em conformidade com as definições e demais requisitos da legislação específica"
-
-    # Item 12: Vacinas veterinárias (3002.12, 3002.15, 3002.42, 3002.90.00, 30.04)
-    if code_normalized in ["300212", "300215", "300242", "30029000"] or re.match(r"^3004\d{4}$", code_normalized):
-        return "Vacinas, soros e medicamentos, de uso veterinário, exceto de animais domésticos"
-
-    # Item 13: Aves de um dia (0105.1)
-    if re.match(r"^01051\d{3}$", code_normalized):
-        return "Aves de um dia, exceto as ornamentais"
-
-    # Item 14: Embriões e sêmen (0511.10.00, 0511.9)
-    if code_normalized == "05111000" or re.match(r"^05119\d{3}$", code_normalized):
-        return "Embriões e sêmen, congelado ou resfriado"
+# Cria (ou valida) o diretório dos índices: precisa ser um diretório real, do
+# próprio usuário e sem acesso para outros, já que os arquivos dele são mapeados
+# e usados na classificação
+def ensure_private_directory(path):
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    stat = os.lstat(path)
+    if not os.path.isdir(path) or os.path.islink(path):
+        raise OSError(f"{path} não é um diretório")
+    if hasattr(os, "getuid") and (stat.st_uid != os.getuid() or stat.st_mode & 0o077):
+        raise OSError(f"{path} deve pertencer ao usuário do processo e ter permissão 0700")
 
-    # Item 15: Reprodutores (01.02, 01.03, 01.04)
-    if re.match(r"^010[234]\d{4}$", code_normalized):
-        return "Reprodutores de raça pura, inclusive matrizes de animais puros de origem com registro genealógico; em conformidade com as definições e demais requisitos da legislação específica"
+# Mapeia em memória (somente leitura) um arquivo de índice existente, ou None
+def map_rule_index(index_path):
+    try:
+        with open(index_path, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+# Remove os índices de outras versões das regras. Processos que ainda usam uma
+# versão antiga continuam com o mapeamento válido após a remoção do arquivo; onde
+# um arquivo mapeado não pode ser removido, ele fica para a próxima troca
+def remove_stale_rule_indexes(index_path):
+    try:
+        entries = list(os.scandir(RULES_INDEX_DIR))
+    except OSError:
+        return
+    for entry in entries:
+        if entry.name.endswith(".idx") and entry.path != index_path:
+            try:
+                os.remove(entry.path)
+                logger.info(f"Índice das regras antigo removido: {entry.path}")
+            except OSError as e:
+                logger.warning(f"Não foi possível remover o índice das regras antigo {entry.path}: {str(e)}")
+
+# Abre (mapeando em memória, somente leitura) o índice binário da versão das
+# regras. Os workers da máquina mapeiam o mesmo arquivo e compartilham uma única
+# cópia física. O índice é sempre compilado a partir das regras (alguns
+# milissegundos) e o arquivo só é reaproveitado se tiver exatamente o mesmo
+# conteúdo; qualquer diferença (arquivo antigo, truncado ou adulterado) faz com
+# que seja regravado. Os índices de outras versões são removidos. Sem diretório
+# gravável, o índice fica só na memória do processo
+def open_rule_index(rules, version):
+    content = encode_rule_index(version, *build_rule_tables(rules))
+    index_path = os.path.join(RULES_INDEX_DIR, re.sub(r"[^\w.-]", "_", version) + ".idx")
+    try:
+        ensure_private_directory(RULES_INDEX_DIR)
+        buffer = map_rule_index(index_path)
+        if buffer is None or buffer[:] != content:
+            if buffer is not None:
+                logger.warning(f"Índice das regras em {index_path} não corresponde às regras; gravando novamente")
+                buffer.close()
+            partial_path = f"{index_path}.tmp-{uuid.uuid4().hex}"
+            with open(partial_path, "wb") as f:
+                f.write(content)
+            os.replace(partial_path, index_path)
+            buffer = map_rule_index(index_path)
+            logger.info(f"Índice das regras {version} gravado em {index_path}")
+        if buffer is None or buffer[:] != content:
+            raise OSError("o arquivo gravado não pôde ser mapeado")
+    except OSError as e:
+        logger.warning(f"Não foi possível usar o índice das regras em {index_path}: {str(e)}. Usando índice em memória")
+        return decode_rule_index(content, version)
+    remove_stale_rule_indexes(index_path)
+    return decode_rule_index(buffer, version)
+
+# Posição na tabela ordenada (chaves, posições) da chave procurada, ou None
+def search_rule_table(table, key):
+    keys, positions = table
+    i = bisect.bisect_left(keys, key)
+    if i < len(keys) and keys[i] == key:
+        return positions[i]
+    return None
 
-    # Item 16: Ovos fertilizados (0407.1)
-    if re.match(r"^04071\d{3}$", code_normalized):
-        return "Ovos fertilizados"
+# Índice compilado das regras, consultado por busca binária nas tabelas
+# ordenadas do índice binário (mapeado em memória). As regras em si (descrição e
+# item) continuam vindo do rules.json
+class RuleIndex:
+    def __init__(self, rules, version=None):
+        self.rules = rules
+        self.version = version
+        self.descriptions = [rule["description"] for rule in rules]
+        self.item_codes = [rule["item"] for rule in rules]
 
-    # Item 17: Girinos e alevinos (0106.90.00)
-    if code_normalized == "01069000":
-        return "Girinos e alevinos"
+        if version is None:
+            self.sections = decode_rule_index(encode_rule_index("", *build_rule_tables(rules)), "")
+        else:
+            self.sections = open_rule_index(rules, version)
+        self.exact_table = self.sections.pop(0)
+        self.prefix_depths = sorted(self.sections)
+
+    # Rótulos distintos usados como categorias das colunas de saída e, para cada
+    # regra, o id do seu rótulo. A última posição de rule_item_ids corresponde a
+    # "sem regra" (posição -1), para indexar direto com as posições das regras.
+    # Calculados no primeiro uso, pois dependem do numpy
+    @cached_property
+    def description_labels(self):
+        return list(dict.fromkeys(self.descriptions))
+
+    @cached_property
+    def rule_description_ids(self):
+        return np.array([self.description_labels.index(description) for description in self.descriptions], dtype=np.int32)
+
+    @cached_property
+    def item_labels(self):
+        return list(dict.fromkeys(self.item_codes)) + ["N/A"]
 
-    # Item 18: Rações (2309.90)
-    if re.match(r"^230990\d{2}$", code_normalized):
-        return "Rações para animais, concentrados, suplementos, aditivos, premix ou núcleo, exceto para animais domésticos"
+    @cached_property
+    def rule_item_ids(self):
+        return np.array([self.item_labels.index(item) for item in self.item_codes] + [len(self.item_labels) - 1], dtype=np.int16)
 
-    # Item 20: Farelos para ração (23.01 a 23.06, 2308.00.00)
-    if re.match(r"^230[1-6]\d{4}$", code_normalized) or code_normalized == "23080000":
-        return "Farelos e tortas de produtos vegetais e demais resíduos e desperdícios das indústrias alimentares; todos destinados diretamente à fabricação de ração para animais ou diretamente à alimentação animal, exceto de animais domésticos"
+    # Índice reverso, montado a partir das tabelas do índice no primeiro uso: os
+    # códigos exatos e os prefixos (vale o mais longo) com a posição da regra, e,
+    # por item, os códigos e prefixos das regras como escritos e os que de fato
+    # resultam no item depois da precedência ("covered_*")
+    @cached_property
+    def reverse_index(self):
+        keys, positions = self.exact_table
+        codes = {str(key // 100).zfill(key % 100): position for key, position in zip(keys, positions)}
+        prefixes = {}
+        for depth in self.prefix_depths:
+            keys, positions = self.sections[depth]
+            prefixes.update((str(key).zfill(depth), position) for key, position in zip(keys, positions))
 
-    # Item 21: Matérias-primas para ração (vários NCMs)
-    if code_normalized in ["0210", "0309", "07129010", "250100", "25210000", "293040"] or re.match(r"^15\d{6}$", code_normalized):
-        return "Alho em pó, sal mineralizado, farinhas de peixe, de ostra, de carne, de osso, de pena, de sangue e de víscera, calcário calcítico, gorduras e óleos animais, resíduos de óleo e de gordura de origem animal ou vegetal descartados por empresas do ramo alimentício, e DL-Metionina e seus análogos; todos destinados diretamente à fabricação de ração para animais ou diretamente à alimentação animal, exceto de animais domésticos"
+        items = {}
+        for position, rule in enumerate(self.rules):
+            entry = items.setdefault(rule["item"], {
+                "item": rule["item"], "rules": [], "descriptions": [],
+                **{field: [] for field in RULE_CODE_FIELDS}, "covered_codes": [], "covered_prefixes": [],
+            })
+            entry["rules"].append(position + 1)
+            if rule["description"] not in entry["descriptions"]:
+                entry["descriptions"].append(rule["description"])
+            for field in RULE_CODE_FIELDS:
+                entry[field].extend(rule.get(field, ()))
+        for code, position in sorted(codes.items()):
+            if position >= 0:
+                items[self.item_codes[position]]["covered_codes"].append(code)
+        for prefix, position in sorted(prefixes.items()):
+            if position >= 0:
+                items[self.item_codes[position]]["covered_prefixes"].append(prefix)
+        return {"codes": codes, "prefixes": prefixes, "items": items}
 
-    # Item 35: Vinhaça (2303.30.00, 2303.20.00)
-    if code_normalized in ["23033000", "23032000"]:
-        return "Vinhaça"
+    # Posição da regra aplicável ao código normalizado (-1 sem regra)
+    def lookup_position(self, code_normalized):
+        if not (code_normalized.isascii() and code_normalized.isdigit()) or len(code_normalized) > RULE_CODE_MAX_DIGITS:
+            return -1
+        position = search_rule_table(self.exact_table, code_key(code_normalized))
+        if position is not None:
+            return position
+        if len(code_normalized) != NCM_LENGTH:
+            return -1
+        # Todo prefixo das regras tem os ancestrais na tabela: desce pelas
+        # profundidades até o primeiro que falta, ficando com o último encontrado
+        value = int(code_normalized)
+        found = -1
+        for depth in self.prefix_depths:
+            position = search_rule_table(self.sections[depth], value // 10 ** (NCM_LENGTH - depth))
+            if position is None:
+                break
+            found = position
+        return found
 
-    # Item 2: Fertilizantes (Capítulo 31, exceto 3101.00.00 já tratado no Item 1)
-    if re.match(r"^31\d{6}$", code_normalized) and code_normalized != "31010000" or code_normalized in ["38249977", "38249979", "38249989"]:
-        return "Fertilizantes (adubos), em conformidade com as definições e demais requisitos da legislação específica"
+    # Retorna a regra aplicável ao código normalizado, ou None
+    def lookup(self, code_normalized):
+        position = self.lookup_position(code_normalized)
+        return self.rules[position] if position >= 0 else None
 
-    # Item 3: Corretivos de solo (Capítulo 25, exceto NCMs do Item 8 e Item 21)
-    if (re.match(r"^25\d{6}$", code_normalized) and
-        code_normalized not in ["25030010", "25030090", "25101010", "25101090", "25102010", "25102090", "250100", "25210000"]):
-        return "Corretivos de solo (inclusive condicionadores), remineralizadores e substratos para plantas; em conformidade com as definições e demais requisitos da legislação específica"
+    # Versão vetorizada de lookup: recebe uma Series de códigos normalizados e
+    # devolve a posição da regra em self.rules para cada linha (-1 sem regra)
+    def lookup_positions(self, normalized):
+        is_number = normalized.str.fullmatch(f"[0-9]{{1,{RULE_CODE_MAX_DIGITS}}}").to_numpy(dtype=bool)
+        lengths = normalized.str.len().to_numpy()
+        numbers = pd.to_numeric(normalized.where(is_number, "0")).to_numpy(dtype=np.uint64)
+        return self.lookup_numbers(numbers, lengths, is_number)
 
-    # Item 10: Sementes (Capítulos 7, 10, 12, exceto NCMs do Item 5, Item 7 e Item 21)
-    if (re.match(r"^(07|10|12)\d{6}$", code_normalized) and
-        code_normalized not in ["07129010", "12011000", "12130000"] and
-        not re.match(r"^1211\d{4}$", code_normalized)):
-        return "Semente genética, semente básica, semente nativa in natura, semente certificada de primeira geração (C1), semente certificada de segunda geração (C2), semente não certificada de primeira geração (S1), semente não certificada de segunda geração (S2) e sementes de cultivar local, tradicional ou crioula; em conformidade com as definições e demais requisitos da legislação específica"
+    # Posições para códigos já convertidos em números, com o número de dígitos de
+    # cada um (mask marca os válidos). As tabelas do índice são lidas como arrays
+    # numpy sem cópia (np.frombuffer)
+    def lookup_numbers(self, numbers, lengths, mask=None):
+        mask = np.ones(len(numbers), dtype=bool) if mask is None else mask
+        positions = np.full(len(numbers), -1, dtype=np.int64)
 
-    # Item 19: Sementes/cereais para ração (Capítulos 10, 11, 12, exceto NCMs do Item 5, Item 7, Item 10 e Item 21)
-    if (re.match(r"^(10|11|12)\d{6}$", code_normalized) and
-        code_normalized not in ["07129010", "12011000", "12130000"] and
-        not re.match(r"^1211\d{4}$", code_normalized)):
-        if re.match(r"^11\d{6}$", code_normalized):
-            return "Sementes e cereais, mesmo triturados, em grãos esmagados ou trabalhados de outro modo; todos destinados diretamente à fabricação de ração para animais ou diretamente à alimentação animal, exceto de animais domésticos"
+        found = self._search_positions(self.exact_table, numbers * np.uint64(100) + lengths.astype(np.uint64), mask, positions)
+        pending = mask & ~found & (lengths == NCM_LENGTH)
+        for depth in self.prefix_depths:
+            if not pending.any():
+                break
+            prefixes = numbers // np.uint64(10 ** (NCM_LENGTH - depth))
+            pending = self._search_positions(self.sections[depth], prefixes, pending, positions)
+        return positions
 
-    # Item 22: Serviços agronômicos (1.1410.90.00)
-    if code_normalized == "114109000":
-        return "Serviços agronômicos"
+    # Preenche positions onde a chave (entre as linhas em mask) está na tabela;
+    # devolve a máscara das linhas encontradas. Nos prefixos, cada profundidade
+    # sobrescreve a anterior e só as linhas encontradas descem para a seguinte
+    @staticmethod
+    def _search_positions(table, keys, mask, positions):
+        table_keys = np.frombuffer(table[0], dtype=np.uint64)
+        table_positions = np.frombuffer(table[1], dtype=np.int16)
+        if len(table_keys) == 0:
+            return np.zeros(len(keys), dtype=bool)
+        index = np.minimum(np.searchsorted(table_keys, keys), len(table_keys) - 1)
+        found = mask & (table_keys[index] == keys)
+        positions[found] = table_positions[index[found]]
+        return found
 
-    # Item 23: Serviços de técnico agrícola, agropecuário ou em agroecologia (1.1410.90.00)
-    if code_normalized == "114109000":
-        return "Serviços de técnico agrícola, agropecuário ou em agroecologia"
-
-    # Item 24: Serviços veterinários para produção animal (1.1405.21.00, 1.1405.22.00, 1.1405.90.00)
-    if code_normalized in ["114052100", "114052200", "114059000"]:
-        return "Serviços veterinários para produção animal"
-
-    # Item 25: Serviços de zootecnistas (1.1410.90.00)
-    if code_normalized == "114109000":
-        return "Serviços de zootecnistas"
-
-    # Item 26: Serviços de inseminação e fertilização de animais de criação (1.1405.22.00)
-    if code_normalized == "114052200":
-        return "Serviços de inseminação e fertilização de animais de criação"
-
-    # Item 27: Serviços de engenharia florestal (1.1403.10.00)
-    if code_normalized == "114031000":
-        return "Serviços de engenharia florestal"
-
-    # Item 28: Serviços de pulverização e controle de pragas (1.1901.10.00)
-    if code_normalized == "119011000":
-        return "Serviços de pulverização e controle de pragas"
-
-    # Item 29: Serviços de semeadura, adubação, reparação de solo, plantio e colheita (1.1901.10.00)
-    if code_normalized == "119011000":
-        return "Serviços de semeadura, adubação, inclusive mistura de adubos, reparação de solo, plantio e colheita"
-
-    # Item 30: Serviços de projetos para irrigação e fertirrigação (1.1403.29.00)
-    if code_normalized == "114032900":
-        return "Serviços de projetos para irrigação e fertirrigação"
-
-    # Item 31: Serviços de análise laboratorial (1.1404.41.00)
-    if code_normalized == "114044100":
-        return "Serviços de análise laboratorial de solos, sementes e outros materiais propagativos, fitossanitários, água de produção, bromatologia e sanidade animal"
-
-    # Item 32: Licenciamento de direitos sobre cultivares (1.1105.10.00)
-    if code_normalized == "111051000":
-        return "Licenciamento de direitos sobre cultivares"
-
-    # Item 33: Cessão definitiva de direitos sobre cultivares (1.1109.10.00)
-    if code_normalized == "111091000":
-        return "Cessão definitiva de direitos sobre cultivares"
+# Compila o arquivo de regras em um índice pronto para consulta
+def compile_rules(path=RULES_PATH):
+    version, rules = load_rules(path)
+    return RuleIndex(rules, version)
 
+# Índice em uso. Pode ser trocado em tempo de execução (swap_rule_index); quem
+# classifica várias linhas lê a referência uma vez e usa o mesmo índice até o fim
+rule_index = compile_rules()
+
+# Mensagem padrão para códigos sem regra correspondente
+def not_found_description(code, code_normalized):
     return f"Código {code} (normalizado: {code_normalized}) não encontrado na tabela fornecida."
 
+# Tamanho do cache LRU de resultados por código (configurável por ambiente)
+CODE_CACHE_SIZE = int(os.environ.get("NCM_CACHE_SIZE", "65536"))
+
+# Resolve descrição, código do item e enquadramento em uma única consulta
+@lru_cache(maxsize=CODE_CACHE_SIZE)
+def resolve_code(code):
+    code_normalized = normalize_code(code)
+    rule = rule_index.lookup(code_normalized)
+    if rule is None:
+        return not_found_description(code, code_normalized), "N/A", False
+    return rule["description"], rule["item"], True
+
+# Posições das regras para um array de códigos distintos (ainda não normalizados).
+# É a unidade de trabalho enviada aos processos na classificação paralela
+def lookup_unique_codes(unique_codes, compiled_rules=None):
+    compiled_rules = compiled_rules or rule_index
+    normalized = pd.Series(unique_codes, dtype=str).str.replace(".", "", regex=False)
+    return compiled_rules.lookup_positions(normalized).astype(np.int32)
+
+# Monta as quatro colunas de saída a partir das posições dos códigos distintos
+# e do índice de cada linha em unique_raw (resultado de pd.factorize). Cada linha
+# guarda apenas ids inteiros: descrição, item e status são Categoricals cujos
+# rótulos vêm da tabela de regras e só viram texto na exportação. Códigos não
+# encontrados ganham uma categoria de descrição própria (uma por código distinto)
+def expand_classification(index, row_codes, unique_raw, unique_positions, compiled_rules=None):
+    compiled_rules = compiled_rules or rule_index
+    unique_matched = unique_positions >= 0
+
+    description_labels = compiled_rules.description_labels
+    unique_description_ids = compiled_rules.rule_description_ids[np.where(unique_matched, unique_positions, 0)]
+    if not unique_matched.all():
+        missing = ~unique_matched
+        missing_raw = pd.Series(unique_raw, dtype=str)[missing]
+        description_labels = description_labels + (
+            "Código " + missing_raw + " (normalizado: "
+            + missing_raw.str.replace(".", "", regex=False) + ") não encontrado na tabela fornecida."
+        ).tolist()
+        unique_description_ids[missing] = np.arange(len(compiled_rules.description_labels), len(description_labels))
+
+    positions = unique_positions[row_codes]
+    matched = positions >= 0
+    return pd.DataFrame({
+        'Classificação NCM': pd.Categorical.from_codes(unique_description_ids[row_codes], categories=description_labels),
+        'Código do item (índice)': pd.Categorical.from_codes(compiled_rules.rule_item_ids[positions], categories=compiled_rules.item_labels),
+        'Classificação (enquadra ou não)': pd.Categorical.from_codes(matched.astype(np.int8), categories=["Não enquadrado", "Enquadrado"]),
+        'Enquadrado': matched,
+    }, index=index)
+
+# Classificação vetorizada de uma coluna inteira de códigos; devolve as
+# quatro colunas de saída de /classify-excel sem chamadas Python por linha
+def classify_series(codes):
+    raw = codes.astype(str).fillna("nan")
+
+    # Cada código distinto é classificado uma única vez e mapeado de volta às linhas
+    compiled_rules = rule_index
+    row_codes, unique_raw = pd.factorize(raw)
+    unique_positions = lookup_unique_codes(np.asarray(unique_raw, dtype=str), compiled_rules)
+    return expand_classification(codes.index, row_codes, unique_raw, unique_positions, compiled_rules)
+
+# Marca, em known_positions, as linhas cuja regra ainda precisa ser consultada
+UNKNOWN_POSITION = -2
+
+# Fatoriza os códigos e obtém a posição da regra de cada código distinto. Com
+# known_positions (posição por linha, UNKNOWN_POSITION quando desconhecida), só
+# são consultados os códigos que não aparecem em nenhuma linha já conhecida. Com
+# um executor (usado pelo benchmark de escalabilidade), a consulta é dividida em
+# blocos e feita em vários processos, que recebem apenas arrays numpy compactos de
+# códigos (não DataFrames) e devolvem arrays de posições, na ordem original.
+# O servidor classifica no próprio processo: as planilhas já ocupam um processo
+# cada no pool de planilhas, e a consulta é uma fração pequena do tempo total
+def locate_codes(codes, known_positions=None, executor=None, chunks=None):
+    compiled_rules = rule_index
+    raw = codes.astype(str).fillna("nan")
+    row_codes, unique_raw = pd.factorize(raw)
+    unique_codes = np.asarray(unique_raw, dtype=str)
+
+    unique_positions = np.full(len(unique_codes), UNKNOWN_POSITION, dtype=np.int32)
+    if known_positions is not None:
+        known = known_positions != UNKNOWN_POSITION
+        unique_positions[row_codes[known]] = known_positions[known]
+    pending = np.flatnonzero(unique_positions == UNKNOWN_POSITION)
+    pending_codes = unique_codes[pending]
+
+    if executor is None:
+        unique_positions[pending] = lookup_unique_codes(pending_codes, compiled_rules)
+    elif len(pending_codes):
+        # Os processos usam o próprio índice, herdado na criação do executor
+        code_chunks = np.array_split(pending_codes, max(1, min(chunks or 1, len(pending_codes))))
+        unique_positions[pending] = np.concatenate(list(executor.map(lookup_unique_codes, code_chunks)))
+    return row_codes, unique_raw, unique_positions, compiled_rules
+
+# Igual a classify_series, mas com a consulta dos códigos distintos dividida
+# entre os processos do executor informado (ver locate_codes). Sem executor,
+# classifica no próprio processo
+def classify_series_parallel(codes, executor=None, chunks=None):
+    row_codes, unique_raw, unique_positions, compiled_rules = locate_codes(codes, executor=executor, chunks=chunks)
+    return expand_classification(codes.index, row_codes, unique_raw, unique_positions, compiled_rules)
+
+# Função para verificar a qual descrição o código (NCM ou NBS) pertence
+def classify_code(code):
+    return resolve_code(code)[0]
+
 # Função para verificar se uma descrição indica que o código foi encontrado
 def is_code_matched(description):
     return "não encontrado" not in description
 
 # Função para obter o código do item com base no NCM
 def get_item_code(ncm_code):
-    code_normalized = normalize_code(ncm_code)
-    
-    # Item 1: Biofertilizantes (3101.00.00)
-    if code_normalized == "31010000":
-        return "1"
-    
-    # Item 2: Fertilizantes (Capítulo 31, exceto 3101.00.00)
-    if re.match(r"^31\d{6}$", code_normalized) and code_normalized != "31010000" or code_normalized in ["38249977", "38249979", "38249989"]:
-        return "2"
-    
-    # Item 3: Corretivos de solo (Capítulo 25, com exceções)
-    if (re.match(r"^25\d{6}$", code_normalized) and 
-        code_normalized not in ["25030010", "25030090", "25101010", "25101090", "25102010", "25102090", "250100", "25210000"]):
-        return "3"
-    
-    # Item 4: Inoculantes (3002.49, 3002.90.00, 3821.00.00)
-    if code_normalized in ["300249", "30029000", "38210000"]:
-        return "4"
-    
-    # Item 5: Bioestimulantes e bioinsumos
-    if re.match(r"^3824\d{4}$", code_normalized) and code_normalized not in ["38249977", "38249979", "38249989"] or code_normalized == "38070000" or re.match(r"^1211\d{4}$", code_normalized) or re.match(r"^3808\d{4}$", code_normalized):
-        return "5"
-    
-    # Item 6: Defensivos agrícolas
-    if re.match(r"^3808\d{4}$", code_normalized) or code_normalized == "38249989":
-        return "6"
-    
-    # Item 7: Matérias-primas para insumos
-    if code_normalized in ["0506", "12011000", "12130000", "13019090", "1302199", "14019000", "14049090", "21022000", "2302", "2303", "230400", "23050000", "2306", "23080000", "27030000", "28399010", "28399050", "29224", "293040", "3301", "38029040", "380400", "38249971", "44013900", "44014", "44029000", "47010000", "53050090", "68062000"]:
-        return "7"
-    
-    # Item 8: Ácidos para fertilizantes
-    if code_normalized in ["25030010", "25030090", "25101010", "25101090", "25102010", "25102090", "28020000", "28061020", "28070010", "28080010", "28092011", "28092019", "28111920", "28151100", "28151200", "28362010", "28362090", "29152100"]:
-        return "8"
-    
-    # Item 9: Enzimas
-    if re.match(r"^3507904\d$", code_normalized):
-        return "9"
-    
-    # Item 10: Sementes
-    if (re.match(r"^(07|10|12)\d{6}$", code_normalized) and 
-        code_normalized not in ["07129010", "12011000", "12130000"] and 
-        not re.match(r"^1211\d{4}$", code_normalized)):
-        return "10"
-    
-    # Item 11: Mudas
-    if re.match(r"^060[12]\d{4}$", code_normalized):
-        return "11"
-    
-    # Item 12: Vacinas veterinárias
-    if code_normalized in ["300212", "300215", "300242", "30029000"] or re.match(r"^3004\d{4}$", code_normalized):
-        return "12"
-    
-    # Item 13: Aves de um dia
-    if re.match(r"^01051\d{3}$", code_normalized):
-        return "13"
-    
-    # Item 14: Embriões e sêmen
-    if code_normalized == "05111000" or re.match(r"^05119\d{3}$", code_normalized):
-        return "14"
-    
-    # Item 15: Reprodutores
-    if re.match(r"^010[234]\d{4}$", code_normalized):
-        return "15"
-    
-    # Item 16: Ovos fertilizados
-    if re.match(r"^04071\d{3}$", code_normalized):
-        return "16"
-    
-    # Item 17: Girinos e alevinos
-    if code_normalized == "01069000":
-        return "17"
-    
-    # Item 18: Rações
-    if re.match(r"^230990\d{2}$", code_normalized):
-        return "18"
-    
-    # Item 19: Sementes/cereais para ração
-    if (re.match(r"^(10|11|12)\d{6}$", code_normalized) and 
-        code_normalized not in ["07129010", "12011000", "12130000"] and 
-        not re.match(r"^1211\d{4}$", code_normalized) and
-        re.match(r"^11\d{6}$", code_normalized)):
-        return "19"
-    
-    # Item 20: Farelos para ração
-    if re.match(r"^230[1-6]\d{4}$", code_normalized) or code_normalized == "23080000":
-        return "20"
-    
-    # Item 21: Matérias-primas para ração
-    if code_normalized in ["0210", "0309", "07129010", "250100", "25210000", "293040"] or re.match(r"^15\d{6}$", code_normalized):
-        return "21"
-    
-    # Item 22: Serviços agronômicos
-    if code_normalized == "114109000":
-        return "22"
-    
-    # Item 23: Serviços de técnico agrícola
-    if code_normalized == "114109000":
-        return "23"
-    
-    # Item 24: Serviços veterinários
-    if code_normalized in ["114052100", "114052200", "114059000"]:
-        return "24"
-    
-    # Item 25: Serviços de zootecnistas
-    if code_normalized == "114109000":
-        return "25"
-    
-    # Item 26: Serviços de inseminação
-    if code_normalized == "114052200":
-        return "26"
-    
-    # Item 27: Serviços de engenharia florestal
-    if code_normalized == "114031000":
-        return "27"
-    
-    # Item 28: Serviços de pulverização
-    if code_normalized == "119011000":
-        return "28"
-    
-    # Item 29: Serviços de semeadura
-    if code_normalized == "119011000":
-        return "29"
-    
-    # Item 30: Serviços de projetos para irrigação
-    if code_normalized == "114032900":
-        return "30"
-    
-    # Item 31: Serviços de análise laboratorial
-    if code_normalized == "114044100":
-        return "31"
-    
-    # Item 32: Licenciamento de direitos sobre cultivares
-    if code_normalized == "111051000":
-        return "32"
-    
-    # Item 33: Cessão definitiva de direitos sobre cultivares
-    if code_normalized == "111091000":
-        return "33"
-    
-    # Item 35: Vinhaça
-    if code_normalized in ["23033000", "23032000"]:
-        return "35"
-    
-    return "N/A"
-
-# Rota para servir o frontend
-@app.get("/", response_class=HTMLResponse)
-async def serve_frontend():
+    return resolve_code(ncm_code)[1]
+
+# Arquivo do frontend servido em "/"
+FRONTEND_PATH = os.environ.get("NCM_FRONTEND_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "index.html"))
+
+# Cópia em memória do frontend, original e compactada com gzip, com o ETag do
+# conteúdo. Só é relida quando o arquivo muda no disco
+class FrontendCache:
+    def __init__(self, path):
+        self.path = path
+        self.stat = None
+
+    def get(self):
+        stat = os.stat(self.path)
+        if self.stat is None or stat.st_mtime_ns != self.stat.st_mtime_ns or stat.st_size != self.stat.st_size:
+            with open(self.path, "rb") as f:
+                content = f.read()
+            self.content = content
+            self.gzipped = gzip.compress(content, compresslevel=9)
+            self.etag = f'"{hashlib.sha256(content).hexdigest()[:16]}"'
+            self.stat = stat
+        return self
+
+frontend_cache = FrontendCache(FRONTEND_PATH)
+
+# Indica se o cliente aceita gzip pelo Accept-Encoding, respeitando os pesos:
+# "gzip;q=0" recusa explicitamente, e "*" vale para gzip quando ele não é citado
+def accepts_gzip(accept_encoding):
+    weights = {}
+    for part in accept_encoding.split(","):
+        coding, *params = [piece.strip() for piece in part.split(";")]
+        weight = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        if coding:
+            weights[coding.lower()] = weight
+    weight = weights.get("gzip", weights.get("x-gzip", weights.get("*", 0.0)))
+    return weight > 0
+
+# Rota para servir o frontend (revalidado pelo ETag a cada acesso; 304 quando não mudou)
+@spreadsheet_routes.get("/", response_class=HTMLResponse)
+async def serve_frontend(request: Request):
     try:
-        with open("index.html", "r", encoding="utf-8") as f:
-            return HTMLResponse(content=f.read())
+        frontend = frontend_cache.get()
     except FileNotFoundError:
         return HTMLResponse(content="<h1>Erro: index.html não encontrado</h1>", status_code=500)
 
+    headers = {
+        "ETag": frontend.etag,
+        "Last-Modified": formatdate(frontend.stat.st_mtime, usegmt=True),
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding",
+    }
+    response = Response(status_code=304, headers=headers)
+    if is_not_modified(request, response, frontend.stat):
+        return response
+    if accepts_gzip(request.headers.get("accept-encoding", "")):
+        return HTMLResponse(content=frontend.gzipped, headers={**headers, "Content-Encoding": "gzip"})
+    return HTMLResponse(content=frontend.content, headers=headers)
+
+# Resultado da classificação de um código, no formato devolvido pela API
+def classification_result(code):
+    description, item_code, is_matched = resolve_code(code)
+    return {
+        "code": code,
+        "description": description,
+        "item_code": item_code,
+        "classification": "Enquadrado" if is_matched else "Não enquadrado"
+    }
+
 # Rota para classificar códigos individuais
 @app.post("/classify")
 async def classify_codes(input: CodeInput):
-    results = []
-    for code in input.codes:
-        description = classify_code(code)
-        item_code = get_item_code(code)
-        is_matched = is_code_matched(description)
-        results.append({
-            "code": code,
-            "description": description,
-            "item_code": item_code,
-            "classification": "Enquadrado" if is_matched else "Não enquadrado"
-        })
-    return {"results": results}
+    ROWS_CLASSIFIED.inc(len(input.codes), source="classify")
+    return {"results": [classification_result(code) for code in input.codes]}
 
-# Rota para processar a planilha Excel
-@app.post("/classify-excel")
-async def classify_excel(file: UploadFile = File(...)):
-    try:
-        start_time = time.time()
-        
-        if not file.filename.endswith(('.xlsx', '.xls')):
-            raise HTTPException(status_code=400, detail="Apenas arquivos Excel (.xlsx ou .xls) são aceitos.")
-        
-        content = await file.read()
-        
-        # Log para debug
-        logger.info(f"Recebido arquivo: {file.filename}, tamanho: {len(content)} bytes")
-        
+# Quantidade de códigos classificados e enviados por vez em /classify/stream
+STREAM_BATCH_CODES = int(os.environ.get("NCM_STREAM_BATCH_CODES", "1000"))
+
+# Tamanho máximo de uma linha em /classify/stream; linhas maiores viram um registro
+# de erro e são descartadas até a próxima quebra de linha (memória constante)
+STREAM_MAX_LINE_BYTES = int(os.environ.get("NCM_STREAM_MAX_LINE_BYTES", "8192"))
+
+# StreamingResponse que não escuta `receive` enquanto envia. A versão padrão
+# (ASGI < 2.4) consome as mensagens do corpo da requisição à procura de
+# desconexões, e aqui o corpo ainda está sendo lido durante a resposta. Uma
+# desconexão aparece como OSError no `send` (ou ClientDisconnect na leitura do
+# corpo), como no caminho ASGI 2.4 do Starlette, e a tarefa de fundo roda ao final
+class DuplexStreamingResponse(StreamingResponse):
+    async def __call__(self, scope, receive, send):
         try:
-            # Tente ler o arquivo Excel com diferentes engines
-            try:
-                df = pd.read_excel(BytesIO(content), engine='openpyxl')
-                logger.info("Arquivo lido com sucesso usando engine 'openpyxl'")
-            except Exception as e:
-                logger.warning(f"Erro ao ler com openpyxl: {str(e)}. Tentando com xlrd...")
-                df = pd.read_excel(BytesIO(content), engine='xlrd')
-                logger.info("Arquivo lido com sucesso usando engine 'xlrd'")
-        except Exception as e:
-            logger.error(f"Falha ao ler o arquivo Excel: {str(e)}")
-            raise HTTPException(status_code=400, detail=f"Não foi possível ler o arquivo Excel: {str(e)}")
-        
-        # Log das colunas encontradas
-        logger.info(f"Colunas no arquivo: {df.columns.tolist()}")
-        
-        # Verificar coluna NCM
-        if "NCM" not in df.columns:
-            # Tentar encontrar uma coluna que possa conter NCMs
-            potential_columns = [col for col in df.columns if col.upper() in ["NCM", "CODIGO", "CÓDIGO", "COD", "CÓD"]]
-            
-            if potential_columns:
-                # Usar a primeira coluna potencial encontrada
-                df = df.rename(columns={potential_columns[0]: "NCM"})
-                logger.info(f"Coluna renomeada: {potential_columns[0]} -> NCM")
-            else:
-                # Verificar se a primeira coluna contém dados que parecem NCMs
-                first_col = df.columns[0]
-                sample_values = df[first_col].iloc[:5].astype(str)
-                
-                # Verificar se os valores da primeira coluna parecem NCMs
-                if all(re.match(r'^\d+(\.\d+)*$', val) for val in sample_values if val != 'nan'):
-                    df = df.rename(columns={first_col: "NCM"})
-                    logger.info(f"Primeira coluna renomeada para NCM: {first_col}")
-                else:
-                    logger.error("Coluna NCM não encontrada e não foi possível identificar uma coluna adequada")
-                    raise HTTPException(status_code=400, detail="A planilha deve conter uma coluna chamada 'NCM' ou similar. Colunas encontradas: " + ", ".join(df.columns.tolist()))
-        
-        # Garantir que valores da coluna NCM sejam strings
-        df['NCM'] = df['NCM'].astype(str)
-        
-        # Verificar se há coluna de faturamento
-        has_revenue_data = False
-        revenue_column = None
-        
-        # Procurar por colunas de faturamento potenciais
-        potential_revenue_columns = [col for col in df.columns if any(term in col.upper() for term in ["FATUR", "RECEITA", "VALOR", "REVENUE", "VENDAS", "SALES"])]
-        
-        if potential_revenue_columns:
-            revenue_column = potential_revenue_columns[0]
-            has_revenue_data = True
-            logger.info(f"Coluna de faturamento encontrada: {revenue_column}")
-            
-            # Converter valores de faturamento para numérico
-            try:
-                df[revenue_column] = pd.to_numeric(df[revenue_column], errors='coerce')
-                # Substituir NaN por 0
-                df[revenue_column].fillna(0, inplace=True)
-            except Exception as e:
-                logger.warning(f"Erro ao converter coluna de faturamento para numérico: {str(e)}")
-                has_revenue_data = False
-        
-        # Criando uma coluna para "Descrição do Produto" se não existir
-        if "Descrição do Produto" not in df.columns:
-            # Verificar se existe alguma coluna que pareça conter descrições
-            desc_columns = [col for col in df.columns if any(s in col.upper() for s in ["DESCR", "PRODUTO", "ITEM", "MERCAD"])]
-            
-            if desc_columns:
-                # Usar a coluna existente
-                df = df.rename(columns={desc_columns[0]: "Descrição do Produto"})
-                logger.info(f"Coluna de descrição encontrada e renomeada: {desc_columns[0]} -> 'Descrição do Produto'")
+            await self.stream_response(send)
+        except OSError:
+            raise ClientDisconnect()
+        if self.background is not None:
+            await self.background()
+
+# Lê o corpo da requisição em partes e gera uma linha (em bytes) por vez; a
+# decodificação fica com quem consome, para que um byte inválido afete só a sua
+# linha. Cada parte é dividida uma única vez e só a linha em aberto fica guardada;
+# uma linha acima de max_line_bytes gera None (uma vez) e o resto dela é descartado
+async def iter_request_lines(request, max_line_bytes=STREAM_MAX_LINE_BYTES):
+    buffer = bytearray()
+    skipping = False
+    async for chunk in request.stream():
+        start = 0
+        while (end := chunk.find(b"\n", start)) >= 0:
+            if not skipping:
+                buffer += chunk[start:end]
+                yield bytes(buffer).strip() if len(buffer) <= max_line_bytes else None
+            buffer.clear()
+            skipping = False
+            start = end + 1
+        if not skipping:
+            buffer += chunk[start:]
+            if len(buffer) > max_line_bytes:
+                yield None
+                buffer.clear()
+                skipping = True
+    if buffer:
+        yield bytes(buffer).strip()
+
+# Extrai o código de uma linha NDJSON: uma string JSON ou {"code": "..."}
+def parse_ndjson_code(line):
+    value = orjson.loads(line)
+    if isinstance(value, dict):
+        value = value["code"]
+    return str(value)
+
+# Classifica os códigos recebidos em lotes e gera as linhas NDJSON de resposta
+async def stream_classification(request, is_ndjson):
+    batch = []
+    line_number = 0
+    async for line in iter_request_lines(request):
+        line_number += 1
+        if line is None:
+            batch.append({"line": line_number, "error": f"Linha inválida: excede {STREAM_MAX_LINE_BYTES} bytes."})
+            continue
+        if not line:
+            continue
+        # Linhas com JSON ou UTF-8 inválido viram um registro de erro (UnicodeDecodeError
+        # é um ValueError) sem interromper a resposta
+        try:
+            code = parse_ndjson_code(line) if is_ndjson else line.decode("utf-8")
+        except (ValueError, KeyError, TypeError) as e:
+            batch.append({"line": line_number, "error": f"Linha inválida: {str(e)}"})
+            continue
+        batch.append(classification_result(code))
+
+        if len(batch) >= STREAM_BATCH_CODES:
+            ROWS_CLASSIFIED.inc(len(batch), source="stream")
+            yield b"".join(orjson.dumps(result) + b"\n" for result in batch)
+            batch = []
+    if batch:
+        ROWS_CLASSIFIED.inc(len(batch), source="stream")
+        yield b"".join(orjson.dumps(result) + b"\n" for result in batch)
+
+# Rota para classificação em massa: recebe um código por linha (texto simples ou
+# NDJSON) e devolve NDJSON à medida que os lotes são classificados
+@app.post("/classify/stream")
+async def classify_codes_stream(request: Request):
+    is_ndjson = "json" in request.headers.get("content-type", "")
+    return DuplexStreamingResponse(stream_classification(request, is_ndjson), media_type="application/x-ndjson")
+
+# Rota com as estatísticas do cache de classificação (para ajustar NCM_CACHE_SIZE)
+@app.get("/cache-stats")
+async def cache_stats():
+    info = resolve_code.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        "hits": info.hits,
+        "misses": info.misses,
+        "hit_rate": round(info.hits / lookups, 4) if lookups > 0 else 0,
+        "size": info.currsize,
+        "max_size": info.maxsize,
+    }
+
+# Tamanho dos blocos usados ao gravar o upload em disco
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Quantidade de linhas classificadas por lote no modo streaming
+STREAMING_BATCH_ROWS = int(os.environ.get("NCM_STREAMING_BATCH_ROWS", "50000"))
+
+# Uploads .xlsx acima deste tamanho usam o modo streaming automaticamente
+STREAMING_THRESHOLD_BYTES = int(os.environ.get("NCM_STREAMING_THRESHOLD_BYTES", str(20 * 1024 * 1024)))
+
+# Grava o upload em um arquivo temporário, em blocos, sem carregá-lo inteiro na memória.
+# Calcula o SHA-256 do conteúdo na mesma passada (usado para reaproveitar resultados)
+async def spool_upload(file, suffix):
+    size = 0
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            tmp.write(chunk)
+            digest.update(chunk)
+            size += len(chunk)
+    UPLOAD_BYTES.inc(size)
+    return tmp.name, size, digest.hexdigest()
+
+# Lê a primeira planilha linha a linha (openpyxl read_only) e gera lotes de DataFrames.
+# Sem keep_columns, as primeiras linhas definem as colunas usadas e os lotes
+# são montados apenas com elas
+def iter_excel_batches(path, batch_rows=STREAMING_BATCH_ROWS, keep_columns=True, key_column=None):
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [f"Unnamed: {i}" if value is None else str(value) for i, value in enumerate(header)]
+
+        # Linhas totalmente vazias são ignoradas, como no pd.read_excel
+        rows = (row for row in rows if not all(value is None for value in row))
+        project = operator.itemgetter(slice(0, len(columns)))
+        if not keep_columns:
+            sample_rows = list(itertools.islice(rows, INPUT_SAMPLE_ROWS))
+            sample = pd.DataFrame([row[:len(columns)] for row in sample_rows], columns=columns, dtype=object)
+            positions, _ = select_input_columns(sample, keep_columns, key_column)
+            columns = [columns[i] for i in positions]
+            project = operator.itemgetter(*positions) if len(positions) > 1 else lambda row: (row[positions[0]],)
+            rows = itertools.chain(sample_rows, rows)
+
+        batch = []
+        for row in rows:
+            batch.append(project(row))
+            if len(batch) >= batch_rows:
+                yield pd.DataFrame(batch, columns=columns, dtype=object)
+                batch = []
+        if batch:
+            yield pd.DataFrame(batch, columns=columns, dtype=object)
+    finally:
+        workbook.close()
+
+# Identifica as colunas de NCM, faturamento e descrição a partir do cabeçalho e
+# das primeiras linhas; retorna o mapeamento de renomeação e a coluna de faturamento
+def detect_columns(df):
+    renames = {}
+
+    # Verificar coluna NCM
+    if "NCM" not in df.columns:
+        # Tentar encontrar uma coluna que possa conter NCMs
+        potential_columns = [col for col in df.columns if str(col).upper() in ["NCM", "CODIGO", "CÓDIGO", "COD", "CÓD"]]
+
+        if potential_columns:
+            # Usar a primeira coluna potencial encontrada
+            renames[potential_columns[0]] = "NCM"
+            logger.info(f"Coluna renomeada: {potential_columns[0]} -> NCM")
+        else:
+            # Verificar se a primeira coluna contém dados que parecem NCMs
+            first_col = df.columns[0]
+            sample_values = df[first_col].iloc[:5].astype(str)
+
+            # Verificar se os valores da primeira coluna parecem NCMs
+            if all(re.match(r'^\d+(\.\d+)*$', val) for val in sample_values if val != 'nan'):
+                renames[first_col] = "NCM"
+                logger.info(f"Primeira coluna renomeada para NCM: {first_col}")
             else:
-                # Criar uma coluna vazia para descrição do produto
-                df["Descrição do Produto"] = "Não informado"
-                logger.info("Coluna 'Descrição do Produto' criada com valor padrão")
-        
-        # Classificar os NCMs
-        df['Classificação NCM'] = df['NCM'].apply(classify_code)
-        df['Código do item (índice)'] = df['NCM'].apply(get_item_code)
-        df['Classificação (enquadra ou não)'] = df['Classificação NCM'].apply(lambda x: "Enquadrado" if is_code_matched(x) else "Não enquadrado")
-        df['Enquadrado'] = df['Classificação (enquadra ou não)'].apply(lambda x: True if x == "Enquadrado" else False)
-
-        # Calcular métricas básicas
-        total_ncms = len(df)
-        matched_ncms = df['Enquadrado'].sum()
-        percentage = round((matched_ncms / total_ncms) * 100, 2) if total_ncms > 0 else 0
-        
-        # Métricas financeiras (apenas se houver dados de faturamento)
-        financial_metrics = {}
-        if has_revenue_data:
-            # Total de faturamento
-            total_revenue = df[revenue_column].sum()
-            
-            # Faturamento dos NCMs enquadrados
-            matched_revenue = df[df['Enquadrado']][revenue_column].sum()
-            
-            # Percentual do faturamento enquadrado
-            revenue_percentage = round((matched_revenue / total_revenue) * 100, 2) if total_revenue > 0 else 0
-            
-            # Média de faturamento por NCM
-            avg_revenue_per_ncm = round(total_revenue / total_ncms, 2) if total_ncms > 0 else 0
-            
-            # Média de faturamento por NCM enquadrado
-            avg_revenue_per_matched_ncm = round(matched_revenue / matched_ncms, 2) if matched_ncms > 0 else 0
-            
-            # Top 5 NCMs por faturamento
-            top_ncms = df.nlargest(5, revenue_column)[['NCM', revenue_column, 'Enquadrado']].to_dict(orient='records')
-            
-            # Faturamento médio dos NCMs enquadrados vs não enquadrados
-            avg_revenue_matched = df[df['Enquadrado']][revenue_column].mean() if matched_ncms > 0 else 0
-            avg_revenue_not_matched = df[~df['Enquadrado']][revenue_column].mean() if (total_ncms - matched_ncms) > 0 else 0
-            
-            # Adicionar porcentagem do total para cada NCM no top 5
-            for ncm in top_ncms:
-                ncm['percentage_of_total'] = round((ncm[revenue_column] / total_revenue) * 100, 2)
-            
-            # Montar o dicionário de métricas financeiras
-            financial_metrics = {
-                "total_revenue": float(total_revenue),
-                "matched_revenue": float(matched_revenue),
-                "revenue_percentage": float(revenue_percentage),
-                "avg_revenue_per_ncm": float(avg_revenue_per_ncm),
-                "avg_revenue_per_matched_ncm": float(avg_revenue_per_matched_ncm),
-                "top_ncms": top_ncms,
-                "avg_revenue_matched": float(avg_revenue_matched),
-                "avg_revenue_not_matched": float(avg_revenue_not_matched),
-                "potential_tax_impact": float(matched_revenue * 0.08),  # 8% de economia fiscal estimada
-                "annual_savings": float(matched_revenue * 0.08)  # Mesma economia, mas para referência anual
-            }
-            
-            # Adicionar coluna de faturamento percentual para todos os NCMs
-            df['Percentual do Faturamento'] = df[revenue_column] / total_revenue * 100
-        
-        # Calcular tempo de processamento
-        processing_time = round(time.time() - start_time, 2)
-        logger.info(f"Processamento concluído em {processing_time} segundos. Total: {total_ncms}, Classificados: {matched_ncms}")
-        
-        # Reordenar colunas no formato solicitado
-        if has_revenue_data:
-            output_columns = [
-                'Código do item (índice)', 
-                'NCM', 
-                'Descrição do Produto', 
-                revenue_column, 
-                'Percentual do Faturamento',
-                'Classificação (enquadra ou não)', 
-                'Classificação NCM'
-            ]
+                logger.error("Coluna NCM não encontrada e não foi possível identificar uma coluna adequada")
+                raise SpreadsheetError(400, "A planilha deve conter uma coluna chamada 'NCM' ou similar. Colunas encontradas: " + ", ".join(map(str, df.columns)))
+
+    columns = [renames.get(col, col) for col in df.columns]
+
+    # Procurar por colunas de faturamento potenciais
+    revenue_column = None
+    potential_revenue_columns = [col for col in columns if any(term in str(col).upper() for term in ["FATUR", "RECEITA", "VALOR", "REVENUE", "VENDAS", "SALES"])]
+    if potential_revenue_columns:
+        revenue_column = potential_revenue_columns[0]
+        logger.info(f"Coluna de faturamento encontrada: {revenue_column}")
+
+    # Verificar se existe alguma coluna que pareça conter descrições
+    if "Descrição do Produto" not in columns:
+        desc_columns = [col for col in columns if any(s in str(col).upper() for s in ["DESCR", "PRODUTO", "ITEM", "MERCAD"])]
+        if desc_columns:
+            renames[desc_columns[0]] = "Descrição do Produto"
+            logger.info(f"Coluna de descrição encontrada e renomeada: {desc_columns[0]} -> 'Descrição do Produto'")
         else:
-            output_columns = [
-                'Código do item (índice)', 
-                'NCM', 
-                'Descrição do Produto', 
-                'Classificação (enquadra ou não)', 
-                'Classificação NCM'
-            ]
-        
-        # Verificar quais colunas existem antes de reorganizar
-        available_columns = [col for col in output_columns if col in df.columns]
-        other_columns = [col for col in df.columns if col not in output_columns and col != 'Enquadrado']
-        final_columns = available_columns + other_columns
-        
-        # Gerar arquivo de saída
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx") as tmp:
-            output_path = tmp.name
-            
-            # Criar um escritor do Excel com formatação
-            with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-                df_export = df[final_columns].copy()
-                
-                # Formatar valores percentuais
-                if has_revenue_data and 'Percentual do Faturamento' in df_export.columns:
-                    df_export['Percentual do Faturamento'] = df_export['Percentual do Faturamento'].round(2).astype(str) + '%'
-                
-                df_export.to_excel(writer, index=False, sheet_name='Classificação NCM')
-                
-                # Adicionar planilha de resumo
-                summary_data = {
-                    'Métrica': [
-                        'Total de NCMs', 
-                        'NCMs enquadrados na redução', 
-                        'Percentual de Cobertura',
-                        'Tempo de Processamento'
-                    ],
-                    'Valor': [
-                        total_ncms,
-                        matched_ncms,
-                        f"{percentage}%",
-                        f"{processing_time}s"
-                    ]
-                }
-                
-                if has_revenue_data:
-                    summary_data['Métrica'].extend([
-                        'Faturamento Total',
-                        'Faturamento Enquadrado',
-                        'Percentual do Faturamento Enquadrado',
-                        'Faturamento Médio por NCM',
-                        'Faturamento Médio por NCM Enquadrado',
-                        'Faturamento Médio por NCM Não Enquadrado',
-                        'Economia Fiscal Estimada (8%)'
-                    ])
-                    
-                    summary_data['Valor'].extend([
-                        f"R$ {total_revenue:,.2f}".replace(',', '_').replace('.', ',').replace('_', '.'),
-                        f"R$ {matched_revenue:,.2f}".replace(',', '_').replace('.', ',').replace('_', '.'),
-                        f"{revenue_percentage}%",
-                        f"R$ {avg_revenue_per_ncm:,.2f}".replace(',', '_').replace('.', ',').replace('_', '.'),
-                        f"R$ {avg_revenue_matched:,.2f}".replace(',', '_').replace('.', ',').replace('_', '.'),
-                        f"R$ {avg_revenue_not_matched:,.2f}".replace(',', '_').replace('.', ',').replace('_', '.'),
-                        f"R$ {matched_revenue * 0.08:,.2f}".replace(',', '_').replace('.', ',').replace('_', '.')
-                    ])
-                
-                # Criar DataFrame para o resumo
-                summary_df = pd.DataFrame(summary_data)
-                summary_df.to_excel(writer, index=False, sheet_name='Resumo')
-            
-            logger.info(f"Arquivo de saída criado: {output_path}")
-        
-        # Preparar métricas para resposta
+            logger.info("Coluna 'Descrição do Produto' será criada com valor padrão")
+
+    return renames, revenue_column
+
+# Normaliza as colunas de um lote (nomes, NCM como texto, faturamento numérico)
+def normalize_batch(df, renames, revenue_column):
+    df = df.rename(columns=renames)
+
+    # Garantir que valores da coluna NCM sejam strings
+    df['NCM'] = df['NCM'].astype(str).fillna('nan')
+
+    # Converter valores de faturamento para numérico, substituindo NaN por 0
+    if revenue_column is not None:
+        df[revenue_column] = pd.to_numeric(df[revenue_column], errors='coerce').fillna(0)
+
+    # Criando uma coluna para "Descrição do Produto" se não existir
+    if "Descrição do Produto" not in df.columns:
+        df["Descrição do Produto"] = "Não informado"
+    return df
+
+# Adiciona as colunas de classificação a um lote já normalizado (todas de uma
+# vez, de forma vetorizada).
+# Retorna também a posição da regra de cada linha (-1 sem regra)
+def classify_batch(df, known_positions=None):
+    row_codes, unique_raw, unique_positions, compiled_rules = locate_codes(df['NCM'], known_positions)
+    classified = expand_classification(df.index, row_codes, unique_raw, unique_positions, compiled_rules)
+    for column in classified.columns:
+        df[column] = classified[column]
+    return df, unique_positions[row_codes]
+
+# Normaliza as colunas de um lote e adiciona as colunas de classificação
+def prepare_batch(df, renames, revenue_column):
+    return classify_batch(normalize_batch(df, renames, revenue_column))[0]
+
+# Quantidade de NCMs nos rankings por faturamento (geral, por status e por item)
+TOP_NCMS = 5
+
+# Acumula as métricas da classificação lote a lote
+class MetricsAccumulator:
+    def __init__(self, revenue_column):
+        self.revenue_column = revenue_column
+        self.item_totals = None
+        self.top_ncms = None
+
+    # Acumulador que parte dos totais por item de um resultado anterior (modo
+    # incremental: as linhas novas são somadas e as removidas, subtraídas)
+    @classmethod
+    def from_metrics(cls, revenue_column, metrics):
+        accumulator = cls(revenue_column)
+        columns = ["count", "revenue"] if revenue_column is not None else ["count"]
+        breakdown = metrics.get("item_breakdown", [])
+        if breakdown:
+            accumulator.item_totals = pd.DataFrame(
+                [[item[column] for column in columns] for item in breakdown],
+                index=[item["item_code"] for item in breakdown], columns=columns, dtype=float,
+            )
+        return accumulator
+
+    def update(self, df):
+        self.add_item_totals(self.group_items(df))
+        self.update_top(df)
+
+    # Uma única agregação por código do item fornece contagens e faturamento;
+    # o enquadramento é derivado do item ("N/A" = não enquadrado)
+    def group_items(self, df):
+        aggregations = {"count": ('Enquadrado', 'size')}
+        if self.revenue_column is not None:
+            aggregations["revenue"] = (self.revenue_column, 'sum')
+        grouped = df.groupby('Código do item (índice)', observed=True, sort=False).agg(**aggregations)
+        grouped.index = grouped.index.astype(str)
+        return grouped
+
+    # Soma (ou, com sign=-1, subtrai) totais por item já agregados
+    def add_item_totals(self, grouped, sign=1):
+        if sign != 1:
+            grouped = grouped * sign
+        self.item_totals = grouped if self.item_totals is None else self.item_totals.add(grouped, fill_value=0)
+
+    # Top 5 NCMs por faturamento de cada código do item, mesclado com o top dos
+    # lotes anteriores. Como o enquadramento é derivado do item, o top geral e o
+    # top por status saem destes mesmos candidatos
+    def update_top(self, df):
+        if self.revenue_column is not None:
+            top = df[['NCM', self.revenue_column, 'Enquadrado', 'Código do item (índice)']]
+            if self.top_ncms is not None:
+                top = pd.concat([self.top_ncms, self._top_by_item(top)])
+            self.top_ncms = self._top_by_item(top)
+
+    def _top_by_item(self, df):
+        ordered = df.sort_values(self.revenue_column, ascending=False, kind="stable")
+        top = ordered.groupby('Código do item (índice)', observed=True, sort=False).head(TOP_NCMS)
+        return top.astype({'Código do item (índice)': str})
+
+    # Registros do top N (já ordenado) com a porcentagem do faturamento total
+    def _top_records(self, top, total_revenue):
+        records = top.head(TOP_NCMS)[['NCM', self.revenue_column, 'Enquadrado']].to_dict(orient='records')
+        for ncm in records:
+            ncm['percentage_of_total'] = round((ncm[self.revenue_column] / total_revenue) * 100, 2) if total_revenue > 0 else 0
+        return records
+
+    # Totais por código do item, ordenados pelo número do item ("N/A" por último)
+    def _item_totals(self):
+        if self.item_totals is None:
+            columns = ["count", "revenue"] if self.revenue_column is not None else ["count"]
+            return pd.DataFrame(columns=columns, dtype=float)
+        # Itens zerados pelas linhas removidas (modo incremental) deixam o detalhamento
+        item_totals = self.item_totals[self.item_totals["count"] > 0]
+        order = sorted(item_totals.index, key=lambda item: (item == "N/A", int(item) if item.isdigit() else 0))
+        return item_totals.loc[order]
+
+    def metrics(self):
+        items = self._item_totals()
+        matched_items = items[items.index != "N/A"]
+        total_ncms = int(items["count"].sum())
+        matched_ncms = int(matched_items["count"].sum())
+        not_matched_ncms = total_ncms - matched_ncms
+        percentage = round((matched_ncms / total_ncms) * 100, 2) if total_ncms > 0 else 0
+
         metrics = {
-            "total_ncms": int(total_ncms),
-            "matched_ncms": int(matched_ncms),
+            "total_ncms": total_ncms,
+            "matched_ncms": matched_ncms,
             "percentage": float(percentage),
-            "processing_time": float(processing_time),
-            "has_revenue_data": has_revenue_data
+            "has_revenue_data": self.revenue_column is not None
         }
-        
-        # Adicionar métricas financeiras se disponíveis
-        if has_revenue_data:
-            metrics.update(financial_metrics)
-        
-        # Preparar resposta simplificada para a interface
-        display_columns = ['NCM', 'Classificação NCM']
-        if has_revenue_data:
-            display_columns.append(revenue_column)
-        
-        display_results = df[display_columns].rename(columns={'Classificação NCM': 'Descrição'})
-        
-        # Preparar resposta com resultados e métricas
-        response_data = {
-            "results": display_results.to_dict(orient='records'), 
-            "output_file": os.path.basename(output_path),
-            "metrics": metrics,
-            "planilha_tipo": 2 if has_revenue_data else 1
+        if self.revenue_column is None:
+            metrics["item_breakdown"] = [
+                {"item_code": item, "count": int(row["count"])} for item, row in items.iterrows()
+            ]
+            return metrics
+
+        total_revenue = float(items["revenue"].sum())
+        matched_revenue = float(matched_items["revenue"].sum())
+
+        # Top 5 geral, por status de enquadramento e por item, a partir dos
+        # candidatos por item (ordenados por faturamento)
+        candidates = self.top_ncms
+        if candidates is None:
+            candidates = pd.DataFrame(columns=['NCM', self.revenue_column, 'Enquadrado', 'Código do item (índice)'])
+        candidates = candidates.sort_values(self.revenue_column, ascending=False, kind="stable")
+        candidate_items = candidates['Código do item (índice)']
+        top_ncms = self._top_records(candidates, total_revenue)
+        top_by_status = {
+            "enquadrado": self._top_records(candidates[candidate_items != "N/A"], total_revenue),
+            "nao_enquadrado": self._top_records(candidates[candidate_items == "N/A"], total_revenue),
         }
-        
-        logger.info("Enviando resposta com métricas: " + str(metrics))
+        top_by_item = {item: self._top_records(top, total_revenue) for item, top in candidates.groupby(candidate_items, sort=False)}
+
+        metrics.update({
+            "total_revenue": total_revenue,
+            "matched_revenue": matched_revenue,
+            "revenue_percentage": float(round((matched_revenue / total_revenue) * 100, 2) if total_revenue > 0 else 0),
+            "avg_revenue_per_ncm": float(round(total_revenue / total_ncms, 2) if total_ncms > 0 else 0),
+            "avg_revenue_per_matched_ncm": float(round(matched_revenue / matched_ncms, 2) if matched_ncms > 0 else 0),
+            "top_ncms": top_ncms,
+            "top_ncms_by_status": top_by_status,
+            "avg_revenue_matched": float(matched_revenue / matched_ncms if matched_ncms > 0 else 0),
+            "avg_revenue_not_matched": float((total_revenue - matched_revenue) / not_matched_ncms if not_matched_ncms > 0 else 0),
+            "potential_tax_impact": float(matched_revenue * 0.08),  # 8% de economia fiscal estimada
+            "annual_savings": float(matched_revenue * 0.08),  # Mesma economia, mas para referência anual
+            # Faturamento por código do item, obtido da mesma agregação
+            "item_breakdown": [
+                {
+                    "item_code": item,
+                    "count": int(row["count"]),
+                    "revenue": float(row["revenue"]),
+                    "avg_revenue": float(row["revenue"] / row["count"]) if row["count"] > 0 else 0.0,
+                    "revenue_percentage": round(float(row["revenue"]) / total_revenue * 100, 2) if total_revenue > 0 else 0,
+                    "top_ncms": top_by_item.get(item, []),
+                }
+                for item, row in items.iterrows()
+            ]
+        })
+        return metrics
+
+# Formata um valor monetário no padrão brasileiro (R$ 1.234,56)
+def format_brl(value):
+    return f"R$ {value:,.2f}".replace(',', '_').replace('.', ',').replace('_', '.')
+
+# Monta o DataFrame da aba "Resumo" a partir das métricas
+def build_summary(metrics):
+    summary_data = {
+        'Métrica': [
+            'Total de NCMs',
+            'NCMs enquadrados na redução',
+            'Percentual de Cobertura',
+            'Tempo de Processamento'
+        ],
+        'Valor': [
+            metrics["total_ncms"],
+            metrics["matched_ncms"],
+            f"{metrics['percentage']}%",
+            f"{metrics['processing_time']}s"
+        ]
+    }
+
+    if metrics["has_revenue_data"]:
+        summary_data['Métrica'].extend([
+            'Faturamento Total',
+            'Faturamento Enquadrado',
+            'Percentual do Faturamento Enquadrado',
+            'Faturamento Médio por NCM',
+            'Faturamento Médio por NCM Enquadrado',
+            'Faturamento Médio por NCM Não Enquadrado',
+            'Economia Fiscal Estimada (8%)'
+        ])
+
+        summary_data['Valor'].extend([
+            format_brl(metrics["total_revenue"]),
+            format_brl(metrics["matched_revenue"]),
+            f"{metrics['revenue_percentage']}%",
+            format_brl(metrics["avg_revenue_per_ncm"]),
+            format_brl(metrics["avg_revenue_matched"]),
+            format_brl(metrics["avg_revenue_not_matched"]),
+            format_brl(metrics["potential_tax_impact"])
+        ])
+
+        # Principais NCMs por faturamento em cada status de enquadramento
+        for status, label in (("enquadrado", "enquadrados"), ("nao_enquadrado", "não enquadrados")):
+            top = metrics.get("top_ncms_by_status", {}).get(status)
+            if top:
+                summary_data['Métrica'].append(f"Principais NCMs {label}")
+                summary_data['Valor'].append(", ".join(str(ncm["NCM"]) for ncm in top))
+
+    # Detalhamento por código do item
+    for item in metrics.get("item_breakdown", []):
+        label = "Não enquadrados" if item["item_code"] == "N/A" else f"Item {item['item_code']}"
+        summary_data['Métrica'].append(f"{label} - NCMs")
+        summary_data['Valor'].append(item["count"])
+        if metrics["has_revenue_data"]:
+            summary_data['Métrica'].append(f"{label} - Faturamento")
+            summary_data['Valor'].append(f"{format_brl(item['revenue'])} ({item['revenue_percentage']}%)")
+            if item.get("top_ncms"):
+                summary_data['Métrica'].append(f"{label} - Principais NCMs")
+                summary_data['Valor'].append(", ".join(str(ncm["NCM"]) for ncm in item["top_ncms"]))
+
+    # Detalhamento por arquivo e aba (lotes)
+    for source in metrics.get("sources", []):
+        label = f"{source['file']} - {source['sheet']}" if source["sheet"] else source["file"]
+        summary_data['Métrica'].append(f"{label} - NCMs enquadrados")
+        summary_data['Valor'].append(f"{source['matched_ncms']} de {source['total_ncms']} ({source['percentage']}%)")
+        if metrics["has_revenue_data"]:
+            summary_data['Métrica'].append(f"{label} - Faturamento enquadrado")
+            summary_data['Valor'].append(f"{format_brl(source['matched_revenue'])} de {format_brl(source['total_revenue'])}")
+    for source in metrics.get("ignored_sources", []):
+        label = f"{source['file']} - {source['sheet']}" if source["sheet"] else source["file"]
+        summary_data['Métrica'].append(f"{label} - Ignorado")
+        summary_data['Valor'].append(source["reason"])
+
+    # Comparação com o resultado anterior (modo incremental)
+    incremental = metrics.get("incremental")
+    if incremental is not None and not incremental["applied"]:
+        summary_data['Métrica'].append("Comparação - Resultado anterior")
+        summary_data['Valor'].append(f"{incremental['previous_result']} (não aplicada: {incremental['reason']})")
+    elif incremental is not None:
+        summary_data['Métrica'].extend([
+            "Comparação - Resultado anterior",
+            "Comparação - Linhas inalteradas",
+            "Comparação - Linhas novas",
+            "Comparação - Linhas alteradas",
+            "Comparação - Linhas removidas",
+            "Comparação - Variação de NCMs enquadrados",
+        ])
+        summary_data['Valor'].extend([
+            incremental["previous_result"],
+            incremental["unchanged_rows"],
+            incremental["added_rows"],
+            incremental["changed_rows"] if incremental["changed_rows"] is not None else "sem coluna-chave",
+            incremental["removed_rows"],
+            f"{incremental['matched_ncms_delta']:+d}",
+        ])
+        if metrics["has_revenue_data"]:
+            summary_data['Métrica'].append("Comparação - Variação do faturamento enquadrado")
+            summary_data['Valor'].append(format_brl(incremental["matched_revenue_delta"]))
+        for item in incremental["item_deltas"]:
+            label = "Não enquadrados" if item["item_code"] == "N/A" else f"Item {item['item_code']}"
+            summary_data['Métrica'].append(f"Comparação - {label} - NCMs")
+            summary_data['Valor'].append(f"{item['count']:+d}")
+            if metrics["has_revenue_data"]:
+                summary_data['Métrica'].append(f"Comparação - {label} - Faturamento")
+                summary_data['Valor'].append(format_brl(item["revenue"]))
+
+    # Tempo por etapa do processamento
+    for stage, seconds in metrics.get("stages", {}).items():
+        summary_data['Métrica'].append(f"Tempo - {stage}")
+        summary_data['Valor'].append(f"{seconds}s")
+
+    return pd.DataFrame(summary_data)
+
+# Ordena as colunas da planilha de saída no formato solicitado
+def output_column_order(columns, revenue_column):
+    if revenue_column is not None:
+        output_columns = [
+            'Código do item (índice)',
+            'NCM',
+            'Descrição do Produto',
+            revenue_column,
+            'Percentual do Faturamento',
+            'Classificação (enquadra ou não)',
+            'Classificação NCM'
+        ]
+    else:
+        output_columns = [
+            'Código do item (índice)',
+            'NCM',
+            'Descrição do Produto',
+            'Classificação (enquadra ou não)',
+            'Classificação NCM'
+        ]
+
+    # Nos lotes, as colunas de origem (arquivo e aba) vêm primeiro
+    output_columns = [col for col in BATCH_ORIGIN_COLUMNS if col in columns] + output_columns
+
+    # Verificar quais colunas existem antes de reorganizar
+    available_columns = [col for col in output_columns if col in columns]
+    other_columns = [col for col in columns if col not in output_columns and col != 'Enquadrado']
+    return available_columns + other_columns
+
+# Armazena em disco os lotes já classificados no modo streaming, para que a
+# escrita da planilha de saída possa relê-los um a um
+class BatchSpool:
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.count = 0
+
+    def append(self, df):
+        pickle.dump(df, self.file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.count += 1
+
+    def __iter__(self):
+        self.file.seek(0)
+        for _ in range(self.count):
+            yield pickle.load(self.file)
+
+    def close(self):
+        self.file.close()
+
+# Grava a planilha de resultado linha a linha (openpyxl write_only), com as
+# abas "Classificação NCM" e "Resumo"
+class ResultWorkbookWriter:
+    def __init__(self, output_path, revenue_column, total_revenue):
+        self.output_path = output_path
+        self.revenue_column = revenue_column
+        self.total_revenue = total_revenue
+        self.workbook = openpyxl.Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet('Classificação NCM')
+        self.columns = None
+        self.percentage_position = None
+
+    def _header(self, sheet, columns):
+        from openpyxl.cell import WriteOnlyCell
+        from openpyxl.styles import Font
+        cells = []
+        for column in columns:
+            cell = WriteOnlyCell(sheet, value=column)
+            cell.font = Font(bold=True)
+            cells.append(cell)
+        sheet.append(cells)
+
+    def write_batch(self, df):
+        from openpyxl.cell import WriteOnlyCell
+        # Faturamento percentual de cada NCM, formatado como número na célula
+        df = add_revenue_percentage(df, self.revenue_column, self.total_revenue, scale=1)
+
+        if self.columns is None:
+            self.columns = output_column_order(df.columns, self.revenue_column)
+            if 'Percentual do Faturamento' in self.columns:
+                self.percentage_position = self.columns.index('Percentual do Faturamento')
+            self._header(self.sheet, self.columns)
+
+        export = df[self.columns].astype(object)
+        export = export.where(export.notna(), None)
+        for row in export.itertuples(index=False, name=None):
+            if self.percentage_position is not None:
+                row = list(row)
+                cell = WriteOnlyCell(self.sheet, value=row[self.percentage_position])
+                cell.number_format = '0.00%'
+                row[self.percentage_position] = cell
+            self.sheet.append(row)
+
+    def close(self, metrics):
+        # Adicionar planilha de resumo
+        summary_sheet = self.workbook.create_sheet('Resumo')
+        summary_df = build_summary(metrics)
+        self._header(summary_sheet, summary_df.columns)
+        for row in summary_df.itertuples(index=False, name=None):
+            summary_sheet.append(row)
+
+        self.workbook.save(self.output_path)
+        logger.info(f"Arquivo de saída criado: {self.output_path}")
+
+# Adiciona a coluna "Percentual do Faturamento" (fração com scale=1, ou 0-100)
+def add_revenue_percentage(df, revenue_column, total_revenue, scale):
+    if revenue_column is None:
+        return df
+    revenue = df[revenue_column]
+    return df.assign(**{'Percentual do Faturamento': revenue / total_revenue * scale if total_revenue > 0 else 0.0})
+
+# Grava o resultado em CSV (UTF-8 com BOM, para abrir direto no Excel)
+class CsvResultWriter:
+    def __init__(self, output_path, revenue_column, total_revenue):
+        self.output_path = output_path
+        self.revenue_column = revenue_column
+        self.total_revenue = total_revenue
+        self.file = open(output_path, "w", encoding="utf-8-sig", newline="")
+        self.columns = None
+
+    def write_batch(self, df):
+        df = add_revenue_percentage(df, self.revenue_column, self.total_revenue, scale=100)
+        write_header = self.columns is None
+        if write_header:
+            self.columns = output_column_order(df.columns, self.revenue_column)
+        df[self.columns].to_csv(self.file, index=False, header=write_header)
+
+    def close(self, metrics):
+        self.file.close()
+        logger.info(f"Arquivo de saída criado: {self.output_path}")
+
+# Grava o resultado em Parquet, um row group por lote
+class ParquetResultWriter:
+    def __init__(self, output_path, revenue_column, total_revenue):
+        import pyarrow.parquet as pq
+        self.pq = pq
+        self.output_path = output_path
+        self.revenue_column = revenue_column
+        self.total_revenue = total_revenue
+        self.writer = None
+        self.columns = None
+
+    def write_batch(self, df):
+        import pyarrow as pa
+        df = add_revenue_percentage(df, self.revenue_column, self.total_revenue, scale=100)
+        if self.columns is None:
+            self.columns = output_column_order(df.columns, self.revenue_column)
+        export = df[self.columns]
+
+        # Tipos estáveis entre lotes: texto para colunas não numéricas, float para o faturamento
+        export = export.astype({
+            col: ("float64" if col == self.revenue_column else "string")
+            for col in self.columns
+            if col == self.revenue_column or not pd.api.types.is_numeric_dtype(export[col])
+        })
+        table = pa.Table.from_pandas(export, preserve_index=False)
+        if self.writer is None:
+            self.writer = self.pq.ParquetWriter(self.output_path, table.schema)
+        else:
+            table = table.cast(self.writer.schema)
+        self.writer.write_table(table)
+
+    def close(self, metrics):
+        if self.writer is not None:
+            self.writer.close()
+        logger.info(f"Arquivo de saída criado: {self.output_path}")
+
+# Linhas por página devolvidas pela interface (a resposta de /classify-excel leva a primeira)
+RESULTS_PAGE_SIZE = int(os.environ.get("NCM_RESULTS_PAGE_SIZE", "100"))
+RESULTS_MAX_PAGE_SIZE = 1000
+
+# Colunas gravadas só para filtrar a paginação (não aparecem nas linhas devolvidas)
+RESULT_FILTER_COLUMNS = ['Enquadrado', 'Código do item (índice)']
+
+# Linhas por row group do arquivo de paginação: uma página lê apenas os row groups
+# em que cai, e os filtros descartam row groups inteiros pelas estatísticas
+RESULTS_ROW_GROUP_ROWS = 10000
+
+# Grava em Parquet as linhas exibidas na interface (NCM, descrição e faturamento)
+# junto com as colunas de filtro, um row group por lote
+class ResultRowsWriter:
+    def __init__(self, output_path, revenue_column):
+        import pyarrow.parquet as pq
+        self.pq = pq
+        self.output_path = output_path
+        self.revenue_column = revenue_column
+        self.writer = None
+
+    def write_batch(self, df):
+        import pyarrow as pa
+        rows = {column: df[column].astype(str) for column in BATCH_ORIGIN_COLUMNS if column in df.columns}
+        rows['NCM'] = df['NCM'].astype(str)
+        rows['Descrição'] = df['Classificação NCM'].astype(str)
+        if self.revenue_column is not None:
+            rows[self.revenue_column] = df[self.revenue_column].astype("float64")
+        rows['Enquadrado'] = df['Enquadrado'].astype(bool)
+        rows['Código do item (índice)'] = df['Código do item (índice)'].astype(str)
+        table = pa.Table.from_pandas(pd.DataFrame(rows), preserve_index=False)
+        if self.writer is None:
+            self.writer = self.pq.ParquetWriter(self.output_path, table.schema)
+        else:
+            table = table.cast(self.writer.schema)
+        self.writer.write_table(table, row_group_size=RESULTS_ROW_GROUP_ROWS)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+# Indica se um row group pode ter linhas com os valores filtrados, pelas
+# estatísticas (mínimo e máximo) gravadas de cada coluna
+def row_group_may_match(row_group, filters):
+    for index in range(row_group.num_columns):
+        column = row_group.column(index)
+        statistics = column.statistics
+        if column.path_in_schema in filters and statistics is not None and statistics.has_min_max:
+            if not statistics.min <= filters[column.path_in_schema] <= statistics.max:
+                return False
+    return True
+
+# Máscara das linhas de um row group (já lido) que passam pelos filtros
+def filter_mask(table, filters):
+    import pyarrow.compute as pc
+    mask = None
+    for column, value in filters.items():
+        matches = pc.equal(table[column], value)
+        mask = matches if mask is None else pc.and_(mask, matches)
+    return mask
+
+# Lê uma página das linhas de um resultado, filtrando por status e/ou código do
+# item. Sem filtros, os metadados dão o total e os row groups da página; com
+# filtros, só as colunas filtradas são lidas para contar as linhas de cada row
+# group (os descartados pelas estatísticas nem são lidos). Em ambos os casos, as
+# linhas completas vêm apenas dos row groups em que a página cai
+def read_result_page(rows_path, page, page_size, enquadrado=None, item_code=None):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+    filters = {}
+    if enquadrado is not None:
+        filters['Enquadrado'] = enquadrado
+    if item_code is not None:
+        filters['Código do item (índice)'] = item_code
+
+    parquet_file = pq.ParquetFile(rows_path)
+    metadata = parquet_file.metadata
+    group_rows = []
+    for index in range(metadata.num_row_groups):
+        row_group = metadata.row_group(index)
+        if not filters:
+            group_rows.append(row_group.num_rows)
+        elif row_group_may_match(row_group, filters):
+            mask = filter_mask(parquet_file.read_row_group(index, columns=list(filters)), filters)
+            group_rows.append(pc.sum(mask).as_py() or 0)
+        else:
+            group_rows.append(0)
+    total_rows = sum(group_rows)
+
+    columns = [name for name in parquet_file.schema_arrow.names if name not in RESULT_FILTER_COLUMNS]
+    start = (page - 1) * page_size
+    end = start + page_size
+    pieces = []
+    group_start = 0
+    for index, rows in enumerate(group_rows):
+        group_end = group_start + rows
+        if rows and group_end > start and group_start < end:
+            table = parquet_file.read_row_group(index, columns=columns + list(filters))
+            if filters:
+                table = table.filter(filter_mask(table, filters))
+            offset = max(start - group_start, 0)
+            pieces.append(table.slice(offset, min(end, group_end) - group_start - offset).select(columns))
+        group_start = group_end
+        if group_start >= end:
+            break
+    rows_page = pa.concat_tables(pieces) if pieces else parquet_file.schema_arrow.empty_table().select(columns)
+    return {
+        "results": rows_page.to_pylist(),
+        "pagination": {
+            "page": page,
+            "page_size": page_size,
+            "total_rows": total_rows,
+            "total_pages": -(-total_rows // page_size),
+        },
+    }
+
+# Assinaturas no início do arquivo: .xlsx é um pacote ZIP (OOXML) e .xls um
+# documento composto OLE2 (BIFF)
+EXCEL_SIGNATURES = {b"PK\x03\x04": "xlsx", b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1": "xls"}
+
+# Engine de leitura de cada formato de Excel
+EXCEL_ENGINES = {"xlsx": "openpyxl", "xls": "xlrd"}
+
+# calamine (pacote opcional python-calamine) lê .xlsx e .xls bem mais rápido que
+# openpyxl e xlrd; é usado na leitura em memória quando estiver instalado.
+# NCM_EXCEL_CALAMINE=0 força as engines tradicionais
+USE_CALAMINE = (
+    os.environ.get("NCM_EXCEL_CALAMINE", "1") != "0"
+    and importlib.util.find_spec("python_calamine") is not None
+)
+
+# Formato real de um arquivo Excel pelos primeiros bytes ("xlsx", "xls" ou None)
+def sniff_excel_format(path):
+    with open(path, "rb") as f:
+        head = f.read(8)
+    for signature, excel_format in EXCEL_SIGNATURES.items():
+        if head.startswith(signature):
+            return excel_format
+    return None
+
+# Confirma o formato de um upload Excel pelo conteúdo, independente da extensão
+# (.xls salvo como .xlsx e vice-versa é comum em exportações de sistemas)
+def detect_upload_format(upload_path, input_format):
+    if input_format not in EXCEL_ENGINES:
+        return input_format
+    excel_format = sniff_excel_format(upload_path)
+    if excel_format is None:
+        raise HTTPException(status_code=400, detail="Não foi possível ler o arquivo Excel: o conteúdo não é um .xlsx nem um .xls válido.")
+    if excel_format != input_format:
+        logger.info(f"Arquivo com extensão .{input_format} tem conteúdo .{excel_format}")
+    return excel_format
+
+# Lê a planilha com uma engine. O arquivo é aberto uma vez: a pré-leitura do
+# cabeçalho e de algumas linhas escolhe as colunas, e a leitura completa carrega
+# apenas elas, com o NCM já como texto
+def read_excel_projected(path, engine, keep_columns, key_column=None):
+    with pd.ExcelFile(path, engine=engine) as workbook:
+        sample = workbook.parse(nrows=INPUT_SAMPLE_ROWS)
+        positions, ncm_column = select_input_columns(sample, keep_columns, key_column)
+        return workbook.parse(usecols=None if keep_columns else positions, dtype={ncm_column: str})
+
+# Lê a planilha inteira na memória (modo padrão; também usado para .xls). O
+# formato já foi identificado pelo conteúdo, então apenas a engine certa é usada
+def read_excel_in_memory(path, excel_format, stats=None, keep_columns=False, key_column=None):
+    stats = stats or ProcessingStats()
+    engine = EXCEL_ENGINES[excel_format]
+    df = None
+    try:
+        if USE_CALAMINE:
+            try:
+                df = read_excel_projected(path, 'calamine', keep_columns, key_column)
+                engine = 'calamine'
+            except SpreadsheetError:
+                raise
+            except Exception as e:
+                stats.engine_failed("calamine")
+                logger.warning(f"Erro ao ler com calamine: {str(e)}. Tentando com {engine}...")
+        if df is None:
+            try:
+                df = read_excel_projected(path, engine, keep_columns, key_column)
+            except SpreadsheetError:
+                raise
+            except Exception:
+                stats.engine_failed(engine)
+                raise
+        logger.info(f"Arquivo lido com sucesso usando engine '{engine}'")
+    except SpreadsheetError:
+        raise
+    except Exception as e:
+        logger.error(f"Falha ao ler o arquivo Excel: {str(e)}")
+        raise SpreadsheetError(400, f"Não foi possível ler o arquivo Excel: {str(e)}")
+
+    # Log das colunas lidas
+    logger.info(f"Colunas lidas do arquivo: {df.columns.tolist()}")
+    return [df]
+
+# Número de linhas de dados informado no cabeçalho da planilha (sem lê-la inteira)
+def count_excel_rows(path):
+    try:
+        workbook = openpyxl.load_workbook(path, read_only=True)
+    except Exception:
+        return None
+    try:
+        max_row = workbook.worksheets[0].max_row
+        return max_row - 1 if max_row else None
+    finally:
+        workbook.close()
+
+# Lê a planilha em lotes de tamanho fixo, com memória limitada
+def read_excel_streaming(path, stats=None, keep_columns=False, key_column=None):
+    try:
+        batches = iter_excel_batches(path, keep_columns=keep_columns, key_column=key_column)
+        first_batch = next(batches, None)
+    except SpreadsheetError:
+        raise
+    except Exception as e:
+        if stats is not None:
+            stats.engine_failed("openpyxl_read_only")
+        logger.error(f"Falha ao ler o arquivo Excel em modo streaming: {str(e)}")
+        raise SpreadsheetError(400, f"Não foi possível ler o arquivo Excel: {str(e)}")
+    if first_batch is None:
+        raise SpreadsheetError(400, "A planilha está vazia.")
+
+    logger.info(f"Colunas lidas do arquivo: {first_batch.columns.tolist()}")
+    yield first_batch
+    yield from batches
+
+# Escritores de resultado por formato de saída
+RESULT_WRITERS = {"xlsx": ResultWorkbookWriter, "csv": CsvResultWriter, "parquet": ParquetResultWriter}
+
+# Formatos de entrada aceitos, pela extensão do arquivo
+INPUT_FORMATS = {".xlsx": "xlsx", ".xls": "xls", ".csv": "csv", ".parquet": "parquet"}
+
+# Formatos de saída disponíveis para o resultado
+OUTPUT_FORMATS = ("xlsx", "csv", "parquet")
+
+def input_format_for(filename):
+    return INPUT_FORMATS.get(os.path.splitext(filename or "")[1].lower())
+
+# Linhas lidas na pré-leitura usada para identificar as colunas
+INPUT_SAMPLE_ROWS = 5
+
+# Colunas efetivamente usadas na classificação (NCM, faturamento e descrição,
+# além da coluna-chave do modo incremental), na ordem do arquivo; as demais só
+# são lidas quando pedidas (keep_columns)
+def projected_columns(columns, renames, revenue_column, key_column=None):
+    wanted = set(renames) | {"NCM", "Descrição do Produto", revenue_column, key_column}
+    return [col for col in columns if col in wanted]
+
+# A partir da pré-leitura, posições das colunas a ler (todas, com keep_columns)
+# e o nome original da coluna de NCM
+def select_input_columns(sample, keep_columns, key_column=None):
+    renames, revenue_column = detect_columns(sample)
+    if keep_columns:
+        positions = list(range(len(sample.columns)))
+    else:
+        wanted = projected_columns(sample.columns, renames, revenue_column, key_column)
+        positions = [i for i, col in enumerate(sample.columns) if col in wanted]
+    ncm_column = next((col for col, new_name in renames.items() if new_name == "NCM"), "NCM")
+    return positions, ncm_column
+
+# Detecta codificação e separador de um CSV a partir do início do arquivo
+def sniff_csv_format(path):
+    with open(path, "rb") as f:
+        head = f.read(64 * 1024)
+    try:
+        text = head.decode("utf-8-sig")
+        encoding = "utf-8-sig"
+    except UnicodeDecodeError:
+        text = head.decode("latin-1")
+        encoding = "latin-1"
+    try:
+        sep = csv.Sniffer().sniff(text.split("\n", 1)[0], delimiters=",;\t|").delimiter
+    except csv.Error:
+        sep = ","
+    return encoding, sep
+
+# Conta as linhas de dados de um CSV sem interpretá-lo (para o progresso dos jobs)
+def count_csv_rows(path):
+    lines = 0
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            lines += chunk.count(b"\n")
+    return max(lines - 1, 0)
+
+# Lê um CSV em lotes, carregando apenas as colunas usadas e o NCM como texto
+def read_csv_batches(path, keep_columns=False, key_column=None):
+    try:
+        encoding, sep = sniff_csv_format(path)
+        # Planilhas brasileiras separadas por ";" usam vírgula decimal
+        number_format = {"decimal": ",", "thousands": "."} if sep == ";" else {}
+        sample = pd.read_csv(path, sep=sep, encoding=encoding, nrows=INPUT_SAMPLE_ROWS, dtype=str)
+        renames, revenue_column = detect_columns(sample)
+        usecols = list(sample.columns) if keep_columns else projected_columns(sample.columns, renames, revenue_column, key_column)
+        text_columns = {col: str for col in usecols if col != revenue_column}
+        reader = pd.read_csv(
+            path, sep=sep, encoding=encoding, usecols=usecols, dtype=text_columns,
+            chunksize=STREAMING_BATCH_ROWS, **number_format
+        )
+    except SpreadsheetError:
+        raise
+    except Exception as e:
+        logger.error(f"Falha ao ler o arquivo CSV: {str(e)}")
+        raise SpreadsheetError(400, f"Não foi possível ler o arquivo CSV: {str(e)}")
+
+    logger.info(f"Colunas lidas do CSV: {usecols}")
+    with reader:
+        yield from reader
+
+# Lê um Parquet em lotes (row groups), apenas com as colunas usadas
+def read_parquet_batches(path, keep_columns=False, key_column=None):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SpreadsheetError(400, "O suporte a arquivos Parquet requer o pacote 'pyarrow'.")
+
+    try:
+        parquet_file = pq.ParquetFile(path)
+        sample = next(parquet_file.iter_batches(batch_size=INPUT_SAMPLE_ROWS), None)
+        if sample is None:
+            raise SpreadsheetError(400, "O arquivo Parquet está vazio.")
+        renames, revenue_column = detect_columns(sample.to_pandas())
+        usecols = parquet_file.schema_arrow.names
+        if not keep_columns:
+            usecols = projected_columns(usecols, renames, revenue_column, key_column)
+    except SpreadsheetError:
+        raise
+    except Exception as e:
+        logger.error(f"Falha ao ler o arquivo Parquet: {str(e)}")
+        raise SpreadsheetError(400, f"Não foi possível ler o arquivo Parquet: {str(e)}")
+
+    logger.info(f"Colunas lidas do Parquet: {usecols}")
+    for record_batch in parquet_file.iter_batches(batch_size=STREAMING_BATCH_ROWS, columns=usecols):
+        yield record_batch.to_pandas()
+
+def count_parquet_rows(path):
+    try:
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(path).metadata.num_rows
+    except Exception:
+        return None
+
+# Abre a leitura do arquivo de entrada conforme o formato; retorna os lotes
+# e o total de linhas esperado (None quando não é possível saber de antemão)
+def open_input_batches(upload_path, input_format, use_streaming, stats=None, keep_columns=False, key_column=None):
+    if input_format == "csv":
+        return read_csv_batches(upload_path, keep_columns, key_column), count_csv_rows(upload_path)
+    if input_format == "parquet":
+        return read_parquet_batches(upload_path, keep_columns, key_column), count_parquet_rows(upload_path)
+    if use_streaming:
+        return read_excel_streaming(upload_path, stats, keep_columns, key_column), count_excel_rows(upload_path)
+    batches = read_excel_in_memory(upload_path, input_format, stats, keep_columns, key_column)
+    return batches, sum(len(batch) for batch in batches)
+
+# Diretório dedicado aos arquivos de resultado (não compartilha o diretório temporário do sistema)
+RESULTS_DIR = os.environ.get("NCM_RESULTS_DIR", os.path.join(tempfile.gettempdir(), "ncm-resultados"))
+
+# Resultados mais antigos que este tempo (segundos) são removidos
+RESULTS_TTL_SECONDS = int(os.environ.get("NCM_RESULTS_TTL_SECONDS", str(24 * 3600)))
+
+# Espaço máximo ocupado pelos resultados; acima disso os mais antigos são removidos
+RESULTS_MAX_BYTES = int(os.environ.get("NCM_RESULTS_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+# Armazena os arquivos de resultado endereçados pelo conteúdo do upload: o mesmo
+# arquivo enviado de novo com o mesmo formato de saída reaproveita o resultado
+# e as métricas já calculados. Cada resultado é o arquivo <chave>.<formato> (para
+# download) acompanhado de <chave>.<formato>.json (resposta da API),
+# <chave>.<formato>.rows (linhas para a paginação) e <chave>.<formato>.estado
+# (hash e regra de cada linha, base do modo incremental)
+class ResultStore:
+    COMPANION_SUFFIXES = (".json", ".rows", ".estado")
+
+    # Acompanhantes que podem faltar (resultados de lotes não têm o estado das linhas)
+    OPTIONAL_SUFFIXES = (".estado",)
+
+    def __init__(self, directory, ttl_seconds, max_bytes):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    # Nome do arquivo de resultado para um upload (hash do conteúdo, formato de
+    # entrada, colunas mantidas e versão das regras: uma nova tabela de regras não
+    # reaproveita resultados antigos). No modo incremental, o resultado depende
+    # também de guardar o estado das linhas, do resultado anterior e da coluna-chave
+    @staticmethod
+    def result_name(content_digest, input_format, output_format, rules_version, keep_columns=False,
+                    key_column=None, previous=None, track_rows=False):
+        columns = ":todas-colunas" if keep_columns else ""
+        if track_rows:
+            columns += ":estado"
+        if key_column is not None:
+            columns += f":chave={key_column}"
+        if previous is not None:
+            columns += f":anterior={previous}"
+        key = hashlib.sha256(f"{content_digest}:{input_format}:{rules_version}{columns}".encode()).hexdigest()[:32]
+        return f"{key}.{output_format}"
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    # Caminho de um resultado existente, aceitando apenas nomes sem diretório
+    def resolve(self, name):
+        if name != os.path.basename(name) or name.startswith("."):
+            return None
+        file_path = self.path(name)
+        return file_path if os.path.isfile(file_path) else None
+
+    # Resposta guardada para o resultado, ou None se ele não existir (ou tiver expirado)
+    def lookup(self, name):
+        file_path = self.resolve(name)
+        if file_path is None:
+            return None
+        stat = os.stat(file_path)
+        if time.time() - max(stat.st_atime, stat.st_mtime) > self.ttl_seconds:
+            return None
+        paths = [file_path] + [
+            file_path + suffix for suffix in self.COMPANION_SUFFIXES
+            if suffix not in self.OPTIONAL_SUFFIXES or os.path.exists(file_path + suffix)
+        ]
+        try:
+            with open(file_path + ".json", "rb") as f:
+                response_data = orjson.loads(f.read())
+            # Renova a validade dos arquivos reaproveitados pelo horário de acesso; a data
+            # de modificação é preservada (serve de Last-Modified/ETag no download)
+            now = time.time()
+            for path in paths:
+                os.utime(path, (now, os.path.getmtime(path)))
+        except (FileNotFoundError, orjson.JSONDecodeError):
+            return None
         return response_data
-        
+
+    # Guarda a resposta ao lado do arquivo de resultado e aplica os limites de retenção
+    def save(self, name, response_data):
+        meta_path = self.path(name) + ".json"
+        tmp_path = f"{meta_path}.tmp-{uuid.uuid4().hex}"
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps(response_data, option=ORJSON_OPTIONS))
+        os.replace(tmp_path, meta_path)
+        self.evict()
+
+    # Remove resultados sem uso há mais que o TTL e, se o diretório passar do limite,
+    # os usados há mais tempo. Cada resultado sai inteiro: o arquivo, os acompanhantes
+    # e o CSV compactado compartilham o hash do nome e são removidos juntos, o arquivo
+    # principal primeiro (assim uma consulta nunca encontra um resultado pela metade).
+    # Arquivos temporários de gravações em andamento só saem pelo TTL
+    def evict(self):
+        now = time.time()
+        results = {}
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            last_used = max(stat.st_atime, stat.st_mtime)
+            if ".tmp-" in entry.name:
+                if now - last_used > self.ttl_seconds:
+                    self._remove(entry.path)
+                continue
+            stem = entry.name.split(".", 1)[0]
+            used, size, paths = results.get(stem, (0, 0, []))
+            results[stem] = (max(used, last_used), size + stat.st_size, paths + [entry.path])
+        total = sum(size for _, size, _ in results.values())
+        for last_used, size, paths in sorted(results.values()):
+            if now - last_used <= self.ttl_seconds and total <= self.max_bytes:
+                continue
+            for path in sorted(paths, key=lambda path: path.endswith(self.COMPANION_SUFFIXES)):
+                self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+result_store = ResultStore(RESULTS_DIR, RESULTS_TTL_SECONDS, RESULTS_MAX_BYTES)
+
+# Processos dedicados às planilhas (0 = usa o pool de threads padrão, sem processos extras)
+SPREADSHEET_WORKERS = int(os.environ.get("NCM_SPREADSHEET_WORKERS", str(os.cpu_count() or 1)))
+
+# Máximo de planilhas em processamento ou aguardando na fila; acima disso responde 503
+SPREADSHEET_MAX_PENDING = int(os.environ.get("NCM_SPREADSHEET_MAX_PENDING", str(max(SPREADSHEET_WORKERS, 1) * 2)))
+
+spreadsheet_pool = None
+pending_spreadsheets = 0
+
+# Cria o pool de processos sob demanda (evita criar processos ao importar o módulo)
+def get_spreadsheet_pool():
+    global spreadsheet_pool
+    if spreadsheet_pool is None and SPREADSHEET_WORKERS > 0:
+        spreadsheet_pool = ProcessPoolExecutor(max_workers=SPREADSHEET_WORKERS)
+    return spreadsheet_pool
+
+# Reserva uma vaga na fila de planilhas; responde 503 quando a fila está cheia
+def acquire_spreadsheet_slot():
+    global pending_spreadsheets
+    if pending_spreadsheets >= SPREADSHEET_MAX_PENDING:
+        raise HTTPException(status_code=503, detail="Servidor ocupado processando outras planilhas. Tente novamente em instantes.")
+    pending_spreadsheets += 1
+
+def release_spreadsheet_slot():
+    global pending_spreadsheets
+    pending_spreadsheets -= 1
+
+# Executa uma tarefa pesada fora do event loop e libera a vaga reservada ao final
+# (release_slot=False para tarefas que não reservaram vaga própria)
+async def run_spreadsheet_task(func, *args, release_slot=True):
+    global spreadsheet_pool
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_spreadsheet_pool(), func, *args)
+    except SpreadsheetError as e:
+        SPREADSHEET_FAILURES.inc(task=func.__name__, kind="entrada_invalida")
+        for engine, failures in getattr(e, "engine_failures", {}).items():
+            EXCEL_ENGINE_FAILURES.inc(failures, engine=engine)
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except BrokenProcessPool:
+        # Um processo morreu (ex.: falta de memória); recria o pool na próxima chamada
+        logger.error("Pool de processos de planilhas interrompido; será recriado")
+        SPREADSHEET_FAILURES.inc(task=func.__name__, kind="processo_interrompido")
+        spreadsheet_pool = None
+        raise
+    except Exception:
+        SPREADSHEET_FAILURES.inc(task=func.__name__, kind="erro_interno")
+        raise
+    finally:
+        if release_slot:
+            release_spreadsheet_slot()
+
+# Encerra o pool de planilhas (ao final do ciclo de vida do app)
+def shutdown_spreadsheet_pool():
+    global spreadsheet_pool
+    if spreadsheet_pool is not None:
+        spreadsheet_pool.shutdown(cancel_futures=True)
+        spreadsheet_pool = None
+
+# Intervalo (segundos) para verificar alterações no arquivo de regras (0 = desativado)
+RULES_WATCH_SECONDS = float(os.environ.get("NCM_RULES_WATCH_SECONDS", "0"))
+
+# Token exigido no cabeçalho X-Admin-Token pelas rotas administrativas (sem token, ficam desativadas)
+ADMIN_TOKEN = os.environ.get("NCM_ADMIN_TOKEN")
+
+rules_loaded_at = time.time()
+rules_watcher = None
+
+# Troca o índice de regras em uso sem interromper requisições em andamento: a
+# atribuição é atômica e cada classificação segue com o índice que leu ao começar.
+# O pool de planilhas é substituído (tarefas já enviadas terminam nos processos
+# antigos), para que os novos processos usem as regras novas
+def swap_rule_index(new_index):
+    global rule_index, rules_loaded_at, spreadsheet_pool
+    old_version = rule_index.version
+    rule_index = new_index
+    rules_loaded_at = time.time()
+    resolve_code.cache_clear()
+    if spreadsheet_pool is not None:
+        spreadsheet_pool.shutdown(wait=False)
+    spreadsheet_pool = None
+    logger.info(f"Tabela de regras atualizada: {old_version} -> {new_index.version} ({len(new_index.rules)} regras)")
+
+# Recompila o arquivo de regras fora do event loop e troca o índice se a versão mudou
+async def reload_rules():
+    new_index = await asyncio.to_thread(compile_rules)
+    if new_index.version != rule_index.version:
+        swap_rule_index(new_index)
+    return rule_index
+
+# Verifica periodicamente o arquivo de regras e recarrega quando ele muda. Um
+# arquivo inválido é ignorado e as regras atuais continuam em uso
+async def watch_rules_file():
+    last_mtime = None
+    while True:
+        try:
+            mtime = os.path.getmtime(RULES_PATH)
+            changed = last_mtime is not None and mtime != last_mtime
+            last_mtime = mtime
+            if changed:
+                await reload_rules()
+        except (OSError, ValueError) as e:
+            logger.error(f"Falha ao recarregar {RULES_PATH}; mantendo as regras {rule_index.version}: {str(e)}")
+        await asyncio.sleep(RULES_WATCH_SECONDS)
+
+# Inicia e para a verificação do arquivo de regras (ver lifespan)
+def start_rules_watcher():
+    global rules_watcher
+    if RULES_WATCH_SECONDS > 0:
+        rules_watcher = asyncio.create_task(watch_rules_file())
+
+async def stop_rules_watcher():
+    global rules_watcher
+    if rules_watcher is not None:
+        rules_watcher.cancel()
+        with suppress(asyncio.CancelledError):
+            await rules_watcher
+        rules_watcher = None
+
+# Informações da tabela de regras em uso
+def rules_info():
+    return {
+        "version": rule_index.version,
+        "rules_count": len(rule_index.rules),
+        "path": RULES_PATH,
+        "loaded_at": rules_loaded_at,
+    }
+
+# Rotas administrativas exigem o token configurado em NCM_ADMIN_TOKEN
+def require_admin(request):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Rotas administrativas desativadas. Defina NCM_ADMIN_TOKEN para habilitá-las.")
+    if not secrets.compare_digest(request.headers.get("x-admin-token", ""), ADMIN_TOKEN):
+        raise HTTPException(status_code=401, detail="Token administrativo inválido.")
+
+# Rota com a versão da tabela de regras em uso
+@app.get("/rules")
+async def get_rules_info():
+    return rules_info()
+
+# Rota para recarregar as regras a partir do arquivo
+@app.post("/admin/rules/reload")
+async def reload_rules_file(request: Request):
+    require_admin(request)
+    try:
+        await reload_rules()
+    except (OSError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Arquivo de regras inválido: {str(e)}")
+    return rules_info()
+
+# Rota para publicar uma nova tabela de regras: valida o JSON recebido, grava o
+# arquivo (substituição atômica) e troca o índice em uso
+@app.put("/admin/rules")
+async def publish_rules(request: Request):
+    require_admin(request)
+    content = await request.body()
+    try:
+        version, rules = parse_rules(content)
+        new_index = await asyncio.to_thread(RuleIndex, rules, version)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=f"Tabela de regras inválida: {str(e)}")
+
+    tmp_path = f"{RULES_PATH}.tmp-{uuid.uuid4().hex}"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, RULES_PATH)
+    if new_index.version != rule_index.version:
+        swap_rule_index(new_index)
+    return rules_info()
+
+# Item de uma posição de regra (None para -1, sem regra)
+def position_item(compiled_rules, position):
+    return compiled_rules.item_codes[position] if position >= 0 else None
+
+# Ordena códigos de item numericamente (itens não numéricos por último)
+def item_sort_key(item):
+    return (not item.isdigit(), int(item) if item.isdigit() else 0, item)
+
+# Cobertura dos NCMs de 8 dígitos que começam com o prefixo, calculada só com o
+# índice reverso (sem classificar código a código). Vale o prefixo mais longo da
+# tabela: o nó mais profundo no caminho até o prefixo define a regra do prefixo
+# como um todo, e cada nó abaixo dele (e cada código exato) toma para si a sua
+# faixa. Devolve as faixas, os códigos exatos e o total de NCMs por item
+def prefix_coverage(compiled_rules, prefix):
+    reverse = compiled_rules.reverse_index
+    depth = len(prefix)
+    default = next((reverse["prefixes"][prefix[:d]] for d in range(depth, 0, -1) if prefix[:d] in reverse["prefixes"]), -1)
+    nodes = {prefix: default}
+    nodes.update((p, position) for p, position in reverse["prefixes"].items() if len(p) > depth and p.startswith(prefix))
+    codes = {code: position for code, position in reverse["codes"].items() if code.startswith(prefix)}
+
+    # Nó mais profundo que contém o código, entre o prefixo consultado e max_depth
+    def covering_node(code, max_depth):
+        return next(code[:d] for d in range(max_depth, depth - 1, -1) if code[:d] in nodes)
+
+    counts = {p: 10 ** (NCM_LENGTH - len(p)) for p in nodes}
+    for p in nodes:
+        if p != prefix:
+            counts[covering_node(p, len(p) - 1)] -= 10 ** (NCM_LENGTH - len(p))
+    totals = {}
+    for p, position in nodes.items():
+        totals[position] = totals.get(position, 0) + counts[p]
+    for code, position in codes.items():
+        if len(code) == NCM_LENGTH:
+            node = covering_node(code, NCM_LENGTH)
+            counts[node] -= 1
+            totals[nodes[node]] -= 1
+            totals[position] = totals.get(position, 0) + 1
+
+    total_codes = 10 ** (NCM_LENGTH - depth)
+    item_counts = {}
+    for position, count in totals.items():
+        item = position_item(compiled_rules, position)
+        item_counts[item] = item_counts.get(item, 0) + count
+    items = [
+        {"item": item, "codes": count, "percentage": round(count / total_codes * 100, 4)}
+        for item, count in sorted(item_counts.items(), key=lambda entry: item_sort_key(entry[0] or ""))
+        if item is not None and count > 0
+    ]
+    return {
+        "prefix": prefix,
+        "rules_version": compiled_rules.version,
+        "total_codes": total_codes,
+        "covered_codes": total_codes - item_counts.get(None, 0),
+        "full_item": items[0]["item"] if len(items) == 1 and items[0]["codes"] == total_codes else None,
+        "items": items,
+        "ranges": [
+            {"prefix": p, "item": position_item(compiled_rules, nodes[p]), "codes": counts[p]}
+            for p in sorted(nodes)
+        ],
+        "exact_codes": [
+            {"code": code, "item": position_item(compiled_rules, position)}
+            for code, position in sorted(codes.items())
+        ],
+    }
+
+# NCMs de 8 dígitos cobertos sob o prefixo (opcionalmente só os de um item),
+# classificados de uma vez, de forma vetorizada, a partir dos números
+def list_covered_codes(compiled_rules, prefix, item=None):
+    size = 10 ** (NCM_LENGTH - len(prefix))
+    numbers = np.arange(size, dtype=np.uint64) + np.uint64(int(prefix) * size)
+    positions = compiled_rules.lookup_numbers(numbers, np.full(size, NCM_LENGTH))
+    selected = positions >= 0
+    if item is not None:
+        item_positions = [position for position, code in enumerate(compiled_rules.item_codes) if code == item]
+        selected &= np.isin(positions, item_positions)
+    return [f"{number:08d}" for number in numbers[selected].tolist()]
+
+# Valida um prefixo de NCM recebido na URL (pontos são ignorados)
+def parse_ncm_prefix(prefix, min_length=1):
+    prefix = normalize_code(prefix)
+    if not (prefix.isascii() and prefix.isdigit()) or not min_length <= len(prefix) <= NCM_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Prefixo inválido: informe de {min_length} a {NCM_LENGTH} dígitos.")
+    return prefix
+
+# Máximo de NCMs listados individualmente na rota de capítulos
+RULES_MAX_LISTED_CODES = int(os.environ.get("NCM_RULES_MAX_LISTED_CODES", "100000"))
+
+# Exportação completa do índice reverso (itens, prefixos e códigos exatos), para
+# ferramentas que antes varriam /classify capítulo a capítulo. O ETag é a versão
+# das regras, então clientes revalidam com If-None-Match e recebem 304
+@app.get("/rules/index")
+async def export_rules_index(request: Request):
+    reverse = rule_index.reverse_index
+    headers = {"ETag": f'"{rule_index.version}"', "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") is not None and is_not_modified(request, Response(headers=headers), None):
+        return Response(status_code=304, headers=headers)
+    return FastJSONResponse({
+        "rules_version": rule_index.version,
+        "items": sorted(reverse["items"].values(), key=lambda entry: item_sort_key(entry["item"])),
+        "prefixes": [
+            {"prefix": prefix, "item": position_item(rule_index, position)}
+            for prefix, position in sorted(reverse["prefixes"].items())
+        ],
+        "codes": [
+            {"code": code, "item": position_item(rule_index, position)}
+            for code, position in sorted(reverse["codes"].items())
+        ],
+    }, headers=headers)
+
+# Rota com os códigos e prefixos de um item, como escritos nas regras e como
+# efetivamente cobertos depois da precedência
+@app.get("/rules/items/{item}")
+async def get_rule_item(item: str):
+    entry = rule_index.reverse_index["items"].get(item)
+    if entry is None:
+        raise HTTPException(status_code=404, detail=f"Item não encontrado: {item}.")
+    return {"rules_version": rule_index.version, **entry}
+
+# Rota com os itens que cobrem os NCMs de um prefixo (de 1 a 8 dígitos)
+@app.get("/rules/coverage/{prefix}")
+async def get_prefix_coverage(prefix: str):
+    return FastJSONResponse(prefix_coverage(rule_index, parse_ncm_prefix(prefix)))
+
+# Rota com a cobertura de um capítulo (2 dígitos). Com list_codes=true, lista
+# também cada NCM coberto (opcionalmente só os de um item), até RULES_MAX_LISTED_CODES
+@app.get("/rules/chapters/{chapter}")
+async def get_chapter_coverage(chapter: str, list_codes: bool = False, item: str | None = None):
+    chapter = normalize_code(chapter)
+    if len(chapter) != 2:
+        raise HTTPException(status_code=400, detail="Capítulo inválido: informe 2 dígitos.")
+    compiled_rules = rule_index
+    coverage = prefix_coverage(compiled_rules, parse_ncm_prefix(chapter))
+    if list_codes:
+        if item is not None and item not in compiled_rules.reverse_index["items"]:
+            raise HTTPException(status_code=404, detail=f"Item não encontrado: {item}.")
+        listed = coverage["covered_codes"] if item is None else next((entry["codes"] for entry in coverage["items"] if entry["item"] == item), 0)
+        if listed > RULES_MAX_LISTED_CODES:
+            raise HTTPException(status_code=400, detail=f"{listed} NCMs cobertos excedem o limite de {RULES_MAX_LISTED_CODES} para listagem; use as faixas (ranges) ou filtre por item.")
+        coverage["codes"] = await asyncio.to_thread(list_covered_codes, compiled_rules, chapter, item)
+    return FastJSONResponse(coverage)
+
+# Sufixo do arquivo com o estado das linhas de um resultado (ver ResultStore)
+ROW_STATE_SUFFIX = ".estado"
+
+# Versão do cálculo do hash das linhas, gravada no estado: estados com outro
+# cálculo não são comparáveis
+ROW_HASH_FORMAT = 2
+
+# Marca os valores vazios no texto canônico (nenhum valor lido da planilha é igual)
+NULL_SENTINEL = "\0vazio"
+
+# Texto canônico de um valor de célula: números inteiros sem casas decimais (o
+# leitor em memória devolve 1.0 onde o streaming devolve 1) e vazios como
+# NULL_SENTINEL. A conversão é feita uma vez por valor distinto
+def canonical_text(series):
+    codes, uniques = pd.factorize(series)
+    labels = [
+        str(int(value)) if isinstance(value, (float, np.floating)) and value.is_integer() else str(value)
+        for value in uniques
+    ]
+    return np.array(labels + [NULL_SENTINEL], dtype=object)[codes]
+
+# Colunas que entram no hash das linhas: as que decidem a classificação e as
+# métricas (NCM, descrição, faturamento) e a coluna-chave. As demais colunas
+# (keep_columns) não participam, então o hash não depende delas nem do leitor
+def hashed_columns(revenue_column, key_column):
+    return ["NCM", "Descrição do Produto"] + [col for col in (revenue_column, key_column) if col is not None]
+
+# Hash de cada linha de um lote normalizado, sobre os valores canônicos das
+# colunas em hashed_columns (o faturamento entra como número)
+def row_hashes(df, revenue_column, key_column=None):
+    values = pd.DataFrame({
+        str(position): df[column].astype("float64") if column == revenue_column else canonical_text(df[column])
+        for position, column in enumerate(hashed_columns(revenue_column, key_column))
+    })
+    return pd.util.hash_pandas_object(values, index=False).to_numpy()
+
+def key_hashes(df, key_column):
+    return pd.util.hash_pandas_object(pd.Series(canonical_text(df[key_column])), index=False).to_numpy()
+
+# Grava em Parquet o estado das linhas de um resultado: hash da linha, posição da
+# regra aplicada, faturamento e hash da coluna-chave (quando houver). Os metadados
+# registram o que precisa coincidir para que um novo upload seja comparado a ele
+class RowStateWriter:
+    def __init__(self, output_path, info):
+        import pyarrow.parquet as pq
+        self.pq = pq
+        self.output_path = output_path
+        self.info = info
+        self.writer = None
+
+    def write_batch(self, hashes, positions, revenue=None, keys=None):
+        import pyarrow as pa
+        columns = {"hash": pa.array(hashes, type=pa.uint64()), "posicao": pa.array(positions, type=pa.int16())}
+        if revenue is not None:
+            columns["faturamento"] = pa.array(revenue, type=pa.float64())
+        if keys is not None:
+            columns["chave"] = pa.array(keys, type=pa.uint64())
+        table = pa.table(columns).replace_schema_metadata({"ncm": json.dumps(self.info)})
+        if self.writer is None:
+            self.writer = self.pq.ParquetWriter(self.output_path, table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+# Compara as linhas de um novo upload com o estado das linhas de um resultado
+# anterior (modo incremental). Linhas com o mesmo hash reaproveitam a regra já
+# encontrada e não entram de novo nas métricas: os totais por item partem do
+# resultado anterior, somando as linhas novas e subtraindo as removidas. Linhas
+# repetidas são pareadas uma a uma. A comparação só é aplicada se regras, colunas,
+# faturamento e coluna-chave forem os mesmos; caso contrário, reason explica
+class RowChanges:
+    def __init__(self, previous, info):
+        self.previous_name = previous["name"]
+        self.previous_metrics = previous["metrics"]
+        self.reason = None
+        try:
+            import pyarrow.parquet as pq
+            table = pq.read_table(previous["state_path"])
+            previous_info = json.loads(table.schema.metadata[b"ncm"])
+        except (OSError, KeyError, TypeError, ValueError) as e:
+            logger.warning(f"Estado das linhas de {self.previous_name} indisponível: {str(e)}")
+            self.reason = "o estado das linhas do resultado anterior não está disponível"
+        else:
+            if previous_info.get("hash_format") != info["hash_format"]:
+                self.reason = "o estado do resultado anterior foi gravado em um formato antigo"
+            elif previous_info["rules_version"] != info["rules_version"]:
+                self.reason = "a tabela de regras mudou desde o resultado anterior"
+            elif previous_info["key_column"] != info["key_column"]:
+                self.reason = "a coluna-chave é diferente da usada no resultado anterior"
+            elif previous_info["columns"] != info["columns"]:
+                self.reason = "as colunas comparadas são diferentes das do resultado anterior"
+            elif previous_info["revenue_column"] != info["revenue_column"]:
+                self.reason = "a coluna de faturamento é diferente da do resultado anterior"
+        self.applied = self.reason is None
+        if not self.applied:
+            logger.info(f"Comparação com {self.previous_name} não aplicada: {self.reason}")
+            return
+
+        # Uma entrada por hash distinto, com quantas linhas anteriores ainda não
+        # foram pareadas (linhas iguais têm a mesma regra, faturamento e chave)
+        self.hashes, first, self.remaining = np.unique(table.column("hash").to_numpy(), return_index=True, return_counts=True)
+        self.positions = table.column("posicao").to_numpy()[first]
+        self.revenue = table.column("faturamento").to_numpy()[first] if "faturamento" in table.column_names else None
+        self.keys = table.column("chave").to_numpy()[first] if "chave" in table.column_names else None
+        self.unchanged_rows = 0
+        self.added_rows = 0
+        self.added_keys = []
+        self.item_deltas = None
+
+    # Pareia as linhas do lote com as anteriores; retorna a posição conhecida de
+    # cada linha (UNKNOWN_POSITION nas novas) e a máscara das reaproveitadas
+    def match(self, hashes):
+        known_positions = np.full(len(hashes), UNKNOWN_POSITION, dtype=np.int32)
+        reused = np.zeros(len(hashes), dtype=bool)
+        if len(self.hashes):
+            index = np.minimum(np.searchsorted(self.hashes, hashes), len(self.hashes) - 1)
+            found = np.flatnonzero(self.hashes[index] == hashes)
+            found_index = index[found]
+            # A n-ésima repetição de uma linha só é reaproveitada se ainda houver
+            # uma n-ésima linha igual não pareada no resultado anterior
+            rank = pd.Series(found_index).groupby(found_index).cumcount().to_numpy()
+            paired = rank < self.remaining[found_index]
+            np.subtract.at(self.remaining, found_index[paired], 1)
+            reused[found[paired]] = True
+            known_positions[found[paired]] = self.positions[found_index[paired]]
+        self.unchanged_rows += int(reused.sum())
+        return known_positions, reused
+
+    # Soma às métricas apenas as linhas novas do lote (o top de NCMs considera
+    # todas, pois depende das linhas e não dos totais)
+    def update(self, accumulator, batch, reused, keys=None):
+        added = accumulator.group_items(batch[~reused])
+        accumulator.add_item_totals(added)
+        accumulator.update_top(batch)
+        self.item_deltas = added if self.item_deltas is None else self.item_deltas.add(added, fill_value=0)
+        self.added_rows += int((~reused).sum())
+        if keys is not None:
+            self.added_keys.append(keys[~reused])
+
+    # Subtrai das métricas as linhas anteriores que não foram pareadas (removidas)
+    def finish(self, accumulator, compiled_rules):
+        left = self.remaining > 0
+        counts = self.remaining[left]
+        item_labels = np.array([str(item) for item in compiled_rules.item_codes] + ["N/A"], dtype=object)
+        removed = {"count": counts.astype(float)}
+        if self.revenue is not None:
+            removed["revenue"] = self.revenue[left] * counts
+        removed = pd.DataFrame(removed, index=item_labels[self.positions[left]]).groupby(level=0).sum()
+        accumulator.add_item_totals(removed, sign=-1)
+        self.item_deltas = -removed if self.item_deltas is None else self.item_deltas.sub(removed, fill_value=0)
+        self.removed_rows = int(counts.sum())
+
+        # Com coluna-chave, uma linha nova e uma removida com a mesma chave contam
+        # como uma linha alterada
+        self.changed_rows = None
+        if self.keys is not None:
+            added_keys, added_counts = np.unique(np.concatenate(self.added_keys or [np.array([], dtype=np.uint64)]), return_counts=True)
+            removed_keys, removed_counts = np.unique(np.repeat(self.keys[left], counts), return_counts=True)
+            _, added_index, removed_index = np.intersect1d(added_keys, removed_keys, assume_unique=True, return_indices=True)
+            self.changed_rows = int(np.minimum(added_counts[added_index], removed_counts[removed_index]).sum())
+
+    # Resumo da comparação, incluído nas métricas da resposta
+    def summary(self, metrics):
+        if not self.applied:
+            return {"previous_result": self.previous_name, "applied": False, "reason": self.reason}
+        changed_rows = self.changed_rows or 0
+        previous = self.previous_metrics
+        item_deltas = self.item_deltas[(self.item_deltas != 0).any(axis=1)]
+        summary = {
+            "previous_result": self.previous_name,
+            "applied": True,
+            "reason": None,
+            "unchanged_rows": self.unchanged_rows,
+            "added_rows": self.added_rows - changed_rows,
+            "changed_rows": self.changed_rows,
+            "removed_rows": self.removed_rows - changed_rows,
+            "total_ncms_delta": metrics["total_ncms"] - previous["total_ncms"],
+            "matched_ncms_delta": metrics["matched_ncms"] - previous["matched_ncms"],
+            "item_deltas": [
+                {"item_code": item, "count": int(row["count"]), **({"revenue": float(row["revenue"])} if "revenue" in row else {})}
+                for item, row in item_deltas.iterrows()
+            ],
+        }
+        if metrics["has_revenue_data"]:
+            summary["total_revenue_delta"] = metrics["total_revenue"] - previous["total_revenue"]
+            summary["matched_revenue_delta"] = metrics["matched_revenue"] - previous["matched_revenue"]
+        return summary
+
+# Grava o progresso de um job em um arquivo JSON (lido pela rota de status);
+# funciona tanto em processos do pool quanto em threads
+def write_job_progress(progress_path, stage, rows_done, rows_total):
+    tmp_path = progress_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"stage": stage, "rows_done": rows_done, "rows_total": rows_total}, f)
+    os.replace(tmp_path, progress_path)
+
+# Lê, classifica e grava a planilha já gravada em disco. Roda em um processo
+# do pool, por isso recebe e retorna apenas dados serializáveis. O resultado é
+# gravado em output_path (no armazenamento de resultados), cujo formato segue a
+# extensão; com track_rows, junto com o estado das linhas. Com previous (nome,
+# estado das linhas e métricas de um resultado anterior), roda no modo
+# incremental (ver RowChanges)
+def process_spreadsheet(upload_path, input_format, use_streaming, keep_columns, start_time, output_path,
+                        progress_path=None, key_column=None, previous=None, track_rows=False):
+    # O modo incremental compara pelo estado das linhas, então também o grava
+    track_rows = track_rows or previous is not None
+    classified_batches = None
+    stats = ProcessingStats()
+    profiler = start_profiler()
+    try:
+        with stats.stage("leitura"):
+            batches, rows_total = open_input_batches(upload_path, input_format, use_streaming, stats, keep_columns, key_column)
+        logger.info(f"Formato: {input_format}, modo de leitura: {'streaming' if use_streaming else 'em memória'}")
+
+        # Classificar lote a lote, acumulando as métricas incrementalmente. No modo
+        # streaming a leitura acontece a cada lote, por isso é medida no next()
+        renames = revenue_column = accumulator = state_writer = changes = None
+        state_path = output_path + ROW_STATE_SUFFIX
+        partial_state_path = f"{state_path}.tmp-{uuid.uuid4().hex}"
+        rows_done = 0
+        classified_batches = BatchSpool() if use_streaming else []
+        batches = iter(batches)
+        while True:
+            with stats.stage("leitura"):
+                batch = next(batches, None)
+            if batch is None:
+                break
+            with stats.stage("classificacao"):
+                if accumulator is None:
+                    renames, revenue_column = detect_columns(batch)
+                batch = normalize_batch(batch, renames, revenue_column)
+                if accumulator is None:
+                    if key_column is not None and key_column not in batch.columns:
+                        raise SpreadsheetError(400, f"Coluna-chave '{key_column}' não encontrada. Colunas lidas: " + ", ".join(map(str, batch.columns)))
+                    info = {"hash_format": ROW_HASH_FORMAT, "rules_version": rule_index.version,
+                            "columns": hashed_columns(revenue_column, key_column),
+                            "revenue_column": revenue_column, "key_column": key_column}
+                    state_writer = RowStateWriter(partial_state_path, info) if track_rows else None
+                    changes = RowChanges(previous, info) if previous is not None else None
+                    if changes is not None and changes.applied:
+                        accumulator = MetricsAccumulator.from_metrics(revenue_column, previous["metrics"])
+                    else:
+                        accumulator = MetricsAccumulator(revenue_column)
+
+                if state_writer is None:
+                    batch, _ = classify_batch(batch)
+                    accumulator.update(batch)
+                else:
+                    hashes = row_hashes(batch, revenue_column, key_column)
+                    keys = key_hashes(batch, key_column) if key_column is not None else None
+                    if changes is not None and changes.applied:
+                        known_positions, reused = changes.match(hashes)
+                        batch, positions = classify_batch(batch, known_positions)
+                        changes.update(accumulator, batch, reused, keys)
+                    else:
+                        batch, positions = classify_batch(batch)
+                        accumulator.update(batch)
+                    revenue = batch[revenue_column].to_numpy(dtype="float64") if revenue_column is not None else None
+                    state_writer.write_batch(hashes, positions, revenue, keys)
+                classified_batches.append(batch)
+            rows_done += len(batch)
+            if progress_path is not None:
+                write_job_progress(progress_path, "classificando", rows_done, rows_total)
+
+        if changes is not None and changes.applied:
+            changes.finish(accumulator, rule_index)
+        if state_writer is not None:
+            state_writer.close()
+            os.replace(partial_state_path, state_path)
+
+        # Calcular tempo de processamento
+        processing_time = round(time.time() - start_time, 2)
+        metrics = accumulator.metrics()
+        metrics["processing_time"] = float(processing_time)
+        if changes is not None:
+            metrics["incremental"] = changes.summary(metrics)
+        logger.info(f"Processamento concluído em {processing_time} segundos. Total: {metrics['total_ncms']}, Classificados: {metrics['matched_ncms']}")
+
+        # Gerar arquivo de saída, escrevendo os lotes classificados um a um. A gravação
+        # vai para arquivos temporários renomeados ao final, para que um download
+        # nunca veja um resultado pela metade. As linhas exibidas na interface vão
+        # para um arquivo à parte, lido pela rota de paginação
+        if progress_path is not None:
+            write_job_progress(progress_path, "gravando", rows_done, rows_done)
+        return write_spreadsheet_results(classified_batches, output_path, revenue_column, metrics, stats)
+    except SpreadsheetError as e:
+        # Volta ao processo principal junto com a exceção (atributos são serializados)
+        e.engine_failures = stats.engine_failures
+        raise
+    finally:
+        if isinstance(classified_batches, BatchSpool):
+            classified_batches.close()
+        stop_profiler(profiler, "planilha")
+
+# Grava o arquivo de resultado e as linhas da paginação a partir dos lotes
+# classificados e monta a resposta da API (métricas e primeira página de linhas)
+def write_spreadsheet_results(classified_batches, output_path, revenue_column, metrics, stats):
+    output_format = os.path.splitext(output_path)[1].lstrip(".")
+    partial_path = f"{output_path}.tmp-{uuid.uuid4().hex}"
+    rows_path = output_path + ".rows"
+    partial_rows_path = f"{rows_path}.tmp-{uuid.uuid4().hex}"
+    with stats.stage("escrita"):
+        writer = RESULT_WRITERS[output_format](partial_path, revenue_column, metrics.get("total_revenue", 0))
+        rows_writer = ResultRowsWriter(partial_rows_path, revenue_column)
+        for batch in classified_batches:
+            writer.write_batch(batch)
+            rows_writer.write_batch(batch)
+        # O resumo registra a escrita até este ponto (sem a gravação final do arquivo)
+        metrics["stages"] = stats.stage_seconds()
+        writer.close(metrics)
+        rows_writer.close()
+        os.replace(partial_path, output_path)
+        os.replace(partial_rows_path, rows_path)
+    metrics["stages"] = stats.stage_seconds()
+
+    first_page = read_result_page(rows_path, 1, RESULTS_PAGE_SIZE)
+    return {
+        "results": first_page["results"],
+        "pagination": first_page["pagination"],
+        "output_file": os.path.basename(output_path),
+        "metrics": metrics,
+        "planilha_tipo": 2 if revenue_column is not None else 1,
+        "rules_version": rule_index.version,
+        "telemetry": {"engine_failures": stats.engine_failures},
+    }
+
+# Colunas que identificam a origem de cada linha no resultado consolidado de um lote
+BATCH_ORIGIN_COLUMNS = ('Arquivo', 'Aba')
+
+# Nome comum da coluna de faturamento no resultado consolidado (cada arquivo
+# pode usar um nome diferente)
+BATCH_REVENUE_COLUMN = 'Faturamento'
+
+# Limites de um lote inteiro: número de arquivos (contando os de dentro de todos
+# os .zip) e tamanho total descompactado de todos os .zip (ver check_batch_limits)
+BATCH_MAX_FILES = int(os.environ.get("NCM_BATCH_MAX_FILES", "50"))
+BATCH_MAX_UNZIPPED_BYTES = int(os.environ.get("NCM_BATCH_MAX_UNZIPPED_BYTES", str(512 * 1024 * 1024)))
+
+# Formatos aceitos em um lote: os de /classify-excel e arquivos .zip com eles
+BATCH_INPUT_FORMATS = {**INPUT_FORMATS, ".zip": "zip"}
+
+def batch_input_format_for(filename):
+    return BATCH_INPUT_FORMATS.get(os.path.splitext(filename or "")[1].lower())
+
+# Padroniza uma aba ou arquivo do lote: NCM, descrição e faturamento com os
+# mesmos nomes e tipos em todas as origens, para que possam ser gravados em
+# Parquet (colunas de texto com valores mistos viram texto) e concatenados
+def batch_source(df, file_label, sheet):
+    renames, revenue_column = detect_columns(df)
+    if revenue_column is not None:
+        renames = {**renames, revenue_column: BATCH_REVENUE_COLUMN}
+    df = normalize_batch(df, renames, BATCH_REVENUE_COLUMN if revenue_column is not None else None)
+    df["Descrição do Produto"] = df["Descrição do Produto"].astype(str)
+    columns = [col for col in ("NCM", "Descrição do Produto", BATCH_REVENUE_COLUMN) if col in df.columns]
+    return {"file": file_label, "sheet": sheet, "data": df[columns], "has_revenue": revenue_column is not None}
+
+# Lê todas as abas de uma planilha com uma engine, cada uma apenas com as
+# colunas usadas. Abas sem coluna de NCM (notas, totais...) são ignoradas
+def read_workbook_sheets(path, engine, file_label):
+    sources, ignored = [], []
+    with pd.ExcelFile(path, engine=engine) as workbook:
+        for sheet in workbook.sheet_names:
+            sample = workbook.parse(sheet, nrows=INPUT_SAMPLE_ROWS)
+            if sample.columns.empty:
+                ignored.append({"file": file_label, "sheet": str(sheet), "reason": "Aba vazia."})
+                continue
+            try:
+                positions, ncm_column = select_input_columns(sample, False)
+            except SpreadsheetError as e:
+                ignored.append({"file": file_label, "sheet": str(sheet), "reason": e.detail})
+                continue
+            df = workbook.parse(sheet, usecols=positions, dtype={ncm_column: str})
+            sources.append(batch_source(df, file_label, str(sheet)))
+    return sources, ignored
+
+# Lê um arquivo do lote (todas as abas de uma planilha, um CSV/Parquet ou o
+# conteúdo de um .zip). Roda no pool de planilhas, um arquivo por tarefa. Cada
+# origem lida é gravada em um Parquet temporário: volta ao processo principal só
+# o caminho (não o DataFrame), junto com as origens ignoradas e o tempo de leitura
+def read_batch_file(path, input_format, file_label):
+    stats = ProcessingStats()
+    with stats.stage("leitura"):
+        if input_format == "zip":
+            sources, ignored = read_batch_archive(path, file_label, stats)
+        else:
+            sources, ignored = read_batch_input(path, input_format, file_label, stats)
+    spilled = []
+    try:
+        for source in sources:
+            data = source.pop("data")
+            with tempfile.NamedTemporaryFile(prefix="ncm-lote-", suffix=".parquet", delete=False) as tmp:
+                spilled.append({**source, "path": tmp.name})
+            data.to_parquet(tmp.name, index=False)
+    except BaseException:
+        remove_batch_spills([{"sources": spilled}])
+        raise
+    return {"sources": spilled, "ignored": ignored, "stats": stats}
+
+# Remove os Parquet temporários das origens lidas de um lote
+def remove_batch_spills(read_results):
+    for result in read_results:
+        for source in result["sources"]:
+            if os.path.exists(source["path"]):
+                os.remove(source["path"])
+
+def read_batch_input(path, input_format, file_label, stats):
+    if input_format in EXCEL_ENGINES:
+        engines = (["calamine"] if USE_CALAMINE else []) + [EXCEL_ENGINES[input_format]]
+        for engine in engines:
+            try:
+                return read_workbook_sheets(path, engine, file_label)
+            except Exception as e:
+                stats.engine_failed(engine)
+                logger.warning(f"Erro ao ler {file_label} com {engine}: {str(e)}")
+                error = f"Não foi possível ler o arquivo Excel: {str(e)}"
+        return [], [{"file": file_label, "sheet": None, "reason": error}]
+
+    reader = read_csv_batches if input_format == "csv" else read_parquet_batches
+    try:
+        df = pd.concat(list(reader(path)), ignore_index=True)
+    except SpreadsheetError as e:
+        return [], [{"file": file_label, "sheet": None, "reason": e.detail}]
+    except ValueError:
+        return [], [{"file": file_label, "sheet": None, "reason": "Arquivo vazio."}]
+    return [batch_source(df, file_label, None)], []
+
+# Arquivos de um .zip considerados no lote (sem diretórios e arquivos ocultos)
+def batch_archive_entries(archive):
+    return [
+        info for info in archive.infolist()
+        if not info.is_dir() and not os.path.basename(info.filename).startswith(".")
+        and not info.filename.startswith("__MACOSX/")
+    ]
+
+# Aplica os limites ao lote inteiro antes de qualquer leitura, somando os
+# arquivos e o tamanho declarado (lido do diretório central, sem descompactar)
+# de todos os .zip. O tamanho declarado é o limite lido de cada arquivo pelo
+# zipfile. Um .zip inválido não conta aqui; ele é reportado na leitura
+def check_batch_limits(upload_paths, input_formats):
+    total_files = total_unzipped = 0
+    for path, input_format in zip(upload_paths, input_formats):
+        if input_format != "zip":
+            total_files += 1
+            continue
+        try:
+            with zipfile.ZipFile(path) as archive:
+                entries = batch_archive_entries(archive)
+        except zipfile.BadZipFile:
+            continue
+        total_files += len(entries)
+        total_unzipped += sum(info.file_size for info in entries)
+        if total_files > BATCH_MAX_FILES:
+            raise HTTPException(status_code=413, detail=f"O lote contém mais de {BATCH_MAX_FILES} arquivos (contando os de dentro dos .zip).")
+        if total_unzipped > BATCH_MAX_UNZIPPED_BYTES:
+            raise HTTPException(status_code=413, detail=f"O conteúdo descompactado do lote excede o limite de {BATCH_MAX_UNZIPPED_BYTES} bytes.")
+    if total_files > BATCH_MAX_FILES:
+        raise HTTPException(status_code=413, detail=f"O lote contém mais de {BATCH_MAX_FILES} arquivos (contando os de dentro dos .zip).")
+
+# Lê os arquivos aceitos de dentro de um .zip, extraindo um de cada vez (os
+# limites já foram verificados para o lote inteiro em check_batch_limits)
+def read_batch_archive(path, file_label, stats):
+    try:
+        archive = zipfile.ZipFile(path)
+    except zipfile.BadZipFile:
+        return [], [{"file": file_label, "sheet": None, "reason": "Arquivo .zip inválido."}]
+
+    sources, ignored = [], []
+    with archive:
+        for info in batch_archive_entries(archive):
+            entry_label = f"{file_label}/{info.filename}"
+            entry_format = input_format_for(info.filename)
+            if entry_format is None:
+                ignored.append({"file": entry_label, "sheet": None, "reason": "Formato não suportado."})
+                continue
+            with tempfile.NamedTemporaryFile(suffix=os.path.splitext(info.filename)[1], delete=False) as tmp:
+                with archive.open(info) as entry:
+                    shutil.copyfileobj(entry, tmp, UPLOAD_CHUNK_SIZE)
+            try:
+                if entry_format in EXCEL_ENGINES:
+                    entry_format = sniff_excel_format(tmp.name)
+                    if entry_format is None:
+                        ignored.append({"file": entry_label, "sheet": None, "reason": "O conteúdo não é um .xlsx nem um .xls válido."})
+                        continue
+                entry_sources, entry_ignored = read_batch_input(tmp.name, entry_format, entry_label, stats)
+                sources.extend(entry_sources)
+                ignored.extend(entry_ignored)
+            finally:
+                os.remove(tmp.name)
+    return sources, ignored
+
+# Consolida as origens lidas de um lote: todos os códigos são classificados de
+# uma vez (cada código distinto uma única vez, mesmo repetido entre arquivos e
+# abas) e o resultado é um único arquivo, com métricas gerais, por arquivo e por aba
+def process_batch(read_results, start_time, output_path):
+    stats = ProcessingStats()
+    profiler = start_profiler()
+    try:
+        sources, ignored = [], []
+        for result in read_results:
+            sources.extend(result["sources"])
+            ignored.extend(result["ignored"])
+            for name, seconds in result["stats"].stages.items():
+                stats.stages[name] = stats.stages.get(name, 0.0) + seconds
+            for engine, failures in result["stats"].engine_failures.items():
+                stats.engine_failures[engine] = stats.engine_failures.get(engine, 0) + failures
+        if not sources:
+            reasons = "; ".join(f"{item['file']}: {item['reason']}" for item in ignored)
+            raise SpreadsheetError(400, f"Nenhuma planilha do lote pôde ser classificada. {reasons}")
+
+        with stats.stage("classificacao"):
+            revenue_column = BATCH_REVENUE_COLUMN if any(source["has_revenue"] for source in sources) else None
+            combined = pd.concat(
+                [pd.read_parquet(source["path"]).assign(Arquivo=source["file"], Aba=source["sheet"] or "") for source in sources],
+                ignore_index=True,
+            )
+            for column in BATCH_ORIGIN_COLUMNS:
+                combined[column] = combined[column].astype("category")
+            combined = prepare_batch(combined, {}, revenue_column)
+            accumulator = MetricsAccumulator(revenue_column)
+            accumulator.update(combined)
+
+        processing_time = round(time.time() - start_time, 2)
+        metrics = accumulator.metrics()
+        metrics["processing_time"] = float(processing_time)
+        metrics["sources"] = origin_breakdown(combined, revenue_column, list(BATCH_ORIGIN_COLUMNS))
+        metrics["files"] = origin_breakdown(combined, revenue_column, ["Arquivo"])
+        metrics["ignored_sources"] = ignored
+        logger.info(f"Lote processado em {processing_time} segundos: {len(sources)} abas/arquivos, {metrics['total_ncms']} NCMs")
+        return write_spreadsheet_results([combined], output_path, revenue_column, metrics, stats)
+    except SpreadsheetError as e:
+        e.engine_failures = stats.engine_failures
+        raise
+    finally:
+        stop_profiler(profiler, "lote")
+
+# Contagens e faturamento por origem (arquivo, ou arquivo e aba), na ordem do lote
+def origin_breakdown(df, revenue_column, columns):
+    aggregations = {"total_ncms": ('Enquadrado', 'size'), "matched_ncms": ('Enquadrado', 'sum')}
+    if revenue_column is not None:
+        df = df.assign(_matched_revenue=df[revenue_column].where(df['Enquadrado'], 0))
+        aggregations["total_revenue"] = (revenue_column, 'sum')
+        aggregations["matched_revenue"] = ('_matched_revenue', 'sum')
+    grouped = df.groupby(columns, observed=True, sort=False).agg(**aggregations)
+
+    breakdown = []
+    for key, row in grouped.iterrows():
+        key = key if isinstance(key, tuple) else (key,)
+        total_ncms = int(row["total_ncms"])
+        item = {"file": key[0]}
+        if len(key) > 1:
+            item["sheet"] = key[1] or None
+        item.update({
+            "total_ncms": total_ncms,
+            "matched_ncms": int(row["matched_ncms"]),
+            "percentage": round(int(row["matched_ncms"]) / total_ncms * 100, 2) if total_ncms > 0 else 0,
+        })
+        if revenue_column is not None:
+            item["total_revenue"] = float(row["total_revenue"])
+            item["matched_revenue"] = float(row["matched_revenue"])
+        breakdown.append(item)
+    return breakdown
+
+# Registra no processo principal as métricas de uma planilha processada; retira da
+# resposta os dados internos de telemetria
+def record_spreadsheet_metrics(response_data):
+    telemetry = response_data.pop("telemetry")
+    for engine, failures in telemetry["engine_failures"].items():
+        EXCEL_ENGINE_FAILURES.inc(failures, engine=engine)
+    for stage, seconds in response_data["metrics"]["stages"].items():
+        SPREADSHEET_STAGE_SECONDS.observe(seconds, stage=stage)
+    ROWS_CLASSIFIED.inc(response_data["metrics"]["total_ncms"], source="planilha")
+    incremental = response_data["metrics"].get("incremental")
+    if incremental is not None and incremental["applied"]:
+        for status in ("unchanged", "added", "changed", "removed"):
+            INCREMENTAL_ROWS.inc(incremental[f"{status}_rows"] or 0, status=status)
+    RESULT_BYTES.inc(os.path.getsize(result_store.path(response_data["output_file"])))
+
+# Guarda a resposta para reaproveitamento. Se as regras foram trocadas enquanto a
+# planilha era processada, o resultado não corresponde à versão do nome e não é guardado
+def store_result(output_name, rules_version, response_data):
+    if response_data["rules_version"] == rules_version:
+        result_store.save(output_name, response_data)
+    else:
+        logger.info(f"Regras atualizadas durante o processamento de {output_name}; resultado não será reaproveitado")
+
+# O modo streaming lê .xlsx linha a linha; .xls continua sendo lido inteiro.
+# CSV e Parquet são sempre lidos em lotes
+def should_stream(input_format, upload_size, streaming):
+    if input_format in ("csv", "parquet"):
+        return True
+    return input_format == "xlsx" and (streaming or upload_size > STREAMING_THRESHOLD_BYTES)
+
+# Resultado anterior usado como base do modo incremental: precisa existir, não ter
+# expirado e ter o estado das linhas (gravado só quando pedido; lotes não têm)
+def load_previous_result(previous):
+    cached = result_store.lookup(previous)
+    if cached is None:
+        raise HTTPException(status_code=404, detail=f"Resultado anterior não encontrado ou expirado: {previous}.")
+    state_path = result_store.resolve(previous + ROW_STATE_SUFFIX)
+    if state_path is None:
+        raise HTTPException(
+            status_code=409,
+            detail=f"O resultado {previous} não guardou o estado das linhas; envie a planilha base com incremental=true ou key_column.",
+        )
+    return {"name": previous, "state_path": state_path, "metrics": cached["metrics"]}
+
+# O estado das linhas (hash e regra de cada linha) só é calculado e gravado
+# quando o upload pode servir de base para outro: com incremental=true, com
+# coluna-chave ou quando ele próprio é incremental
+def should_track_rows(incremental, key_column, previous):
+    return incremental or key_column is not None or previous is not None
+
+# Valida a extensão do upload e o formato de saída pedido
+def validate_upload(filename, output_format):
+    input_format = input_format_for(filename)
+    if input_format is None:
+        raise HTTPException(status_code=400, detail="Apenas arquivos Excel (.xlsx ou .xls), CSV (.csv) ou Parquet (.parquet) são aceitos.")
+    if output_format not in OUTPUT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Formato de saída inválido: {output_format}. Use um de: {', '.join(OUTPUT_FORMATS)}.")
+    return input_format
+
+# Rota para processar a planilha Excel. Com incremental=true, o resultado guarda o
+# estado das linhas e pode servir de base depois. Com previous (output_file de um
+# resultado assim), só as linhas novas ou alteradas são classificadas e a resposta
+# traz a comparação em metrics["incremental"]; key_column identifica linhas alteradas
+@spreadsheet_routes.post("/classify-excel")
+async def classify_excel(file: UploadFile = File(...), streaming: bool = False, output_format: str = "xlsx", keep_columns: bool = False,
+                         incremental: bool = False, previous: str | None = None, key_column: str | None = None):
+    upload_path = None
+    try:
+        start_time = time.time()
+
+        input_format = validate_upload(file.filename, output_format)
+        previous_result = load_previous_result(previous) if previous is not None else None
+
+        upload_path, upload_size, upload_digest = await spool_upload(file, os.path.splitext(file.filename)[1])
+
+        # Log para debug
+        logger.info(f"Recebido arquivo: {file.filename}, tamanho: {upload_size} bytes")
+        input_format = detect_upload_format(upload_path, input_format)
+
+        # Mesmo conteúdo e mesmo formato de saída: devolve o resultado já calculado
+        rules_version = rule_index.version
+        track_rows = should_track_rows(incremental, key_column, previous)
+        output_name = ResultStore.result_name(upload_digest, input_format, output_format, rules_version, keep_columns,
+                                              key_column, previous, track_rows)
+        cached = result_store.lookup(output_name)
+        RESULT_CACHE_LOOKUPS.inc(result="hit" if cached is not None else "miss")
+        if cached is not None:
+            logger.info(f"Resultado reaproveitado para {file.filename}: {output_name}")
+            return FastJSONResponse({**cached, "cached": True})
+
+        use_streaming = should_stream(input_format, upload_size, streaming)
+
+        # Leitura, classificação e escrita rodam no pool, sem bloquear o event loop
+        acquire_spreadsheet_slot()
+        response_data = await run_spreadsheet_task(
+            process_spreadsheet, upload_path, input_format, use_streaming, keep_columns, start_time, result_store.path(output_name),
+            None, key_column, previous_result, track_rows
+        )
+        record_spreadsheet_metrics(response_data)
+        store_result(output_name, rules_version, response_data)
+
+        logger.info("Enviando resposta com métricas: " + str(response_data["metrics"]))
+        return FastJSONResponse(response_data)
+
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Erro ao processar a planilha: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Erro ao processar a planilha: {str(e)}")
+    finally:
+        if upload_path is not None and os.path.exists(upload_path):
+            os.remove(upload_path)
+
+# Rota para classificar vários arquivos (e/ou .zip) de uma vez, com todas as
+# abas de cada planilha, gerando um único resultado consolidado. Os arquivos são
+# lidos em paralelo no pool de planilhas, que grava cada origem em um Parquet
+# temporário; a classificação lê esses arquivos e classifica tudo junto ao final
+@spreadsheet_routes.post("/classify-excel/batch")
+async def classify_excel_batch(files: list[UploadFile] = File(...), output_format: str = "xlsx"):
+    if len(files) > BATCH_MAX_FILES:
+        raise HTTPException(status_code=413, detail=f"Envie no máximo {BATCH_MAX_FILES} arquivos por lote.")
+    if output_format not in OUTPUT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Formato de saída inválido: {output_format}. Use um de: {', '.join(OUTPUT_FORMATS)}.")
+    input_formats = [batch_input_format_for(file.filename) for file in files]
+    unsupported = [file.filename for file, input_format in zip(files, input_formats) if input_format is None]
+    if unsupported:
+        raise HTTPException(status_code=400, detail=f"Formato não suportado: {', '.join(unsupported)}. Envie planilhas Excel, CSV, Parquet ou arquivos .zip com elas.")
+
+    upload_paths = []
+    read_results = []
+    slot_reserved = False
+    try:
+        start_time = time.time()
+        batch_digest = hashlib.sha256()
+        for file, input_format in zip(files, input_formats):
+            upload_path, upload_size, upload_digest = await spool_upload(file, os.path.splitext(file.filename)[1])
+            upload_paths.append(upload_path)
+            batch_digest.update(f"{file.filename}:{upload_digest}\n".encode())
+        input_formats = [detect_upload_format(path, input_format) for path, input_format in zip(upload_paths, input_formats)]
+        check_batch_limits(upload_paths, input_formats)
+        logger.info(f"Lote recebido: {len(files)} arquivos")
+
+        rules_version = rule_index.version
+        output_name = ResultStore.result_name(batch_digest.hexdigest(), "lote", output_format, rules_version)
+        cached = result_store.lookup(output_name)
+        RESULT_CACHE_LOOKUPS.inc(result="hit" if cached is not None else "miss")
+        if cached is not None:
+            logger.info(f"Resultado reaproveitado para o lote: {output_name}")
+            return FastJSONResponse({**cached, "cached": True})
+
+        # O lote ocupa uma vaga na fila; as leituras usam o mesmo pool sem reservar outras
+        acquire_spreadsheet_slot()
+        slot_reserved = True
+        labels = [os.path.basename(file.filename) for file in files]
+        outcomes = await asyncio.gather(*(
+            run_spreadsheet_task(read_batch_file, path, input_format, label, release_slot=False)
+            for path, input_format, label in zip(upload_paths, input_formats, labels)
+        ), return_exceptions=True)
+        read_results = [outcome for outcome in outcomes if not isinstance(outcome, BaseException)]
+        for outcome in outcomes:
+            if isinstance(outcome, BaseException):
+                raise outcome
+        slot_reserved = False
+        response_data = await run_spreadsheet_task(process_batch, read_results, start_time, result_store.path(output_name))
+        record_spreadsheet_metrics(response_data)
+        store_result(output_name, rules_version, response_data)
+        return FastJSONResponse(response_data)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Erro ao processar o lote: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Erro ao processar o lote: {str(e)}")
+    finally:
+        if slot_reserved:
+            release_spreadsheet_slot()
+        remove_batch_spills(read_results)
+        for upload_path in upload_paths:
+            if os.path.exists(upload_path):
+                os.remove(upload_path)
+
+# Jobs finalizados ficam disponíveis para consulta por este tempo (segundos)
+JOB_TTL_SECONDS = int(os.environ.get("NCM_JOB_TTL_SECONDS", "3600"))
+
+# Jobs de classificação em segundo plano, indexados pelo id
+jobs = {}
+job_tasks = set()
+
+# Remove da memória os jobs finalizados há mais de JOB_TTL_SECONDS
+def prune_jobs():
+    now = time.time()
+    expired = [job_id for job_id, job in jobs.items()
+               if job["finished_at"] is not None and now - job["finished_at"] > JOB_TTL_SECONDS]
+    for job_id in expired:
+        del jobs[job_id]
+
+# Processa a planilha de um job em segundo plano e registra o resultado
+async def run_job(job, upload_path, input_format, use_streaming, keep_columns, output_name, rules_version,
+                  key_column=None, previous_result=None, track_rows=False):
+    job["status"] = "processing"
+    try:
+        response_data = await run_spreadsheet_task(
+            process_spreadsheet, upload_path, input_format, use_streaming, keep_columns, job["created_at"],
+            result_store.path(output_name), job["progress_path"], key_column, previous_result, track_rows
+        )
+        record_spreadsheet_metrics(response_data)
+        store_result(output_name, rules_version, response_data)
+        complete_job(job, response_data)
+    except HTTPException as e:
+        job["status"] = "failed"
+        job["error"] = e.detail
+    except Exception as e:
+        logger.error(f"Erro ao processar a planilha do job {job['job_id']}: {str(e)}", exc_info=True)
+        job["status"] = "failed"
+        job["error"] = f"Erro ao processar a planilha: {str(e)}"
+    finally:
+        job["finished_at"] = time.time()
+        job["progress"] = read_job_progress(job)
+        for path in (upload_path, job["progress_path"]):
+            if os.path.exists(path):
+                os.remove(path)
+
+# Registra no job o resultado de uma classificação concluída
+def complete_job(job, response_data):
+    job["metrics"] = response_data["metrics"]
+    job["output_file"] = response_data["output_file"]
+    job["planilha_tipo"] = response_data["planilha_tipo"]
+    job["status"] = "completed"
+
+# Lê o último progresso registrado pelo processo que executa o job
+def read_job_progress(job):
+    try:
+        with open(job["progress_path"], encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return job["progress"]
+
+# Rota para enviar uma planilha para processamento em segundo plano
+@spreadsheet_routes.post("/classify-excel/jobs", status_code=202)
+async def create_classification_job(file: UploadFile = File(...), streaming: bool = False, output_format: str = "xlsx", keep_columns: bool = False,
+                                    incremental: bool = False, previous: str | None = None, key_column: str | None = None):
+    input_format = validate_upload(file.filename, output_format)
+    previous_result = load_previous_result(previous) if previous is not None else None
+
+    prune_jobs()
+    acquire_spreadsheet_slot()
+    upload_path = None
+    try:
+        upload_path, upload_size, upload_digest = await spool_upload(file, os.path.splitext(file.filename)[1])
+        input_format = detect_upload_format(upload_path, input_format)
+    except Exception:
+        release_spreadsheet_slot()
+        if upload_path is not None and os.path.exists(upload_path):
+            os.remove(upload_path)
+        raise
+    logger.info(f"Job recebido: {file.filename}, tamanho: {upload_size} bytes")
+    rules_version = rule_index.version
+    track_rows = should_track_rows(incremental, key_column, previous)
+    output_name = ResultStore.result_name(upload_digest, input_format, output_format, rules_version, keep_columns,
+                                          key_column, previous, track_rows)
+    cached = result_store.lookup(output_name)
+    RESULT_CACHE_LOOKUPS.inc(result="hit" if cached is not None else "miss")
+
+    job_id = uuid.uuid4().hex
+    job = {
+        "job_id": job_id,
+        "filename": file.filename,
+        "status": "queued",
+        "created_at": time.time(),
+        "finished_at": None,
+        "progress": {"stage": "na fila", "rows_done": 0, "rows_total": None},
+        "progress_path": os.path.join(tempfile.gettempdir(), f"ncm-job-{job_id}.json"),
+        "metrics": None,
+        "output_file": None,
+        "planilha_tipo": None,
+        "error": None,
+    }
+    jobs[job_id] = job
+
+    # Upload já classificado antes: o job nasce concluído, sem ocupar o pool
+    if cached is not None:
+        release_spreadsheet_slot()
+        os.remove(upload_path)
+        complete_job(job, cached)
+        rows_total = cached["metrics"]["total_ncms"]
+        job["progress"] = {"stage": "reaproveitado", "rows_done": rows_total, "rows_total": rows_total}
+        job["finished_at"] = time.time()
+        return {"job_id": job_id, "status": job["status"]}
+
+    use_streaming = should_stream(input_format, upload_size, streaming)
+    task = asyncio.create_task(run_job(job, upload_path, input_format, use_streaming, keep_columns, output_name, rules_version,
+                                       key_column, previous_result, track_rows))
+    job_tasks.add(task)
+    task.add_done_callback(job_tasks.discard)
+
+    return {"job_id": job_id, "status": job["status"]}
+
+# Rota para consultar status, progresso e métricas de um job
+@spreadsheet_routes.get("/jobs/{job_id}")
+async def get_classification_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job não encontrado.")
+
+    progress = read_job_progress(job) if job["finished_at"] is None else job["progress"]
+    rows_total = progress.get("rows_total")
+    return {
+        "job_id": job_id,
+        "filename": job["filename"],
+        "status": job["status"],
+        "progress": {
+            **progress,
+            "percentage": round(progress["rows_done"] / rows_total * 100, 2) if rows_total else None,
+        },
+        "metrics": job["metrics"],
+        "output_file": job["output_file"],
+        "download_url": f"/download/{job['output_file']}" if job["output_file"] else None,
+        "planilha_tipo": job["planilha_tipo"],
+        "error": job["error"],
+    }
+
+# Rota para paginar as linhas de um resultado já processado, com filtros opcionais
+# por status (enquadrado=true/false) e por código do item (item=6, item=N/A). O
+# item não é validado contra as regras atuais: o resultado pode ter sido gerado com
+# outra versão delas, e um item que não aparece no resultado dá uma página vazia
+@spreadsheet_routes.get("/results/{filename}")
+async def get_result_page(filename: str, page: int = 1, page_size: int = RESULTS_PAGE_SIZE,
+                          enquadrado: bool | None = None, item: str | None = None):
+    file_path = result_store.resolve(filename)
+    rows_path = file_path + ".rows" if file_path is not None else None
+    if rows_path is None or not os.path.exists(rows_path):
+        raise HTTPException(status_code=404, detail="Resultado não encontrado.")
+    if page < 1 or not 1 <= page_size <= RESULTS_MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"Use page >= 1 e page_size entre 1 e {RESULTS_MAX_PAGE_SIZE}.")
+
+    result_page = await asyncio.to_thread(read_result_page, rows_path, page, page_size, enquadrado, item)
+    return FastJSONResponse({
+        "output_file": filename,
+        "filters": {"enquadrado": enquadrado, "item": item},
+        **result_page,
+    })
 
 # Rota para download da planilha processada
-@app.get("/download/{filename}")
-async def download_file(filename: str):
-    file_path = os.path.join(tempfile.gettempdir(), filename)
-    if os.path.exists(file_path):
-        return FileResponse(file_path, media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', filename="classificacao_ncm.xlsx")
-    raise HTTPException(status_code=404, detail="Arquivo não encontrado.")
+DOWNLOAD_MEDIA_TYPES = {
+    ".xlsx": 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    ".csv": 'text/csv',
+    ".parquet": 'application/vnd.apache.parquet',
+    ".csv.gz": 'application/gzip',
+}
+
+# Extensão de download do arquivo (considera a extensão dupla .csv.gz)
+def download_extension(filename):
+    filename = filename.lower()
+    return next((extension for extension in DOWNLOAD_MEDIA_TYPES if filename.endswith(extension)), None)
+
+# Converte um resultado (.xlsx, .csv ou .parquet) em CSV compactado com gzip,
+# no mesmo layout do CsvResultWriter (percentual de 0 a 100). Roda no pool de planilhas
+def export_gzip_csv(source_path, target_path):
+    partial_path = f"{target_path}.tmp-{uuid.uuid4().hex}"
+    extension = download_extension(source_path)
+    with gzip.open(partial_path, "wt", encoding="utf-8-sig", newline="") as target:
+        if extension == ".csv":
+            with open(source_path, encoding="utf-8-sig", newline="") as source:
+                shutil.copyfileobj(source, target, UPLOAD_CHUNK_SIZE)
+        elif extension == ".parquet":
+            import pyarrow.parquet as pq
+            for i, record_batch in enumerate(pq.ParquetFile(source_path).iter_batches(batch_size=STREAMING_BATCH_ROWS)):
+                record_batch.to_pandas().to_csv(target, index=False, header=i == 0)
+        else:
+            workbook = openpyxl.load_workbook(source_path, read_only=True)
+            try:
+                writer = csv.writer(target)
+                rows = workbook['Classificação NCM'].iter_rows(values_only=True)
+                header = next(rows, None)
+                if header is not None:
+                    writer.writerow(header)
+                    percentage_position = header.index('Percentual do Faturamento') if 'Percentual do Faturamento' in header else None
+                    for row in rows:
+                        if percentage_position is not None and row[percentage_position] is not None:
+                            row = list(row)
+                            row[percentage_position] *= 100
+                        writer.writerow(row)
+            finally:
+                workbook.close()
+    os.replace(partial_path, target_path)
+
+# Responde 304 quando o cliente já tem a versão atual do arquivo (If-None-Match / If-Modified-Since)
+def is_not_modified(request, response, stat):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or response.headers["etag"] in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            return int(stat.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+# Downloads com ETag/Last-Modified (revalidados a cada uso, respondendo 304 quando
+# nada mudou) e suporte a Range para retomar downloads grandes. Com csv_gzip=true,
+# entrega o mesmo resultado como CSV compactado (gerado uma vez e guardado no armazenamento)
+@spreadsheet_routes.get("/download/{filename}")
+async def download_file(filename: str, request: Request, csv_gzip: bool = False):
+    file_path = result_store.resolve(filename)
+    extension = download_extension(filename)
+    if extension is None or file_path is None:
+        raise HTTPException(status_code=404, detail="Arquivo não encontrado.")
+
+    if csv_gzip and extension != ".csv.gz":
+        gzip_name = filename[:-len(extension)] + ".csv.gz"
+        gzip_path = result_store.resolve(gzip_name)
+        if gzip_path is None:
+            acquire_spreadsheet_slot()
+            await run_spreadsheet_task(export_gzip_csv, file_path, result_store.path(gzip_name))
+            result_store.evict()
+            gzip_path = result_store.path(gzip_name)
+        file_path, extension = gzip_path, ".csv.gz"
+
+    stat = os.stat(file_path)
+    response = FileResponse(
+        file_path,
+        media_type=DOWNLOAD_MEDIA_TYPES[extension],
+        filename=f"classificacao_ncm{extension}",
+        stat_result=stat,
+        headers={"Cache-Control": "private, no-cache"},
+    )
+    if is_not_modified(request, response, stat):
+        return Response(status_code=304, headers={
+            key: response.headers[key] for key in ("etag", "last-modified", "cache-control")
+        })
+    return response
+
+# Valores lidos de outras estruturas no momento da coleta de /metrics
+def collect_runtime_metrics():
+    info = resolve_code.cache_info()
+    CODE_CACHE.set(info.hits, result="hit")
+    CODE_CACHE.set(info.misses, result="miss")
+    CODE_CACHE_ENTRIES.set(info.currsize)
+    SPREADSHEETS_PENDING.set(pending_spreadsheets)
+    JOBS.series.clear()
+    for job in jobs.values():
+        JOBS.inc(status=job["status"])
+    RULES_INFO.series.clear()
+    RULES_INFO.set(1, version=rule_index.version)
+
+CODE_CACHE = metrics_registry.add("gauge", "ncm_code_cache_lookups", "Consultas ao cache de códigos desde a última limpeza (hit/miss)")
+CODE_CACHE_ENTRIES = metrics_registry.add("gauge", "ncm_code_cache_entries", "Códigos no cache de classificação")
+SPREADSHEETS_PENDING = metrics_registry.add("gauge", "ncm_spreadsheets_pending", "Planilhas em processamento ou na fila")
+JOBS = metrics_registry.add("gauge", "ncm_jobs", "Jobs em memória, por status")
+RULES_INFO = metrics_registry.add("gauge", "ncm_rules_info", "Versão da tabela de regras em uso")
+metrics_registry.collectors.append(collect_runtime_metrics)
+
+# Rota com as métricas no formato texto do Prometheus
+@app.get("/metrics")
+async def prometheus_metrics():
+    return Response(metrics_registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# Rotas de planilhas e frontend só no modo completo (depois de todas as definições)
+if SERVICE_MODE == "completo":
+    app.include_router(spreadsheet_routes)
 
 # Iniciar o servidor com o comando: uvicorn main:app --reload
\ No newline at end of file
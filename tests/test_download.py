@@ -0,0 +1,94 @@
+import gzip
+import os
+import tempfile
+from email.utils import formatdate
+
+os.environ.setdefault("NCM_SPREADSHEET_WORKERS", "0")
+os.environ.setdefault("NCM_RESULTS_DIR", tempfile.mkdtemp(prefix="ncm-resultados-teste-"))
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+client = TestClient(main.app)
+
+
+@pytest.fixture(scope="module")
+def output_file():
+    rows = "".join(f"{code},produto {index},{index}\n" for index, code in enumerate(["3101.00.00", "8473.30.49", "3004.90.99"] * 50))
+    content = ("NCM,Produto,Faturamento\n" + rows).encode()
+    response = client.post("/classify-excel", params={"output_format": "csv"}, files={"file": ("planilha.csv", content)})
+    assert response.status_code == 200, response.text
+    return response.json()["output_file"]
+
+
+def stored_bytes(name):
+    with open(main.result_store.path(name), "rb") as f:
+        return f.read()
+
+
+def test_download_sends_validators(output_file):
+    response = client.get(f"/download/{output_file}")
+    assert response.status_code == 200
+    assert response.content == stored_bytes(output_file)
+    assert response.headers["etag"] and response.headers["last-modified"]
+    assert response.headers["accept-ranges"] == "bytes"
+
+
+@pytest.mark.parametrize("header", ["{etag}", "W/{etag}", '"outro", {etag}', "*"])
+def test_matching_etag_is_not_modified(output_file, header):
+    etag = client.get(f"/download/{output_file}").headers["etag"]
+    response = client.get(f"/download/{output_file}", headers={"If-None-Match": header.format(etag=etag)})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == etag
+
+
+def test_changed_etag_downloads_again(output_file):
+    response = client.get(f"/download/{output_file}", headers={"If-None-Match": '"outro"'})
+    assert response.status_code == 200
+    assert response.content == stored_bytes(output_file)
+
+
+def test_if_modified_since(output_file):
+    last_modified = client.get(f"/download/{output_file}").headers["last-modified"]
+    assert client.get(f"/download/{output_file}", headers={"If-Modified-Since": last_modified}).status_code == 304
+    older = formatdate(os.path.getmtime(main.result_store.path(output_file)) - 3600, usegmt=True)
+    assert client.get(f"/download/{output_file}", headers={"If-Modified-Since": older}).status_code == 200
+
+
+def test_range_requests_resume_the_download(output_file):
+    content = stored_bytes(output_file)
+    first = client.get(f"/download/{output_file}", headers={"Range": "bytes=0-99"})
+    assert first.status_code == 206
+    assert first.content == content[:100]
+    assert first.headers["content-range"] == f"bytes 0-99/{len(content)}"
+
+    rest = client.get(f"/download/{output_file}", headers={"Range": "bytes=100-"})
+    assert rest.status_code == 206
+    assert first.content + rest.content == content
+
+    assert client.get(f"/download/{output_file}", headers={"Range": f"bytes={len(content) + 10}-"}).status_code == 416
+
+
+def test_range_with_stale_if_range_sends_the_whole_file(output_file):
+    response = client.get(f"/download/{output_file}", headers={"Range": "bytes=0-9", "If-Range": '"outro"'})
+    assert response.status_code == 200
+    assert response.content == stored_bytes(output_file)
+
+
+def test_gzip_csv_export(output_file):
+    response = client.get(f"/download/{output_file}", params={"csv_gzip": True})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/gzip"
+    assert gzip.decompress(response.content).decode("utf-8-sig") == stored_bytes(output_file).decode("utf-8-sig")
+
+    etag = response.headers["etag"]
+    again = client.get(f"/download/{output_file}", params={"csv_gzip": True}, headers={"If-None-Match": etag})
+    assert again.status_code == 304
+
+
+@pytest.mark.parametrize("name", ["..%2Fmain.py", "inexistente.xlsx", "resultado.txt"])
+def test_unknown_or_unsafe_names_are_not_found(name):
+    assert client.get(f"/download/{name}").status_code == 404
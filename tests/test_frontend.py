@@ -0,0 +1,59 @@
+import gzip
+import os
+import tempfile
+
+os.environ.setdefault("NCM_SPREADSHEET_WORKERS", "0")
+os.environ.setdefault("NCM_RESULTS_DIR", tempfile.mkdtemp(prefix="ncm-resultados-teste-"))
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+client = TestClient(main.app)
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("gzip", True),
+    ("gzip, deflate, br", True),
+    ("br, gzip;q=0.5", True),
+    ("GZIP;Q=1", True),
+    ("x-gzip", True),
+    ("gzip;q=0.001", True),
+    ("*", True),
+    ("gzip;q=0", False),
+    ("gzip; q=0.0, deflate", False),
+    ("*;q=0", False),
+    ("*, gzip;q=0", False),
+    ("gzip;q=abc", False),
+    ("identity", False),
+    ("", False),
+])
+def test_accepts_gzip_honours_q_values(header, expected):
+    assert main.accepts_gzip(header) is expected
+
+
+def frontend(accept_encoding, **headers):
+    # httpx descompacta sozinho; o corpo bruto mostra o que o servidor enviou
+    with client.stream("GET", "/", headers={"Accept-Encoding": accept_encoding, **headers}) as response:
+        return response, b"".join(response.iter_raw())
+
+
+def test_frontend_is_gzipped_only_when_accepted():
+    with open(main.FRONTEND_PATH, "rb") as f:
+        content = f.read()
+    response, body = frontend("gzip")
+    assert response.headers["content-encoding"] == "gzip"
+    assert gzip.decompress(body) == content
+    assert "Accept-Encoding" in response.headers["vary"]
+
+    response, body = frontend("gzip;q=0")
+    assert "content-encoding" not in response.headers
+    assert body == content
+
+
+def test_frontend_revalidates_with_etag():
+    response, _ = frontend("identity")
+    response, body = frontend("identity", **{"If-None-Match": response.headers["etag"]})
+    assert response.status_code == 304
+    assert body == b""
@@ -0,0 +1,63 @@
+import io
+import os
+import tempfile
+
+os.environ.setdefault("NCM_SPREADSHEET_WORKERS", "0")
+os.environ.setdefault("NCM_RESULTS_DIR", tempfile.mkdtemp(prefix="ncm-resultados-teste-"))
+
+import pandas as pd
+from fastapi.testclient import TestClient
+
+import main
+
+client = TestClient(main.app)
+
+
+def workbook(df):
+    buffer = io.BytesIO()
+    df.to_excel(buffer, index=False)
+    return buffer.getvalue()
+
+
+def upload(content, **params):
+    response = client.post("/classify-excel", params=params, files={"file": ("planilha.xlsx", content)})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+# Uma coluna inteira com um vazio vira float (1.0) na leitura em memória e int (1)
+# no streaming; o mesmo arquivo lido dos dois jeitos não pode parecer alterado
+def test_same_workbook_in_memory_then_streaming_is_unchanged():
+    df = pd.DataFrame({
+        "NCM": ["3101.00.00", "8473.30.49", "3808.91.99", "0101.21.00"],
+        "Produto": ["a", "b", "c", "d"],
+        "Faturamento": [10.0, 20.0, 30.0, 40.0],
+        "Lote": [1, None, 3, 4],
+    })
+    content = workbook(df)
+    base = upload(content, keep_columns=True, incremental=True)
+    again = upload(content, keep_columns=True, streaming=True, previous=base["output_file"])
+
+    incremental = again["metrics"]["incremental"]
+    assert incremental["applied"], incremental
+    assert (incremental["unchanged_rows"], incremental["added_rows"], incremental["removed_rows"]) == (4, 0, 0)
+    assert again["metrics"]["total_revenue"] == base["metrics"]["total_revenue"]
+
+
+def test_revision_streaming_then_in_memory_counts_changes():
+    df = pd.DataFrame({
+        "Pedido": ["P1", "P2", "P3", "P4"],
+        "NCM": ["3101.00.00", "8473.30.49", "3808.91.99", "0101.21.00"],
+        "Faturamento": [10, 20, 30, 40],
+    })
+    base = upload(workbook(df), streaming=True, key_column="Pedido")
+    revised = pd.concat([df.drop(index=[3]), pd.DataFrame({"Pedido": ["P5"], "NCM": ["3101.00.00"], "Faturamento": [5]})])
+    revised.loc[0, "Faturamento"] = 11
+    result = upload(workbook(revised), key_column="Pedido", previous=base["output_file"])
+
+    incremental = result["metrics"]["incremental"]
+    assert incremental["applied"], incremental
+    assert incremental["unchanged_rows"] == 2
+    assert (incremental["added_rows"], incremental["changed_rows"], incremental["removed_rows"]) == (1, 1, 1)
+    full = upload(workbook(revised), key_column="Pedido")
+    assert result["metrics"]["item_breakdown"] == full["metrics"]["item_breakdown"]
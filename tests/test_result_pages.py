@@ -0,0 +1,121 @@
+import os
+import tempfile
+
+os.environ.setdefault("NCM_SPREADSHEET_WORKERS", "0")
+os.environ.setdefault("NCM_RESULTS_DIR", tempfile.mkdtemp(prefix="ncm-resultados-teste-"))
+
+import numpy as np
+import pandas as pd
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+client = TestClient(main.app)
+
+FILTERS = [
+    {},
+    {"enquadrado": True},
+    {"enquadrado": False},
+    {"item_code": "12"},
+    {"item_code": "N/A", "enquadrado": False},
+    {"item_code": "12", "enquadrado": False},
+    {"item_code": "999"},
+]
+
+
+# Arquivo de linhas com vários row groups pequenos, gravado em lotes como na classificação
+@pytest.fixture(scope="module")
+def rows_path(tmp_path_factory):
+    rng = np.random.default_rng(7)
+    size = 2_500
+    # Blocos de códigos de um mesmo item, para que alguns row groups fiquem de fora dos filtros
+    codes = np.where(np.arange(size) % 1_000 < 400, rng.integers(30040000, 30050000, size), rng.integers(90000000, 90100000, size))
+    df = pd.DataFrame({
+        "NCM": [f"{code:08d}" for code in codes],
+        "Descrição do Produto": "produto",
+        "Faturamento": rng.random(size).round(2),
+    })
+    path = str(tmp_path_factory.mktemp("paginas") / "resultado.rows")
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(main, "RESULTS_ROW_GROUP_ROWS", 150)
+        writer = main.ResultRowsWriter(path, "Faturamento")
+        for start in range(0, size, 700):
+            batch = main.normalize_batch(df.iloc[start:start + 700].copy(), {}, "Faturamento")
+            writer.write_batch(main.classify_batch(batch)[0])
+        writer.close()
+    return path
+
+
+# Referência: a tabela inteira filtrada e fatiada
+def reference_page(rows_path, page, page_size, enquadrado=None, item_code=None):
+    table = pq.read_table(rows_path)
+    mask = pc.equal(table["NCM"], table["NCM"])
+    if enquadrado is not None:
+        mask = pc.and_(mask, pc.equal(table["Enquadrado"], enquadrado))
+    if item_code is not None:
+        mask = pc.and_(mask, pc.equal(table["Código do item (índice)"], item_code))
+    table = table.filter(mask)
+    rows = table.slice((page - 1) * page_size, page_size).drop_columns(main.RESULT_FILTER_COLUMNS).to_pylist()
+    return rows, table.num_rows
+
+
+def test_rows_file_has_several_row_groups(rows_path):
+    assert pq.ParquetFile(rows_path).num_row_groups > 10
+
+
+@pytest.mark.parametrize("filters", FILTERS)
+@pytest.mark.parametrize("page_size", [1, 7, 100, 1000])
+def test_pages_match_full_table_scan(rows_path, filters, page_size):
+    for page in [1, 2, 3, 10, 21, 150, 2500, 2501]:
+        result = main.read_result_page(rows_path, page, page_size, **filters)
+        rows, total_rows = reference_page(rows_path, page, page_size, **filters)
+        assert result["results"] == rows, (filters, page_size, page)
+        assert result["pagination"]["total_rows"] == total_rows
+        assert result["pagination"]["total_pages"] == -(-total_rows // page_size)
+
+
+# Row groups excluídos pelas estatísticas (mínimo e máximo) não são lidos nem para contar
+def test_filter_skips_row_groups_by_statistics(rows_path, monkeypatch):
+    parquet_file = pq.ParquetFile(rows_path)
+    items = [parquet_file.read_row_group(index, columns=["Código do item (índice)"]).column(0).to_pylist() for index in range(parquet_file.num_row_groups)]
+    may_match = [index for index, values in enumerate(items) if min(values) <= "12" <= max(values)]
+    assert 0 < len(may_match) < len(items)
+
+    read_groups = []
+    original = pq.ParquetFile.read_row_group
+
+    def tracking_read(self, index, columns=None, **kwargs):
+        read_groups.append((index, tuple(columns or ())))
+        return original(self, index, columns=columns, **kwargs)
+
+    monkeypatch.setattr(pq.ParquetFile, "read_row_group", tracking_read)
+    result = main.read_result_page(rows_path, 1, 10, item_code="12")
+    assert [index for index, columns in read_groups if columns == ("Código do item (índice)",)] == may_match
+    # As linhas completas vêm só do primeiro row group com resultados
+    assert len([index for index, columns in read_groups if "NCM" in columns]) == 1
+    assert len(result["results"]) == 10
+
+
+# O filtro por item vale para os itens do próprio resultado, mesmo que as regras
+# tenham mudado depois; itens ausentes dão uma página vazia
+def test_item_filter_survives_a_rules_swap(monkeypatch):
+    content = ("NCM,Produto,Faturamento\n" + "3101.00.00,adubo,10\n8473.30.49,peça,20\n" * 30).encode()
+    response = client.post("/classify-excel", params={"output_format": "csv"}, files={"file": ("planilha.csv", content)})
+    assert response.status_code == 200, response.text
+    output_file = response.json()["output_file"]
+    item = main.get_item_code("3101.00.00")
+    assert item != "N/A"
+
+    rules = [rule for rule in main.rule_index.rules if rule["item"] != item]
+    monkeypatch.setattr(main, "rule_index", main.RuleIndex(rules))
+    response = client.get(f"/results/{output_file}", params={"item": item})
+    assert response.status_code == 200, response.text
+    assert response.json()["pagination"]["total_rows"] == 30
+
+    response = client.get(f"/results/{output_file}", params={"item": "inexistente"})
+    assert response.status_code == 200
+    assert response.json()["results"] == []
+    assert response.json()["pagination"]["total_rows"] == 0
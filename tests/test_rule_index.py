@@ -0,0 +1,145 @@
+import os
+import random
+import tempfile
+
+os.environ.setdefault("NCM_SPREADSHEET_WORKERS", "0")
+os.environ.setdefault("NCM_RESULTS_DIR", tempfile.mkdtemp(prefix="ncm-resultados-teste-"))
+
+import pandas as pd
+
+import main
+
+RULES = main.rule_index.rules
+
+
+# Referência sem índice: a primeira regra (na ordem de precedência) que se aplica
+def brute_force_position(code):
+    code_normalized = main.normalize_code(code)
+    return next((position for position, rule in enumerate(RULES) if main.rule_matches(rule, code_normalized)), -1)
+
+
+# Códigos próximos das regras (os próprios códigos, prefixos completados, exceções),
+# além de aleatórios, com pontos e inválidos
+def sample_codes(count, seed=1):
+    rng = random.Random(seed)
+    cited = sorted({code for rule in RULES for field in main.RULE_CODE_FIELDS for code in rule.get(field, ())})
+    codes = list(cited)
+    while len(codes) < count:
+        kind = rng.random()
+        if kind < 0.6:
+            base = rng.choice(cited)[:main.NCM_LENGTH]
+            code = base + "".join(rng.choice("0123456789") for _ in range(main.NCM_LENGTH - len(base)))
+        elif kind < 0.85:
+            code = f"{rng.randrange(10 ** main.NCM_LENGTH):08d}"
+        else:
+            code = rng.choice(["", "abc", "3101.00.0x", "0" * 17, "31010000 ", rng.choice(cited) + "1", rng.choice(cited)[:-1]])
+        if len(code) == main.NCM_LENGTH and rng.random() < 0.3:
+            code = f"{code[:4]}.{code[4:6]}.{code[6:]}"
+        codes.append(code)
+    return codes
+
+
+CODES = sample_codes(100_000)
+EXPECTED = [brute_force_position(code) for code in CODES]
+
+
+def test_scalar_lookup_matches_brute_force():
+    mismatches = [
+        (code, expected) for code, expected in zip(CODES, EXPECTED)
+        if main.rule_index.lookup_position(main.normalize_code(code)) != expected
+    ]
+    assert not mismatches, mismatches[:10]
+
+
+def test_vectorized_lookup_matches_brute_force():
+    positions = main.lookup_unique_codes(pd.Series(CODES).to_numpy(dtype=str))
+    mismatches = [(code, expected, int(found)) for code, expected, found in zip(CODES, EXPECTED, positions) if found != expected]
+    assert not mismatches, mismatches[:10]
+
+
+def test_classify_code_and_item_code_follow_the_matching_rule():
+    for code, expected in zip(CODES[:20_000], EXPECTED):
+        if expected >= 0:
+            assert main.classify_code(code) == RULES[expected]["description"]
+            assert main.get_item_code(code) == RULES[expected]["item"]
+        else:
+            assert main.classify_code(code) == main.not_found_description(code, main.normalize_code(code))
+            assert main.get_item_code(code) == "N/A"
+
+
+def test_classify_series_matches_brute_force():
+    codes = pd.Series(CODES[:20_000])
+    classified = main.classify_series(codes)
+    expected_items = [RULES[position]["item"] if position >= 0 else "N/A" for position in EXPECTED[:20_000]]
+    assert classified["Código do item (índice)"].astype(str).tolist() == expected_items
+    assert classified["Enquadrado"].tolist() == [position >= 0 for position in EXPECTED[:20_000]]
+
+
+def section_dict(section):
+    keys, positions = section
+    return dict(zip(keys.tolist(), positions.tolist()))
+
+
+def test_index_encoding_round_trips():
+    exact, prefix_levels = main.build_rule_tables(RULES)
+    sections = main.decode_rule_index(main.encode_rule_index("v1", exact, prefix_levels), "v1")
+    assert section_dict(sections.pop(0)) == {main.code_key(code): position for code, position in exact.items()}
+    assert {depth: section_dict(section) for depth, section in sections.items()} == {
+        depth: {int(prefix): position for prefix, position in level.items()} for depth, level in prefix_levels.items()
+    }
+
+
+def test_index_of_another_version_is_rejected():
+    content = main.encode_rule_index("v1", *main.build_rule_tables(RULES))
+    try:
+        main.decode_rule_index(content, "v2")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("índice de outra versão aceito")
+
+
+def lookups(index):
+    return [index.lookup_position(main.normalize_code(code)) for code in CODES[:5_000]]
+
+
+# Arquivos adulterados (mesmo tamanho), truncados ou vazios são regravados a partir das regras
+def test_mapped_index_is_rebuilt_when_the_file_does_not_match(monkeypatch, tmp_path):
+    index_dir = tmp_path / "indices"
+    monkeypatch.setattr(main, "RULES_INDEX_DIR", str(index_dir))
+    assert lookups(main.RuleIndex(RULES, "teste")) == EXPECTED[:5_000]
+    assert index_dir.stat().st_mode & 0o777 == 0o700
+    (index_path,) = index_dir.glob("*.idx")
+    original = index_path.read_bytes()
+
+    forged = bytearray(original)
+    forged[-16:] = b"\xff" * 16
+    for content in (bytes(forged), original[:len(original) // 2], b""):
+        index_path.write_bytes(content)
+        assert lookups(main.RuleIndex(RULES, "teste")) == EXPECTED[:5_000]
+        assert index_path.read_bytes() == original
+
+
+# Um diretório acessível a outros usuários não é usado: o índice fica na memória
+def test_shared_index_directory_falls_back_to_memory(monkeypatch, tmp_path):
+    index_dir = tmp_path / "indices"
+    index_dir.mkdir(mode=0o777)
+    index_dir.chmod(0o777)
+    monkeypatch.setattr(main, "RULES_INDEX_DIR", str(index_dir))
+    assert lookups(main.RuleIndex(RULES, "teste")) == EXPECTED[:5_000]
+    assert not list(index_dir.glob("*.idx"))
+
+
+# Ao abrir uma versão, os índices das outras são removidos; um índice antigo ainda
+# mapeado continua respondendo
+def test_indexes_of_other_versions_are_removed(monkeypatch, tmp_path):
+    index_dir = tmp_path / "indices"
+    monkeypatch.setattr(main, "RULES_INDEX_DIR", str(index_dir))
+    old_index = main.RuleIndex(RULES, "v1")
+    assert [path.name for path in index_dir.glob("*.idx")] == ["v1.idx"]
+    (index_dir / "outro.txt").write_text("mantido")
+
+    new_index = main.RuleIndex(RULES, "v2")
+    assert [path.name for path in index_dir.glob("*.idx")] == ["v2.idx"]
+    assert (index_dir / "outro.txt").exists()
+    assert lookups(old_index) == lookups(new_index) == EXPECTED[:5_000]
@@ -0,0 +1,74 @@
+import os
+import tempfile
+from collections import Counter
+
+os.environ.setdefault("NCM_SPREADSHEET_WORKERS", "0")
+os.environ.setdefault("NCM_RESULTS_DIR", tempfile.mkdtemp(prefix="ncm-resultados-teste-"))
+
+import numpy as np
+from fastapi.testclient import TestClient
+
+import main
+
+client = TestClient(main.app)
+
+RULES = main.rule_index.rules
+CITED = {code for rule in RULES for field in main.RULE_CODE_FIELDS for code in rule.get(field, ())}
+
+
+def coverage_counts(coverage):
+    counts = {entry["item"]: entry["codes"] for entry in coverage["items"]}
+    assert sum(counts.values()) == coverage["covered_codes"]
+    assert sum(entry["codes"] for entry in coverage["ranges"]) + sum(
+        1 for entry in coverage["exact_codes"] if len(entry["code"]) == main.NCM_LENGTH
+    ) == coverage["total_codes"]
+    return counts
+
+
+# Referência por força bruta: todos os NCMs sob o prefixo, cada um com a primeira
+# regra que se aplica. Só as regras que citam algo compatível com o prefixo podem se aplicar
+def brute_force_counts(prefix):
+    rules = [
+        rule for rule in RULES
+        if any(code.startswith(prefix) or prefix.startswith(code) for field in main.RULE_CODE_FIELDS for code in rule.get(field, ()))
+    ]
+    counts = Counter()
+    for number in range(10 ** (main.NCM_LENGTH - len(prefix))):
+        code = prefix + str(number).zfill(main.NCM_LENGTH - len(prefix))
+        rule = next((rule for rule in rules if main.rule_matches(rule, code)), None)
+        if rule is not None:
+            counts[rule["item"]] += 1
+    return dict(counts)
+
+
+def test_heading_coverage_matches_brute_force():
+    headings = sorted({code[:4] for code in CITED if len(code) >= 4}) + ["0000", "9999"]
+    for heading in headings:
+        assert coverage_counts(main.prefix_coverage(main.rule_index, heading)) == brute_force_counts(heading), heading
+
+
+def test_longer_prefix_coverage_matches_brute_force():
+    prefixes = sorted({code[:length] for code in CITED for length in (5, 6, 7) if len(code) >= length})
+    for prefix in prefixes:
+        assert coverage_counts(main.prefix_coverage(main.rule_index, prefix)) == brute_force_counts(prefix), prefix
+
+
+# Nos capítulos (um milhão de NCMs cada), a referência é a consulta vetorizada,
+# comparada com a força bruta em tests/test_rule_index.py
+def test_chapter_coverage_matches_vectorized_lookup():
+    compiled_rules = main.rule_index
+    labels = np.array(compiled_rules.item_codes + [None], dtype=object)
+    for chapter in sorted({code[:2] for code in CITED}) + ["99"]:
+        size = 10 ** (main.NCM_LENGTH - 2)
+        numbers = np.arange(size, dtype=np.uint64) + np.uint64(int(chapter) * size)
+        positions = compiled_rules.lookup_numbers(numbers, np.full(size, main.NCM_LENGTH))
+        expected = Counter(labels[positions[positions >= 0]].tolist())
+        assert coverage_counts(main.prefix_coverage(compiled_rules, chapter)) == dict(expected), chapter
+
+
+def test_chapter_listing_matches_coverage():
+    response = client.get("/rules/chapters/30", params={"list_codes": True})
+    assert response.status_code == 200, response.text
+    body = response.json()
+    assert len(body["codes"]) == body["covered_codes"]
+    assert all(main.rule_index.lookup_position(code) >= 0 for code in body["codes"][:1000])